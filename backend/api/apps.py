@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from .renderers import PdfShoppingCartRenderer
+        PdfShoppingCartRenderer.register_font()
@@ -0,0 +1,413 @@
+import json
+import random
+import statistics
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import NoReverseMatch, URLResolver, resolve, reverse
+from rest_framework.test import APIClient
+
+from recipes import popularity
+from recipes.counters import COUNTERS, reconcile
+from recipes.search import refresh_all, search_recipes, uses_search_vector
+from recipes.models import (Favorite, Ingredient, Recipe, RecipeIngredient,
+                            RecipePopularity, RecipeTag, ShoppingList, Tag)
+from recipes.shopping_cart import refresh_totals
+from recipes.versions import INGREDIENTS, bump_version
+from users.models import Subscription, User
+from . import urls
+
+IMAGE = (
+    'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABAgMAAABieywaAAAA'
+    'CVBMVEUAAAD///9fX1/S0ecCAAAACXBIWXMAAA7EAAAOxAGVKw4bAAAACklEQVQImWNoAA'
+    'AAggCByxOyYQAAAABJRU5ErkJggg=='
+)
+
+SEED_BATCH_SIZE = 10000
+# Запросы для замера поиска: редкое слово, слово из названий и слово,
+# которое есть в каждом рецепте.
+SEARCH_QUERIES = ('ingredient 000042', 'recipe', 'benchmark')
+
+DEFAULT_SCALE = {
+    'users': 20,
+    'recipes': 60,
+    'ingredients': 200,
+    'ingredients_per_recipe': 8,
+    'tags': 5,
+    'favorites': 10,
+    'subscriptions': 5,
+    'cart': 5,
+}
+
+
+@dataclass
+class Scenario:
+    name: str
+    route: str
+    method: str
+    url: str
+    data: dict = None
+    anonymous: bool = False
+    admin: bool = False
+
+
+SCENARIOS = (
+    Scenario('api-root', 'api-root', 'get', '/api/', anonymous=True),
+    Scenario('recipe-list', 'recipe-list', 'get', '/api/recipes/?limit=50'),
+    Scenario('recipe-list-cursor', 'recipe-list', 'get',
+             '/api/recipes/?limit=50&pagination=cursor'),
+    Scenario('recipe-list-anonymous', 'recipe-list', 'get',
+             '/api/recipes/?limit=50', anonymous=True),
+    Scenario('recipe-list-popular', 'recipe-list', 'get',
+             '/api/recipes/?ordering=-favorites&limit=50'),
+    Scenario('recipe-list-popularity', 'recipe-list', 'get',
+             '/api/recipes/?ordering=popular&limit=50'),
+    Scenario('recipe-trending', 'recipe-trending', 'get',
+             '/api/recipes/trending/?limit=50&author={author_id}'),
+    Scenario('recipe-list-search', 'recipe-list', 'get',
+             '/api/recipes/?search=ingredient&limit=50'),
+    Scenario('recipe-match', 'recipe-match', 'get',
+             '/api/recipes/match/?ingredients={pantry}&limit=20'),
+    Scenario('recipe-list-filtered', 'recipe-list', 'get',
+             '/api/recipes/?limit=50&tags={tag_slug}&is_favorited=1'),
+    Scenario('recipe-detail', 'recipe-detail', 'get',
+             '/api/recipes/{recipe_id}/'),
+    Scenario('recipe-create', 'recipe-list', 'post', '/api/recipes/', {
+        'name': 'Benchmark',
+        'text': 'Benchmark recipe',
+        'cooking_time': 10,
+        'ingredients': '{recipe_ingredients}',
+        'tags': '{tag_ids}',
+        'image': IMAGE,
+    }),
+    Scenario('recipe-update', 'recipe-detail', 'patch',
+             '/api/recipes/{own_recipe_id}/', {
+                 'name': 'Updated',
+                 'text': 'Benchmark recipe',
+                 'cooking_time': 5,
+                 'ingredients': '{recipe_ingredients}',
+                 'tags': '{tag_ids}',
+                 'image': IMAGE,
+             }),
+    Scenario('recipe-favorite-add', 'recipe-favorite', 'post',
+             '/api/recipes/{other_recipe_id}/favorite/'),
+    Scenario('recipe-favorite-remove', 'recipe-favorite', 'delete',
+             '/api/recipes/{other_recipe_id}/favorite/'),
+    Scenario('recipe-shopping-cart-add', 'recipe-shopping-cart', 'post',
+             '/api/recipes/{other_recipe_id}/shopping_cart/'),
+    Scenario('recipe-shopping-cart-remove', 'recipe-shopping-cart',
+             'delete', '/api/recipes/{other_recipe_id}/shopping_cart/'),
+    Scenario('recipe-bulk-shopping-cart-add', 'recipe-bulk-shopping-cart',
+             'post', '/api/recipes/shopping_cart/',
+             {'ids': '{bulk_recipe_ids}'}),
+    Scenario('recipe-bulk-shopping-cart-remove',
+             'recipe-bulk-shopping-cart', 'delete',
+             '/api/recipes/shopping_cart/', {'ids': '{bulk_recipe_ids}'}),
+    Scenario('recipe-bulk-favorite-add', 'recipe-bulk-favorite', 'post',
+             '/api/recipes/favorite/', {'ids': '{bulk_recipe_ids}'}),
+    Scenario('recipe-bulk-favorite-remove', 'recipe-bulk-favorite',
+             'delete', '/api/recipes/favorite/', {'ids': '{bulk_recipe_ids}'}),
+    Scenario('recipe-download-shopping-cart',
+             'recipe-download-shopping-cart', 'get',
+             '/api/recipes/download_shopping_cart/'),
+    Scenario('recipe-delete', 'recipe-detail', 'delete',
+             '/api/recipes/{own_recipe_id}/'),
+    Scenario('tag-list', 'tag-list', 'get', '/api/tags/', anonymous=True),
+    Scenario('tag-detail', 'tag-detail', 'get', '/api/tags/{tag_id}/',
+             anonymous=True),
+    Scenario('ingredient-list', 'ingredient-list', 'get',
+             '/api/ingredients/', anonymous=True),
+    Scenario('ingredient-search', 'ingredient-list', 'get',
+             '/api/ingredients/?name={ingredient_prefix}', anonymous=True),
+    Scenario('ingredient-detail', 'ingredient-detail', 'get',
+             '/api/ingredients/{ingredient_id}/', anonymous=True),
+    Scenario('user-list', 'user-list', 'get', '/api/users/?limit=10'),
+    Scenario('user-detail', 'user-detail', 'get', '/api/users/{author_id}/'),
+    Scenario('user-detail-expanded', 'user-detail', 'get',
+             '/api/users/{author_id}/?expand=recipes&recipes_limit=3'),
+    Scenario('user-me', 'user-me', 'get', '/api/users/me/'),
+    Scenario('user-subscriptions', 'user-subscriptions', 'get',
+             '/api/users/subscriptions/?limit=6&recipes_limit=3'),
+    Scenario('user-subscribe', 'user-subscribe', 'post',
+             '/api/users/{unfollowed_id}/subscribe/'),
+    Scenario('user-unsubscribe', 'user-subscribe', 'delete',
+             '/api/users/{unfollowed_id}/subscribe/'),
+    Scenario('user-set-password', 'user-set-password', 'post',
+             '/api/users/set_password/', {'new_password': 'benchmark-pass'}),
+    Scenario('login', 'login', 'post', '/api/auth/token/login', {
+        'email': '{viewer_email}', 'password': 'benchmark-pass',
+    }, anonymous=True),
+    Scenario('logout', 'logout', 'post', '/api/auth/token/logout'),
+    Scenario('metrics', 'metrics', 'get', '/api/metrics', admin=True),
+)
+
+
+def _route_names(patterns):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            yield from _route_names(pattern.url_patterns)
+        elif pattern.name:
+            yield pattern.name
+
+
+def _reachable(name):
+    try:
+        url = reverse(f'{urls.app_name}:{name}')
+    except NoReverseMatch:
+        return True
+    return resolve(url).url_name == name
+
+
+def registered_routes():
+    """Имена маршрутов api.urls, до которых доходят запросы.
+
+    Часть маршрутов djoser (users/activation/ и т. п.) перекрыта
+    маршрутом users/<pk>/ роутера, такие имена не учитываются.
+    """
+    return set(filter(_reachable, _route_names(urls.urlpatterns)))
+
+
+def uncovered_routes(scenarios=SCENARIOS):
+    return registered_routes() - {scenario.route for scenario in scenarios}
+
+
+def seed(scale=None, random_seed=0):
+    scale = {**DEFAULT_SCALE, **(scale or {})}
+    rnd = random.Random(random_seed)
+    password = make_password('benchmark-pass')
+
+    User.objects.bulk_create(
+        User(
+            email=f'bench{number}@example.com',
+            username=f'bench{number}',
+            first_name='Bench',
+            last_name=f'User {number}',
+            password=password,
+        )
+        for number in range(scale['users'])
+    )
+    users = list(User.objects.filter(
+        username__startswith='bench').order_by('id'))
+    Tag.objects.bulk_create(
+        Tag(name=f'Tag {number}', slug=f'tag{number}', color='#E26C2D')
+        for number in range(scale['tags'])
+    )
+    tags = list(Tag.objects.filter(slug__startswith='tag').order_by('id'))
+    Ingredient.objects.bulk_create(
+        Ingredient(name=f'ingredient {number:06}', measurement_unit='г')
+        for number in range(scale['ingredients'])
+    )
+    ingredients = list(Ingredient.objects.filter(
+        name__startswith='ingredient ').order_by('id'))
+    Recipe.objects.bulk_create((
+        Recipe(
+            name=f'Recipe {number}',
+            text='Benchmark recipe',
+            cooking_time=rnd.randint(1, 120),
+            author=users[number % len(users)],
+            image='recipes/benchmark.png',
+        )
+        for number in range(scale['recipes'])
+    ), batch_size=SEED_BATCH_SIZE)
+    recipes = list(Recipe.objects.filter(
+        author__in=users).only('id').order_by('id'))
+
+    recipe_tags = []
+    recipe_ingredients = []
+    for number, recipe in enumerate(recipes, 1):
+        for tag in rnd.sample(tags, min(2, len(tags))):
+            recipe_tags.append(RecipeTag(recipe=recipe, tag=tag))
+        for ingredient in rnd.sample(
+                ingredients,
+                min(scale['ingredients_per_recipe'], len(ingredients))):
+            recipe_ingredients.append(RecipeIngredient(
+                recipe=recipe,
+                ingredient=ingredient,
+                amount=rnd.randint(1, 1000),
+            ))
+        # Связи пишутся пачками, чтобы сид на миллион рецептов не
+        # держал все строки в памяти.
+        if number % SEED_BATCH_SIZE == 0 or number == len(recipes):
+            RecipeTag.objects.bulk_create(
+                recipe_tags, batch_size=SEED_BATCH_SIZE
+            )
+            RecipeIngredient.objects.bulk_create(
+                recipe_ingredients, batch_size=SEED_BATCH_SIZE
+            )
+            recipe_tags, recipe_ingredients = [], []
+
+    favorites = []
+    cart = []
+    subscriptions = []
+    for user in users:
+        for recipe in rnd.sample(
+                recipes, min(scale['favorites'], len(recipes))):
+            favorites.append(Favorite(user=user, recipe=recipe))
+        for recipe in rnd.sample(recipes, min(scale['cart'], len(recipes))):
+            cart.append(ShoppingList(user=user, recipe=recipe))
+        others = [author for author in users if author != user]
+        for author in rnd.sample(
+                others, min(scale['subscriptions'], len(others))):
+            subscriptions.append(Subscription(user=user, author=author))
+    Favorite.objects.bulk_create(favorites)
+    ShoppingList.objects.bulk_create(cart)
+    Subscription.objects.bulk_create(subscriptions)
+    refresh_totals([user.pk for user in users])
+    for model, counters in COUNTERS:
+        reconcile(model, counters)
+    popularity.refresh(lag=timedelta(0))
+    refresh_all()
+    bump_version(INGREDIENTS)
+
+    return users[0]
+
+
+def build_context(viewer):
+    own_recipe = Recipe.objects.filter(author=viewer).first()
+    other_recipe = Recipe.objects.exclude(author=viewer).exclude(
+        favorited_by__user=viewer).exclude(
+        in_shopping_cart__user=viewer).first()
+    unfollowed = User.objects.exclude(pk=viewer.pk).exclude(
+        followed__user=viewer).first()
+    author = User.objects.exclude(pk=viewer.pk).first()
+    ingredients = list(Ingredient.objects.all()[:5])
+    tags = list(Tag.objects.all()[:2])
+    return {
+        'viewer_email': viewer.email,
+        'recipe_id': other_recipe.pk,
+        'own_recipe_id': own_recipe.pk,
+        'other_recipe_id': other_recipe.pk,
+        'author_id': author.pk,
+        'unfollowed_id': unfollowed.pk,
+        'tag_id': tags[0].pk,
+        'tag_slug': tags[0].slug,
+        'tag_ids': [tag.pk for tag in tags],
+        'ingredient_id': ingredients[0].pk,
+        'pantry': ','.join(str(ingredient.pk) for ingredient in ingredients),
+        'ingredient_prefix': ingredients[0].name[:3],
+        'bulk_recipe_ids': list(
+            Recipe.objects.exclude(author=viewer).values_list(
+                'id', flat=True)[:20]
+        ),
+        'recipe_ingredients': [
+            {'id': ingredient.pk, 'amount': 10} for ingredient in ingredients
+        ],
+    }
+
+
+def query_plans(viewer):
+    """Планы запросов к связям и ленте, которые опираются на индексы."""
+    context = build_context(viewer)
+    querysets = {
+        'favorite-lookup': Favorite.objects.filter(
+            user=viewer, recipe_id=context['recipe_id']),
+        'shopping-list-lookup': ShoppingList.objects.filter(
+            user=viewer, recipe_id=context['recipe_id']),
+        'subscription-lookup': Subscription.objects.filter(
+            user=viewer, author_id=context['author_id']),
+        'recipe-tag-lookup': RecipeTag.objects.filter(
+            recipe_id=context['recipe_id'], tag_id=context['tag_id']),
+        'recipe-feed': Recipe.objects.all()[:6],
+        'author-feed': Recipe.objects.filter(
+            author_id=context['author_id'])[:6],
+        'popularity-feed': RecipePopularity.objects.order_by('-score')[:6],
+    }
+    if uses_search_vector():
+        querysets['recipe-search'] = search_recipes(
+            Recipe.objects.all(), SEARCH_QUERIES[0]
+        )[:6]
+    return {name: queryset.explain() for name, queryset in querysets.items()}
+
+
+def _fill(value, context):
+    if isinstance(value, str):
+        if value.startswith('{') and value.endswith('}'):
+            key = value[1:-1]
+            if key in context:
+                return context[key]
+        return value.format(**context)
+    if isinstance(value, dict):
+        return {key: _fill(item, context) for key, item in value.items()}
+    return value
+
+
+def _content_length(response):
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+def run(viewer, scenarios=SCENARIOS):
+    context = build_context(viewer)
+    results = {}
+    for scenario in scenarios:
+        client = APIClient()
+        if scenario.admin:
+            client.force_authenticate(user=User(is_staff=True))
+        elif not scenario.anonymous:
+            client.force_authenticate(user=viewer)
+        url = _fill(scenario.url, context)
+        data = _fill(scenario.data, context)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, scenario.method)(
+                url, data, format='json'
+            )
+            size = _content_length(response)
+            elapsed = time.perf_counter() - started
+        results[scenario.name] = {
+            'method': scenario.method.upper(),
+            'url': url,
+            'status': response.status_code,
+            'queries': len(queries),
+            'time_ms': round(elapsed * 1000, 3),
+            'bytes': size,
+        }
+    return results
+
+
+def time_search(viewer, queries=SEARCH_QUERIES, repeat=5):
+    """Медиана времени ответа /api/recipes/?search=... по запросам, мс.
+
+    Первый ответ прогревает кэши и индекс в памяти и не учитывается.
+    """
+    client = APIClient()
+    client.force_authenticate(user=viewer)
+    timings = {}
+    for query in queries:
+        samples = []
+        for _ in range(repeat + 1):
+            started = time.perf_counter()
+            client.get('/api/recipes/', {'search': query, 'limit': 6})
+            samples.append((time.perf_counter() - started) * 1000)
+        timings[query] = round(statistics.median(samples[1:]), 3)
+    return timings
+
+
+def load_budgets(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def check_budgets(results, budgets):
+    violations = []
+    for name, budget in budgets.items():
+        if name not in results:
+            violations.append(f'{name}: no measurement')
+            continue
+        result = results[name]
+        for metric, limit in budget.items():
+            if metric == 'status':
+                if result['status'] != limit:
+                    violations.append(
+                        f'{name}: status {result["status"]} != {limit}'
+                    )
+            elif result[metric] > limit:
+                violations.append(
+                    f'{name}: {metric} {result[metric]} > {limit}'
+                )
+    return violations
@@ -0,0 +1,192 @@
+from collections import defaultdict
+from datetime import timedelta
+from threading import Lock
+
+from django.conf import settings
+from django.utils import timezone
+
+from recipes.models import Ingredient, Recipe, RecipeIngredient, Tag
+from recipes.versions import (CHANGES_LAG, INGREDIENTS, RECIPES, TAGS,
+                              changed_recipes, get_version, prune_changes)
+from .metrics import cache_hit
+from .search import IngredientIndex, IngredientMatcher, RecipeIndex
+
+BATCH_SIZE = 1000
+PRUNE_INTERVAL = timedelta(hours=1)
+
+
+class IngredientCatalogue:
+    """Снимок справочника ингредиентов, готовый к отдаче клиенту."""
+
+    def __init__(self, version, items):
+        self.version = version
+        self.items = items
+        self.by_id = {item['id']: item for item in items}
+        self.index = IngredientIndex(
+            (item['id'], item['name']) for item in items
+        )
+
+    def get(self, pk):
+        return self.by_id.get(pk)
+
+    def search(self, query, limit):
+        return [self.by_id[pk] for pk in self.index.search(query, limit)]
+
+
+_catalogue = None
+_catalogue_lock = Lock()
+_tag_map = None
+_tag_lock = Lock()
+
+
+def get_ingredient_catalogue():
+    """Каталог текущего процесса; пересобирается при смене версии."""
+    global _catalogue
+    version = get_version(INGREDIENTS)
+    catalogue = _catalogue
+    if catalogue is not None and catalogue.version == version:
+        cache_hit('ingredients', True)
+        return catalogue
+    with _catalogue_lock:
+        if _catalogue is None or _catalogue.version != version:
+            cache_hit('ingredients', False)
+            _catalogue = IngredientCatalogue(
+                version,
+                tuple(Ingredient.objects.values(
+                    'id', 'name', 'measurement_unit'
+                ))
+            )
+        return _catalogue
+
+
+def in_batches(recipe_ids):
+    recipe_ids = sorted(recipe_ids)
+    for start in range(0, len(recipe_ids), BATCH_SIZE):
+        yield recipe_ids[start:start + BATCH_SIZE]
+
+
+def recipe_search_rows(recipe_ids=None):
+    """(id, название, ингредиенты через пробел, текст) рецептов
+    recipe_ids или всех рецептов."""
+    if recipe_ids is None:
+        batches = [None]
+    else:
+        batches = in_batches(recipe_ids)
+    for batch in batches:
+        links = RecipeIngredient.objects.all()
+        recipes = Recipe.objects.all()
+        if batch is not None:
+            links = links.filter(recipe_id__in=batch)
+            recipes = recipes.filter(pk__in=batch)
+        ingredients = defaultdict(list)
+        for recipe_id, name in links.values_list(
+                'recipe_id', 'ingredient__name').iterator():
+            ingredients[recipe_id].append(name)
+        for pk, name, text in recipes.values_list(
+                'id', 'name', 'text').iterator():
+            yield pk, name, ' '.join(ingredients[pk]), text
+
+
+def recipe_compositions(recipe_ids=None):
+    if recipe_ids is None:
+        batches = [None]
+    else:
+        batches = in_batches(recipe_ids)
+    for batch in batches:
+        links = RecipeIngredient.objects.order_by(
+            'recipe_id', 'ingredient_id'
+        )
+        if batch is not None:
+            links = links.filter(recipe_id__in=batch)
+        yield from links.values_list(
+            'recipe_id', 'ingredient_id'
+        ).iterator()
+
+
+class RecipeSnapshot:
+    """Структура рецептов в памяти процесса, которая догоняет базу по
+    журналу RecipeChange.
+
+    При смене версии RECIPES перечитываются только рецепты, изменённые
+    с прошлой синхронизации (с запасом CHANGES_LAG на поздние коммиты).
+    Целиком структура собирается при первом обращении, после долгого
+    простоя (журнал мог быть очищен) и при изменении большой доли
+    рецептов. Старые записи журнала удаляются не чаще PRUNE_INTERVAL.
+    """
+
+    def __init__(self, name, factory, load):
+        self.name = name
+        self.factory = factory
+        self.load = load
+        self.current = None
+        self.since = None
+        self.pruned = None
+        self.lock = Lock()
+
+    def get(self):
+        version = get_version(RECIPES)
+        current = self.current
+        if current is not None and current.version == version:
+            cache_hit(self.name, True)
+            return current
+        with self.lock:
+            current = self.current
+            if current is not None and current.version == version:
+                cache_hit(self.name, True)
+                return current
+            cache_hit(self.name, False)
+            started = timezone.now()
+            retention = timedelta(seconds=settings.RECIPE_CHANGES_RETENTION)
+            recipe_ids = None
+            if current is not None and self.since > started - retention:
+                recipe_ids = changed_recipes(self.since)
+                if len(recipe_ids) > max(len(current), 1000) // 4:
+                    recipe_ids = None
+            if recipe_ids is None:
+                self.current = self.factory(version, self.load())
+            else:
+                current.update(version, recipe_ids, self.load(recipe_ids))
+            if self.pruned is None:
+                self.pruned = started
+            elif started - self.pruned > PRUNE_INTERVAL:
+                prune_changes(started - retention)
+                self.pruned = started
+            self.since = started - CHANGES_LAG
+            return self.current
+
+    def clear(self):
+        with self.lock:
+            self.current = None
+
+
+recipe_index = RecipeSnapshot('recipe-index', RecipeIndex, recipe_search_rows)
+recipe_matcher = RecipeSnapshot(
+    'recipe-matcher', IngredientMatcher, recipe_compositions
+)
+
+
+def get_recipe_index():
+    """Поисковый индекс рецептов текущего процесса для баз без tsvector."""
+    return recipe_index.get()
+
+
+def get_recipe_matcher():
+    """Составы рецептов текущего процесса для подбора по ингредиентам."""
+    return recipe_matcher.get()
+
+
+def get_tag_ids():
+    """Словарь slug -> id тегов текущего процесса."""
+    global _tag_map
+    version = get_version(TAGS)
+    tag_map = _tag_map
+    if tag_map is not None and tag_map[0] == version:
+        cache_hit('tags', True)
+        return tag_map[1]
+    with _tag_lock:
+        if _tag_map is None or _tag_map[0] != version:
+            cache_hit('tags', False)
+            _tag_map = (
+                version, dict(Tag.objects.values_list('slug', 'id'))
+            )
+        return _tag_map[1]
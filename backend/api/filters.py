@@ -1,26 +1,152 @@
 import django_filters
+from django.conf import settings
+from django.db import connections
+from django.db.models import (Case, Exists, F, IntegerField, OuterRef, Value,
+                              When)
+from django_filters.constants import EMPTY_VALUES
 
-from recipes.models import Ingredient, Recipe
+from recipes.models import Ingredient, Recipe, RecipeTag
+from recipes.search import search_recipes, uses_search_vector
+from .catalogue import (get_ingredient_catalogue, get_recipe_index,
+                        get_tag_ids)
 
 
 class IngredientFilter(django_filters.FilterSet):
-    name = django_filters.CharFilter(lookup_expr='icontains')
+    name = django_filters.CharFilter(method='filter_name')
 
     class Meta:
         model = Ingredient
         fields = ['name', ]
 
+    def filter_name(self, queryset, name, value):
+        limit = settings.INGREDIENT_SEARCH_LIMIT
+        if connections[queryset.db].vendor == 'postgresql':
+            return queryset.filter(name__icontains=value).annotate(
+                prefix_rank=Case(
+                    When(name__istartswith=value, then=Value(0)),
+                    default=Value(1),
+                    output_field=IntegerField(),
+                )
+            ).order_by('prefix_rank', 'name')[:limit]
+        ids = get_ingredient_catalogue().index.search(value, limit)
+        if not ids:
+            return queryset.none()
+        return queryset.filter(pk__in=ids).order_by(Case(
+            *(When(pk=pk, then=Value(rank)) for rank, pk in enumerate(ids)),
+            output_field=IntegerField(),
+        ))
+
+
+class StableOrderingFilter(django_filters.OrderingFilter):
+    """Дополняет выбранную сортировку свежестью, чтобы страницы
+    с равными счётчиками не перемешивались.
+
+    presets задаёт готовые сортировки по имени параметра, например
+    по выражениям, которые нельзя выразить именем поля.
+    """
+    tiebreak = ('-pub_date', '-id')
+
+    def __init__(self, *args, presets=None, **kwargs):
+        self.presets = presets or {}
+        super().__init__(*args, **kwargs)
+        self.extra['choices'] = [
+            *self.extra['choices'],
+            *((param, param) for param in self.presets),
+        ]
+
+    def filter(self, qs, value):
+        if value in EMPTY_VALUES:
+            return qs
+        ordering = []
+        for param in value:
+            ordering.extend(
+                self.presets.get(param) or (self.get_ordering_value(param),)
+            )
+        names = {
+            name.lstrip('-') for name in ordering if isinstance(name, str)
+        }
+        return qs.order_by(*ordering, *(
+            field for field in self.tiebreak
+            if field.lstrip('-') not in names
+        ))
+
+
+def tag_choices():
+    return [(slug, slug) for slug in get_tag_ids()]
+
 
 class RecipeFilter(django_filters.FilterSet):
-    tags = django_filters.AllValuesMultipleFilter(field_name='tags__slug')
+    tags = django_filters.MultipleChoiceFilter(
+        choices=tag_choices, method='filter_tags'
+    )
+    tags_mode = django_filters.ChoiceFilter(
+        choices=(('any', 'any'), ('all', 'all')), method='filter_noop'
+    )
     is_favorited = django_filters.NumberFilter(method='filter_is_favorited')
     is_in_shopping_cart = django_filters.NumberFilter(
         method='filter_is_in_shopping_cart')
     author = django_filters.NumberFilter(field_name='author__id')
+    search = django_filters.CharFilter(method='filter_search')
+    ordering = StableOrderingFilter(
+        fields=(
+            ('favorites_count', 'favorites'),
+            ('carts_count', 'carts'),
+            ('pub_date', 'pub_date'),
+        ),
+        presets={
+            'popular': (F('popularity__score').desc(nulls_last=True),),
+        }
+    )
 
     class Meta:
         model = Recipe
-        fields = ('author', 'tags', 'is_favorited', 'is_in_shopping_cart')
+        fields = ('author', 'tags', 'tags_mode', 'is_favorited',
+                  'is_in_shopping_cart')
+
+    def filter_noop(self, queryset, name, value):
+        return queryset
+
+    def filter_tags(self, queryset, name, value):
+        """Рецепты с любым (tags_mode=any) или со всеми (tags_mode=all)
+        из тегов; EXISTS не размножает строки, и DISTINCT не нужен."""
+        tag_ids = get_tag_ids()
+        ids = {tag_ids[slug] for slug in value if slug in tag_ids}
+        if self.form.cleaned_data.get('tags_mode') == 'all':
+            for tag_id in ids:
+                queryset = queryset.filter(Exists(RecipeTag.objects.filter(
+                    recipe=OuterRef('pk'), tag_id=tag_id
+                )))
+            return queryset
+        return queryset.filter(Exists(RecipeTag.objects.filter(
+            recipe=OuterRef('pk'), tag_id__in=ids
+        )))
+
+    def filter_search(self, queryset, name, value):
+        """Без tsvector отдаёт до RECIPE_SEARCH_LIMIT лучших совпадений
+        среди рецептов, уже отобранных остальными фильтрами (search
+        применяется после них)."""
+        if uses_search_vector():
+            return search_recipes(queryset, value)
+        limit = settings.RECIPE_SEARCH_LIMIT
+        ranked = get_recipe_index().search(value, None)
+        if queryset.query.where:
+            ids = []
+            for start in range(0, len(ranked), limit):
+                batch = ranked[start:start + limit]
+                allowed = set(queryset.filter(
+                    pk__in=batch
+                ).values_list('pk', flat=True))
+                ids.extend(pk for pk in batch if pk in allowed)
+                if len(ids) >= limit:
+                    break
+            ranked = ids
+        ids = ranked[:limit]
+        if not ids:
+            return queryset.none()
+        return queryset.filter(pk__in=ids).order_by(Case(
+            *(When(pk=pk, then=Value(rank)) for rank, pk in enumerate(ids)),
+            output_field=IntegerField(),
+        ))
 
     def filter_is_in_shopping_cart(self, queryset, name, value):
         if value and self.request.user.is_authenticated:
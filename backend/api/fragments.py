@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .metrics import cache_hit
+
+
+def shared_key(key):
+    return 'recipe-fragment:' + ':'.join(map(str, key))
+
+
+class FragmentCache:
+    """LRU-кэш готовых представлений рецептов текущего процесса.
+
+    Ключ — (id рецепта, версия рецепта, размер изображения, адрес сайта),
+    поэтому устаревшие записи не удаляются, а просто перестают
+    запрашиваться. При RECIPE_FRAGMENT_SHARED_CACHE промахи ищутся
+    и сохраняются также в общем кэше Django.
+    """
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = self.items.get(key)
+                if value is not None:
+                    self.items.move_to_end(key)
+                    found[key] = value
+        missing = [key for key in keys if key not in found]
+        if missing and settings.RECIPE_FRAGMENT_SHARED_CACHE:
+            names = {shared_key(key): key for key in missing}
+            shared = {
+                names[name]: value
+                for name, value in cache.get_many(list(names)).items()
+            }
+            self.store(shared)
+            found.update(shared)
+        for key in keys:
+            cache_hit('recipe-fragments', key in found)
+        return found
+
+    def set_many(self, fragments):
+        self.store(fragments)
+        if fragments and settings.RECIPE_FRAGMENT_SHARED_CACHE:
+            cache.set_many(
+                {shared_key(key): value for key, value in fragments.items()},
+                settings.RECIPE_FRAGMENT_CACHE_TTL
+            )
+
+    def store(self, fragments):
+        size = settings.RECIPE_FRAGMENT_CACHE_SIZE
+        if size <= 0:
+            return
+        with self.lock:
+            self.items.update(fragments)
+            for key in fragments:
+                self.items.move_to_end(key)
+            while len(self.items) > size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+fragments = FragmentCache()
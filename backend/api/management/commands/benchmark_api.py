@@ -0,0 +1,120 @@
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import (override_settings, setup_test_environment,
+                               teardown_test_environment)
+
+from api import benchmark
+
+DEFAULT_BUDGETS = os.path.join(
+    settings.BASE_DIR, 'api', 'benchmark_budgets.json'
+)
+BENCHMARK_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark',
+    }
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Прогон всех эндпоинтов API на синтетических данных: '
+        'число SQL-запросов, время и размер ответа'
+    )
+
+    def add_arguments(self, parser):
+        for name, value in benchmark.DEFAULT_SCALE.items():
+            parser.add_argument(
+                f'--{name.replace("_", "-")}', dest=name, type=int,
+                default=value
+            )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--budgets', default=DEFAULT_BUDGETS)
+        parser.add_argument('--no-budgets', action='store_true')
+        parser.add_argument('--report', help='Путь для JSON-отчёта')
+        parser.add_argument(
+            '--explain', action='store_true',
+            help='Вывести планы запросов к связям и ленте рецептов'
+        )
+        parser.add_argument(
+            '--search-target-ms', type=float,
+            help='Замерить поиск рецептов и упасть, если медиана '
+                 'ответа по какому-то запросу дольше заданной'
+        )
+        parser.add_argument('--search-repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        scale = {name: options[name] for name in benchmark.DEFAULT_SCALE}
+        uncovered = benchmark.uncovered_routes()
+        if uncovered:
+            raise CommandError(
+                'Нет сценариев для маршрутов: ' + ', '.join(sorted(uncovered))
+            )
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True
+        )
+        try:
+            with tempfile.TemporaryDirectory() as media_root, \
+                    override_settings(MEDIA_ROOT=media_root,
+                                      CACHES=BENCHMARK_CACHES), \
+                    transaction.atomic():
+                viewer = benchmark.seed(scale, options['seed'])
+                results = benchmark.run(viewer)
+                plans = (
+                    benchmark.query_plans(viewer)
+                    if options['explain'] else {}
+                )
+                search = (
+                    benchmark.time_search(viewer,
+                                          repeat=options['search_repeat'])
+                    if options['search_target_ms'] is not None else {}
+                )
+                transaction.set_rollback(True)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:34} {result["status"]:>4} '
+                f'{result["queries"]:>5} q {result["time_ms"]:>9.1f} ms '
+                f'{result["bytes"]:>9} B'
+            )
+
+        for name, plan in plans.items():
+            self.stdout.write(f'\n{name}:\n{plan}')
+
+        for query, time_ms in search.items():
+            self.stdout.write(f'search {query!r:27} {time_ms:>9.1f} ms')
+
+        if options['report']:
+            with open(options['report'], 'w', encoding='utf-8') as f:
+                json.dump(
+                    {'scale': scale, 'results': results, 'plans': plans,
+                     'search': search},
+                    f, indent=2, sort_keys=True
+                )
+
+        violations = [
+            f'search {query!r}: {time_ms} ms > {options["search_target_ms"]}'
+            for query, time_ms in search.items()
+            if time_ms > options['search_target_ms']
+        ]
+        if not options['no_budgets']:
+            violations += benchmark.check_budgets(
+                results, benchmark.load_budgets(options['budgets'])
+            )
+        elif not search:
+            return
+        if violations:
+            raise CommandError(
+                'Превышены бюджеты:\n' + '\n'.join(violations)
+            )
+        self.stdout.write(self.style.SUCCESS('Все бюджеты соблюдены'))
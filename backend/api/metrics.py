@@ -0,0 +1,73 @@
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+
+SIZE_BUCKETS = (
+    1024, 16 * 1024, 64 * 1024, 256 * 1024,
+    1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024,
+)
+
+REQUESTS = Counter(
+    'foodgram_requests_total', 'HTTP-запросы к API',
+    ['route', 'method', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'foodgram_request_duration_seconds', 'Время ответа API',
+    ['route', 'method']
+)
+REQUEST_QUERIES = Histogram(
+    'foodgram_request_queries', 'SQL-запросов на один HTTP-запрос',
+    ['route', 'method'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+)
+CACHE_REQUESTS = Counter(
+    'foodgram_cache_requests_total', 'Обращения к кэшам',
+    ['cache', 'result']
+)
+IMAGE_UPLOAD_BYTES = Histogram(
+    'foodgram_image_upload_bytes', 'Размер загруженных изображений',
+    buckets=SIZE_BUCKETS
+)
+CART_EXPORT_BYTES = Histogram(
+    'foodgram_cart_export_bytes', 'Размер выгрузки списка покупок',
+    ['format'], buckets=SIZE_BUCKETS
+)
+CART_EXPORT_DURATION = Histogram(
+    'foodgram_cart_export_duration_seconds',
+    'Время выгрузки списка покупок', ['format']
+)
+
+
+def cache_hit(name, hit):
+    CACHE_REQUESTS.labels(name, 'hit' if hit else 'miss').inc()
+
+
+def observe_export(file_format, chunks, charset=None):
+    """Отдаёт части выгрузки байтами, измеряя её размер и время до конца."""
+    started = time.perf_counter()
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(charset or 'utf-8')
+        size += len(chunk)
+        yield chunk
+    CART_EXPORT_BYTES.labels(file_format).observe(size)
+    CART_EXPORT_DURATION.labels(file_format).observe(
+        time.perf_counter() - started
+    )
+
+
+def collect():
+    """Метрики в текстовом формате Prometheus.
+
+    Под gunicorn с PROMETHEUS_MULTIPROC_DIR каждый воркер пишет значения
+    в свои mmap-файлы в этом каталоге, а здесь они суммируются.
+    """
+    registry = REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
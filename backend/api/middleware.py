@@ -0,0 +1,179 @@
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+_profile = ContextVar('request_profile', default=None)
+
+
+def fingerprint(sql):
+    """SQL без значений: запросы, отличающиеся только ими, совпадают."""
+    return IN_LIST.sub('IN (...)', sql)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = Counter()
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries[fingerprint(sql)] += 1
+
+    def duplicates(self):
+        return [
+            {'sql': sql, 'count': count}
+            for sql, count in self.queries.most_common()
+            if count >= settings.REQUEST_PROFILING_DUPLICATE_THRESHOLD
+        ]
+
+
+class ProfiledData:
+    """Примесь к классу сериализатора: время serializer.data верхнего
+    уровня засчитывается в профиль запроса."""
+
+    @property
+    def data(self):
+        profile = _profile.get()
+        if profile is None or profile.serializer_depth:
+            return super().data
+        profile.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().data
+        finally:
+            profile.serializer_time += time.perf_counter() - started
+            profile.serializer_depth -= 1
+
+
+_profiled_classes = {}
+
+
+def profiled(serializer):
+    """Включает замер serializer.data, если запрос профилируется."""
+    if _profile.get() is None:
+        return serializer
+    cls = type(serializer)
+    profiled_class = _profiled_classes.get(cls)
+    if profiled_class is None:
+        profiled_class = _profiled_classes[cls] = type(
+            cls.__name__, (ProfiledData, cls), {}
+        )
+    serializer.__class__ = profiled_class
+    return serializer
+
+
+class RequestProfilingMiddleware:
+    """Число и время SQL-запросов, время сериализации и повторяющиеся
+    запросы (N+1) для доли REQUEST_PROFILING_SAMPLE_RATE запросов.
+
+    Время сериализации считают представления: сериализаторы, полученные
+    через ProfiledSerializerMixin.get_serializer или обёрнутые profiled().
+
+    Результат уходит в заголовок Server-Timing и в лог api.middleware
+    одной JSON-строкой. При нулевой доле middleware отключается целиком.
+    """
+
+    def __init__(self, get_response):
+        self.sample_rate = settings.REQUEST_PROFILING_SAMPLE_RATE
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            _profile.reset(token)
+        self.report(request, response, profile)
+        return response
+
+    def report(self, request, response, profile):
+        total = time.perf_counter() - profile.started
+        query_count = sum(profile.queries.values())
+        duplicates = profile.duplicates()
+        match = request.resolver_match
+        timing = [
+            f'total;dur={total * 1000:.1f}',
+            f'db;dur={profile.db_time * 1000:.1f};desc="{query_count} q"',
+            f'serializer;dur={profile.serializer_time * 1000:.1f}',
+        ]
+        if duplicates:
+            timing.append(f'dup;desc="{len(duplicates)} repeated"')
+        response['Server-Timing'] = ', '.join(timing)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'db_ms': round(profile.db_time * 1000, 1),
+            'queries': query_count,
+            'serializer_ms': round(profile.serializer_time * 1000, 1),
+            'duplicates': duplicates,
+        }, ensure_ascii=False))
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware:
+    """Время ответа, статус и число SQL-запросов по маршрутам API."""
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+        match = request.resolver_match
+        route = match.view_name if match else 'unmatched'
+        metrics.REQUEST_LATENCY.labels(route, request.method).observe(
+            time.perf_counter() - started
+        )
+        metrics.REQUEST_QUERIES.labels(route, request.method).observe(
+            counter.count
+        )
+        metrics.REQUESTS.labels(
+            route, request.method, response.status_code
+        ).inc()
+        return response
@@ -0,0 +1,55 @@
+from hashlib import sha1
+
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+
+from recipes.versions import get_version
+from .middleware import profiled
+
+
+class ConditionalGetMixin:
+    """ETag и Cache-Control для справочников, меняющихся только через
+    сигналы моделей.
+
+    ETag строится из версии набора данных, пути запроса и заголовка
+    Accept, поэтому 304 отдаётся до аутентификации, запросов к БД и
+    сериализации.
+    """
+    version_name = None
+
+    def get_etag(self, request):
+        source = '\n'.join((
+            get_version(self.version_name),
+            request.get_full_path(),
+            request.META.get('HTTP_ACCEPT', ''),
+        ))
+        return f'"{sha1(source.encode()).hexdigest()}"'
+
+    def set_cache_headers(self, response, etag):
+        response['ETag'] = etag
+        patch_cache_control(
+            response, public=True, max_age=settings.API_CACHE_MAX_AGE
+        )
+        patch_vary_headers(response, ('Accept',))
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+        etag = self.get_etag(request)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+            self.set_cache_headers(response, etag)
+            return response
+        response = super().dispatch(request, *args, **kwargs)
+        if response.status_code == 200:
+            self.set_cache_headers(response, etag)
+        return response
+
+
+class ProfiledSerializerMixin:
+    """Засчитывает время сериализации в профиль запроса."""
+
+    def get_serializer(self, *args, **kwargs):
+        return profiled(super().get_serializer(*args, **kwargs))
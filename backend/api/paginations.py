@@ -1,6 +1,378 @@
+import base64
+import binascii
+import hashlib
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import (EmptyResultSet, FieldDoesNotExist,
+                                    ValidationError as DjangoValidationError)
+from django.core.paginator import (EmptyPage, Page, PageNotAnInteger,
+                                   Paginator)
+from django.db import connection
+from django.db.models import F, OrderBy, Q, QuerySet
+from django.db.models.constants import LOOKUP_SEP
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .metrics import cache_hit
+
+
+def estimate_count(queryset):
+    """Оценка числа строк по плану PostgreSQL; на других СУБД — None."""
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        sql, params = queryset.order_by().query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class ExactCount:
+    name = 'exact'
+
+    def count(self, queryset):
+        return queryset.count(), self.name
+
+
+class CachedCount(ExactCount):
+    """Точное число, сохранённое в кэше на PAGINATION_COUNT_CACHE_TTL.
+
+    Ключ строится по SQL запроса без аннотаций, поэтому одинаковые
+    фильтры разных пользователей попадают в одну запись кэша.
+    """
+    name = 'cached'
+
+    def count(self, queryset):
+        try:
+            sql, params = (
+                queryset.order_by().values('pk').query.sql_with_params()
+            )
+        except EmptyResultSet:
+            return 0, self.name
+        key = 'pagination-count:' + hashlib.sha1(
+            repr((sql, params)).encode()
+        ).hexdigest()
+        value = cache.get(key)
+        cache_hit('pagination-count', value is not None)
+        if value is None:
+            value = queryset.count()
+            cache.set(key, value, settings.PAGINATION_COUNT_CACHE_TTL)
+        return value, self.name
+
+
+class EstimatedCount(ExactCount):
+    """Оценка планировщика; небольшие выборки считаются точно."""
+    name = 'estimated'
+
+    def count(self, queryset):
+        value = estimate_count(queryset)
+        if value is None or value < settings.PAGINATION_ESTIMATE_THRESHOLD:
+            return super().count(queryset)
+        return value, self.name
+
+
+class NoCount:
+    name = 'none'
+
+    def count(self, queryset):
+        return None, self.name
+
+
+COUNT_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (ExactCount(), CachedCount(), EstimatedCount(), NoCount())
+}
+
+
+class CountingPage(Page):
+    def has_next(self):
+        return self.has_more
+
+
+class CountingPaginator(Paginator):
+    """Paginator, который берёт count у выбранной стратегии.
+
+    Приблизительный count не обрезает страницы: наличие следующей
+    страницы определяется по лишней строке выборки, а номера страниц
+    за пределами оценки не считаются ошибкой.
+    """
+
+    def __init__(self, *args, count_strategy, **kwargs):
+        self.count_strategy = count_strategy
+        self.count_strategy_used = ExactCount.name
+        super().__init__(*args, **kwargs)
+
+    @cached_property
+    def count(self):
+        if not isinstance(self.object_list, QuerySet):
+            return super().count
+        value, self.count_strategy_used = self.count_strategy.count(
+            self.object_list
+        )
+        return value
+
+    def validate_number(self, number):
+        self.count  # заполняет count_strategy_used
+        if self.count_strategy_used == ExactCount.name:
+            return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('Номер страницы должен быть целым')
+        if number < 1:
+            raise EmptyPage('Номер страницы меньше 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        page = CountingPage(rows[:self.per_page], number, self)
+        page.has_more = len(rows) > self.per_page
+        return page
 
 
 class CustomPagination(PageNumberPagination):
+    """Постраничная выдача с подключаемым способом подсчёта count.
+
+    Способ выбирается параметром count (exact, cached, estimated), по
+    умолчанию — count_strategy; использованный способ возвращается в
+    поле count_strategy ответа.
+    """
     page_size = 6
     page_size_query_param = 'limit'
+    count_query_param = 'count'
+    count_strategy = settings.PAGINATION_COUNT_STRATEGY
+
+    def get_count_strategy(self, request, default):
+        name = request.query_params.get(self.count_query_param, default)
+        return COUNT_STRATEGIES.get(name, COUNT_STRATEGIES[default])
+
+    def paginate_queryset(self, queryset, request, view=None):
+        strategy = self.get_count_strategy(request, self.count_strategy)
+        if strategy is COUNT_STRATEGIES[NoCount.name]:
+            strategy = COUNT_STRATEGIES[ExactCount.name]
+        self.django_paginator_class = (
+            lambda *args, **kwargs: CountingPaginator(
+                *args, count_strategy=strategy, **kwargs
+            )
+        )
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'count': self.page.paginator.count,
+            'count_strategy': self.page.paginator.count_strategy_used,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+
+class CursorKey:
+    """Ключ сортировки курсора: поле рецепта или аннотация cursor_N."""
+
+    def __init__(self, model, name, expression, descending, number):
+        self.descending = descending
+        self.expression = expression
+        field = None
+        if name is not None and LOOKUP_SEP not in name:
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                pass
+        self.annotated = field is None or field.null
+        self.name = name
+        self.field = field
+        self.attname = f'cursor_{number}' if self.annotated else name
+
+    def order_by(self):
+        if not self.annotated:
+            return ('-' if self.descending else '') + self.attname
+        if self.descending:
+            return F(self.attname).desc(nulls_last=True)
+        return F(self.attname).asc(nulls_last=True)
+
+    def to_python(self, queryset, value):
+        if self.annotated:
+            field = queryset.query.annotations[self.attname].output_field
+        else:
+            field = self.field
+        return field.to_python(value)
+
+    def equal(self, value):
+        if value is None:
+            return Q(**{self.attname + '__isnull': True})
+        return Q(**{self.attname: value})
+
+    def beyond(self, value):
+        if value is None:
+            return None  # NULL идут последними
+        lookup = 'lt' if self.descending else 'gt'
+        condition = Q(**{f'{self.attname}__{lookup}': value})
+        if self.annotated:
+            condition |= Q(**{self.attname + '__isnull': True})
+        return condition
+
+
+class RecipePagination(CustomPagination):
+    """Постраничная выдача с опциональным режимом курсора.
+
+    С pagination=cursor (или cursor=...) лента идёт по ключу текущей
+    сортировки (по умолчанию pub_date, id) без OFFSET, поэтому глубокие
+    страницы стоят столько же, сколько первая, а новые рецепты не
+    сдвигают уже выданные. Число записей в этом режиме по умолчанию
+    не считается (count=none).
+    """
+    cursor_query_param = 'cursor'
+    mode_query_param = 'pagination'
+    count_strategy = settings.RECIPE_COUNT_STRATEGY
+    cursor_count_strategy = NoCount.name
+    cursor_ordering = ('-pub_date', '-id')
+    invalid_cursor_message = 'Некорректный курсор'
+    invalid_ordering_message = 'Сортировка не поддерживается курсором'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = (
+            self.cursor_query_param in request.query_params
+            or request.query_params.get(self.mode_query_param) == 'cursor'
+        )
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset, self.keys = self.cursor_keys(queryset)
+        self.count, self.count_strategy_used = self.get_count_strategy(
+            request, self.cursor_count_strategy
+        ).count(queryset)
+        position = self.decode_cursor(
+            queryset, request.query_params.get(self.cursor_query_param)
+        )
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+        page = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = [
+                getattr(page[-1], key.attname) for key in self.keys
+            ]
+        return page
+
+    def cursor_keys(self, queryset):
+        """Упорядочивает queryset по ключам курсора.
+
+        Ключи берутся из текущей сортировки и дополняются id. Поля
+        рецепта без NULL сортируются как есть, чтобы работали индексы;
+        остальное (поля связей, выражения) аннотируется, а NULL в нём
+        идут последними.
+        """
+        keys = []
+        for term in queryset.query.order_by or self.cursor_ordering:
+            if isinstance(term, str):
+                if term == '?':
+                    raise ValidationError(
+                        {'ordering': self.invalid_ordering_message}
+                    )
+                descending = term.startswith('-')
+                name = term.lstrip('-')
+                name = 'id' if name == 'pk' else name
+                expression = F(name)
+            elif isinstance(term, OrderBy):
+                descending = term.descending
+                expression = term.expression
+                name = getattr(expression, 'name', None)
+            else:
+                descending, expression, name = False, term, None
+            keys.append(CursorKey(queryset.model, name, expression,
+                                  descending, len(keys)))
+        if not any(key.name == 'id' for key in keys):
+            keys.append(CursorKey(queryset.model, 'id', F('id'), True,
+                                  len(keys)))
+        queryset = queryset.annotate(**{
+            key.attname: key.expression for key in keys if key.annotated
+        })
+        return queryset.order_by(*(key.order_by() for key in keys)), keys
+
+    def after(self, position):
+        """Условие «строка идёт после position» для сортировки по ключам."""
+        condition = None
+        equal = Q()
+        for key, value in zip(self.keys, position):
+            beyond = key.beyond(value)
+            if beyond is not None:
+                beyond &= equal
+                condition = beyond if condition is None else condition | beyond
+            equal &= key.equal(value)
+        return condition
+
+    def signature(self):
+        return [('-' if key.descending else '') + key.attname
+                for key in self.keys]
+
+    def decode_cursor(self, queryset, token):
+        if not token:
+            return None
+        try:
+            signature, values = json.loads(
+                base64.urlsafe_b64decode(token.encode()).decode()
+            )
+            if signature != self.signature() or len(values) != len(self.keys):
+                raise ValueError(signature)
+            return [
+                None if value is None else key.to_python(queryset, value)
+                for key, value in zip(self.keys, values)
+            ]
+        except (binascii.Error, DjangoValidationError, TypeError,
+                ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        return base64.urlsafe_b64encode(json.dumps([
+            self.signature(),
+            [
+                value.isoformat() if isinstance(value, datetime) else value
+                for value in position
+            ],
+        ]).encode()).decode()
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if self.next_position is None:
+            return None
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.page_query_param
+        )
+        return replace_query_param(
+            url, self.cursor_query_param,
+            self.encode_cursor(self.next_position)
+        )
+
+    def get_previous_link(self):
+        if not self.cursor_mode:
+            return super().get_previous_link()
+        return None
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response({
+            'count': self.count,
+            'count_strategy': self.count_strategy_used,
+            'next': self.get_next_link(),
+            'previous': None,
+            'results': data,
+        })
@@ -0,0 +1,29 @@
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.parsers import JSONParser
+
+
+class RequestTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Слишком большое тело запроса'
+    default_code = 'request_too_large'
+
+
+class LimitedJSONParser(JSONParser):
+    """JSONParser, отклоняющий тело больше JSON_BODY_MAX_SIZE до разбора.
+
+    DRF читает поток запроса сам, поэтому DATA_UPLOAD_MAX_MEMORY_SIZE
+    к JSON не применяется.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = (parser_context or {}).get('request')
+        if request is not None:
+            try:
+                length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            if length > settings.JSON_BODY_MAX_SIZE:
+                raise RequestTooLarge
+        return super().parse(stream, media_type, parser_context)
@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from rest_framework import permissions
 from rest_framework.permissions import SAFE_METHODS
 
@@ -15,3 +17,14 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
             request.method in SAFE_METHODS
             or request.user == obj.author
         )
+
+
+class HasMetricsToken(permissions.BasePermission):
+    """Заголовок Authorization: Bearer <METRICS_TOKEN>; без токена
+    в настройках не пропускает никого."""
+
+    def has_permission(self, request, view):
+        token = settings.METRICS_TOKEN
+        return bool(token) and constant_time_compare(
+            request.headers.get('Authorization', ''), f'Bearer {token}'
+        )
@@ -0,0 +1,149 @@
+import csv
+import json
+import logging
+import os
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from rest_framework.renderers import BaseRenderer
+
+logger = logging.getLogger(__name__)
+
+PDF_LINE_HEIGHT = 16
+PDF_MARGIN = 50
+PDF_DEFAULT_FONT = 'Helvetica'
+PDF_FONT = 'ShoppingCartFont'
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+class ShoppingCartRenderer(BaseRenderer):
+    """Базовый рендерер списка покупок.
+
+    Строки списка приходят итератором словарей с ключами name,
+    measurement_unit и amount; stream() отдаёт файл по частям —
+    по умолчанию строками «название - количество единица».
+    """
+    charset = 'utf-8'
+
+    def stream(self, rows):
+        for row in rows:
+            yield (
+                f"{row['name']} - {row['amount']} "
+                f"{row['measurement_unit']}\n"
+            )
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if response is not None and response.exception:
+            response['Content-Type'] = 'application/json'
+            return json.dumps(data, ensure_ascii=False).encode()
+        return b''.join(
+            chunk if isinstance(chunk, bytes) else chunk.encode(self.charset)
+            for chunk in self.stream(data)
+        )
+
+
+class TxtShoppingCartRenderer(ShoppingCartRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CsvShoppingCartRenderer(ShoppingCartRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def stream(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(('name', 'amount', 'measurement_unit'))
+        for row in rows:
+            yield writer.writerow(
+                (row['name'], row['amount'], row['measurement_unit'])
+            )
+
+
+class JsonShoppingCartRenderer(ShoppingCartRenderer):
+    media_type = 'application/json'
+    format = 'json'
+
+    def stream(self, rows):
+        separator = '['
+        for row in rows:
+            yield separator + json.dumps(row, ensure_ascii=False)
+            separator = ','
+        yield '[]' if separator == '[' else ']'
+
+
+class PdfShoppingCartRenderer(ShoppingCartRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+    chunk_size = 64 * 1024
+    font = PDF_DEFAULT_FONT
+
+    @classmethod
+    def register_font(cls):
+        """Регистрирует шрифт SHOPPING_CART_PDF_FONT один раз при старте.
+
+        Ошибка шрифта внутри stream() оборвала бы уже начатый ответ,
+        поэтому без файла шрифта PDF строится встроенной Helvetica.
+        """
+        path = settings.SHOPPING_CART_PDF_FONT
+        cls.font = PDF_DEFAULT_FONT
+        if not path:
+            return cls.font
+        if not os.path.isfile(path):
+            logger.warning('Шрифт для PDF не найден: %s, используется %s',
+                           path, PDF_DEFAULT_FONT)
+            return cls.font
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        try:
+            pdfmetrics.registerFont(TTFont(PDF_FONT, path))
+        except Exception:
+            logger.warning('Не удалось загрузить шрифт для PDF: %s, '
+                           'используется %s', path, PDF_DEFAULT_FONT,
+                           exc_info=True)
+            return cls.font
+        cls.font = PDF_FONT
+        return cls.font
+
+    def stream(self, rows):
+        from reportlab.lib.pagesizes import A4
+        from reportlab.pdfgen import canvas
+
+        font = self.font
+        with SpooledTemporaryFile(max_size=self.chunk_size) as buffer:
+            width, height = A4
+            pdf = canvas.Canvas(buffer, pagesize=A4)
+            pdf.setFont(font, 12)
+            y = height - PDF_MARGIN
+            for row in rows:
+                if y < PDF_MARGIN:
+                    pdf.showPage()
+                    pdf.setFont(font, 12)
+                    y = height - PDF_MARGIN
+                pdf.drawString(
+                    PDF_MARGIN, y,
+                    f"{row['name']} - {row['amount']} "
+                    f"{row['measurement_unit']}"
+                )
+                y -= PDF_LINE_HEIGHT
+            pdf.save()
+            buffer.seek(0)
+            while True:
+                chunk = buffer.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+SHOPPING_CART_RENDERERS = (
+    TxtShoppingCartRenderer,
+    CsvShoppingCartRenderer,
+    JsonShoppingCartRenderer,
+    PdfShoppingCartRenderer,
+)
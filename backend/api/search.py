@@ -0,0 +1,259 @@
+import heapq
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from sys import intern
+from threading import Lock
+
+SEPARATOR = '\n'
+WORD = re.compile(r'\w+')
+# Веса полей как у ts_rank для меток A, B и C.
+FIELD_WEIGHTS = (1.0, 0.4, 0.2)
+
+
+class IngredientIndex:
+    """Индекс названий ингредиентов для поиска по префиксу и подстроке.
+
+    Названия хранятся отсортированными: совпадения по префиксу находятся
+    бинарным поиском, а по подстроке — через str.find по склеенной строке.
+    """
+
+    def __init__(self, rows):
+        entries = sorted(
+            (name.casefold(), pk) for pk, name in rows
+        )
+        self.keys = [key for key, _ in entries]
+        self.ids = [pk for _, pk in entries]
+        self.offsets = []
+        offset = 0
+        for key in self.keys:
+            self.offsets.append(offset)
+            offset += len(key) + len(SEPARATOR)
+        self.haystack = SEPARATOR.join(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, query, limit):
+        query = query.strip().casefold()
+        if not query or SEPARATOR in query:
+            return []
+
+        found = []
+        position = bisect_left(self.keys, query)
+        while (
+            position < len(self.keys)
+            and len(found) < limit
+            and self.keys[position].startswith(query)
+        ):
+            found.append(position)
+            position += 1
+
+        start = 0
+        while len(found) < limit:
+            hit = self.haystack.find(query, start)
+            if hit == -1:
+                break
+            position = bisect_right(self.offsets, hit) - 1
+            if not self.keys[position].startswith(query):
+                found.append(position)
+            start = self.offsets[position] + len(self.keys[position]) + 1
+
+        return [self.ids[position] for position in found]
+
+
+def tokenize(value):
+    return WORD.findall(value.casefold().replace('ё', 'е'))
+
+
+class RecipeIndex:
+    """Инвертированный индекс рецептов по названию, ингредиентам и тексту.
+
+    Замена tsvector для баз без полнотекстового поиска: каждое слово
+    запроса ищется как префикс, найдены должны быть все слова. Для каждого
+    рецепта хранятся его слова, поэтому изменённые рецепты можно
+    переиндексировать по одному (update).
+    """
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.lock = Lock()
+        postings = defaultdict(dict)
+        self.documents = {}
+        for pk, *fields in rows:
+            weights = self.weigh(fields)
+            for token, score in weights.items():
+                postings[token][pk] = score
+            self.documents[pk] = tuple(weights)
+        self.tokens = sorted(postings)
+        self.postings = [postings[token] for token in self.tokens]
+
+    def __len__(self):
+        return len(self.documents)
+
+    @staticmethod
+    def weigh(fields):
+        weights = defaultdict(float)
+        for weight, value in zip(FIELD_WEIGHTS, fields):
+            for token in tokenize(value):
+                weights[intern(token)] += weight
+        return weights
+
+    def update(self, version, recipe_ids, rows):
+        """Переиндексирует recipe_ids по их текущим строкам rows;
+        рецептов без строк больше нет."""
+        with self.lock:
+            for pk in recipe_ids:
+                for token in self.documents.pop(pk, ()):
+                    position = bisect_left(self.tokens, token)
+                    posting = self.postings[position]
+                    posting.pop(pk, None)
+                    if not posting:
+                        del self.tokens[position]
+                        del self.postings[position]
+            for pk, *fields in rows:
+                weights = self.weigh(fields)
+                for token, score in weights.items():
+                    position = bisect_left(self.tokens, token)
+                    if (
+                        position == len(self.tokens)
+                        or self.tokens[position] != token
+                    ):
+                        self.tokens.insert(position, token)
+                        self.postings.insert(position, {})
+                    self.postings[position][pk] = score
+                self.documents[pk] = tuple(weights)
+            self.version = version
+
+    def match(self, term):
+        scores = defaultdict(float)
+        position = bisect_left(self.tokens, term)
+        while (
+            position < len(self.tokens)
+            and self.tokens[position].startswith(term)
+        ):
+            for pk, score in self.postings[position].items():
+                scores[pk] += score
+            position += 1
+        return scores
+
+    def search(self, query, limit):
+        with self.lock:
+            return self._search(query, limit)
+
+    def _search(self, query, limit):
+        scores = None
+        for term in dict.fromkeys(tokenize(query)):
+            matched = self.match(term)
+            if scores is None:
+                scores = matched
+            else:
+                scores = {
+                    pk: score + matched[pk]
+                    for pk, score in scores.items() if pk in matched
+                }
+            if not scores:
+                return []
+        if scores is None:
+            return []
+        return [
+            pk for pk, _ in sorted(
+                scores.items(), key=lambda item: (-item[1], -item[0])
+            )[:limit]
+        ]
+
+
+class IngredientMatcher:
+    """Составы рецептов для подбора по имеющимся ингредиентам.
+
+    Хранит две плотные таблицы: отсортированные id ингредиентов каждого
+    рецепта и, наоборот, номера рецептов каждого ингредиента. Подсчёт
+    совпадений проходит только по рецептам с имеющимися ингредиентами.
+
+    Изменённый рецепт дописывается в конец таблиц, а его прежняя запись
+    выпадает из postings; когда таких записей больше, чем живых,
+    таблицы пересобираются в памяти.
+    """
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.lock = Lock()
+        self.build(rows)
+
+    def build(self, rows):
+        self.recipe_ids = array('q')
+        self.offsets = array('q', [0])
+        self.ingredients = array('q')
+        self.positions = {}
+        self.postings = {}
+        self.append(rows)
+
+    def append(self, rows):
+        """Дописывает составы из строк (id рецепта, id ингредиента),
+        отсортированных по рецепту и ингредиенту."""
+        for recipe_id, ingredient_id in rows:
+            if recipe_id not in self.positions:
+                self.positions[recipe_id] = len(self.recipe_ids)
+                self.recipe_ids.append(recipe_id)
+                self.offsets.append(self.offsets[-1])
+            self.postings.setdefault(
+                ingredient_id, array('q')
+            ).append(len(self.recipe_ids) - 1)
+            self.ingredients.append(ingredient_id)
+            self.offsets[-1] += 1
+
+    def __len__(self):
+        return len(self.positions)
+
+    def composition(self, position):
+        return self.ingredients[
+            self.offsets[position]:self.offsets[position + 1]
+        ]
+
+    def update(self, version, recipe_ids, rows):
+        """Заменяет составы recipe_ids текущими строками rows."""
+        with self.lock:
+            for recipe_id in recipe_ids:
+                position = self.positions.pop(recipe_id, None)
+                if position is None:
+                    continue
+                for ingredient_id in self.composition(position):
+                    posting = self.postings[ingredient_id]
+                    posting.remove(position)
+                    if not posting:
+                        del self.postings[ingredient_id]
+            self.append(rows)
+            if len(self.recipe_ids) > 2 * len(self.positions):
+                self.build(sorted(
+                    (recipe_id, ingredient_id)
+                    for recipe_id, position in self.positions.items()
+                    for ingredient_id in self.composition(position)
+                ))
+            self.version = version
+
+    def match(self, ingredient_ids, limit):
+        """[(id рецепта, доля имеющихся ингредиентов, id недостающих)]
+        по убыванию доли, затем по числу недостающих."""
+        with self.lock:
+            return self._match(ingredient_ids, limit)
+
+    def _match(self, ingredient_ids, limit):
+        hits = Counter()
+        for ingredient_id in set(ingredient_ids):
+            hits.update(self.postings.get(ingredient_id, ()))
+        ranked = heapq.nsmallest(limit, hits.items(), key=lambda item: (
+            -item[1] / (self.offsets[item[0] + 1] - self.offsets[item[0]]),
+            self.offsets[item[0] + 1] - self.offsets[item[0]] - item[1],
+            -self.recipe_ids[item[0]],
+        ))
+        have = set(ingredient_ids)
+        result = []
+        for position, found in ranked:
+            composition = self.composition(position)
+            result.append((
+                self.recipe_ids[position],
+                found / len(composition),
+                [pk for pk in composition if pk not in have],
+            ))
+        return result
@@ -1,31 +1,52 @@
-import base64
-import uuid
-
 import webcolors
-from django.core.files.base import ContentFile
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import Manager, Prefetch, prefetch_related_objects
+from django.utils.functional import cached_property
 from rest_framework import serializers
 
 
+from recipes import shopping_cart, versions
+from recipes.images import schedule_release
 from recipes.models import (Favorite, Ingredient, Recipe, RecipeIngredient,
                             ShoppingList, Tag)
+from recipes.search import refresh_search
 from users.models import User, Subscription
+from .fragments import fragments
+from .uploads import decode_data_uri
 
 
 class Base64ImageField(serializers.ImageField):
+    def __init__(self, *args, rendition=None, **kwargs):
+        self.rendition = rendition
+        super().__init__(*args, **kwargs)
+
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            id = uuid.uuid4()
-            data = ContentFile(
-                base64.b64decode(imgstr),
-                name=id.urn[9:] + '.' + ext
-            )
+            try:
+                data = decode_data_uri(data, settings.IMAGE_MAX_UPLOAD_SIZE)
+            except ValueError as error:
+                raise serializers.ValidationError(str(error))
 
         return super().to_internal_value(data)
 
+    def to_representation(self, value):
+        if not value:
+            return None
+        rendition = self.context.get('image_rendition', self.rendition)
+        renditions = getattr(value.instance, 'image_renditions', {})
+        if (
+            renditions.get('source') != value.name
+            or rendition not in renditions
+        ):
+            return super().to_representation(value)
+        url = value.storage.url(renditions[rendition])
+        request = self.context.get('request')
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
 
 class Hex2NameColor(serializers.Field):
     def to_representation(self, value):
@@ -55,6 +76,51 @@ class IngredientSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'name', 'measurement_unit')
 
 
+def prefetch_recipe_details(*recipes):
+    """Догружает теги и ингредиенты рецептов фиксированным числом запросов."""
+    recipes = [
+        recipe for recipe in recipes
+        if 'recipeingredients' not in getattr(
+            recipe, '_prefetched_objects_cache', {}
+        )
+    ]
+    if not recipes:
+        return
+    prefetch_related_objects(
+        recipes,
+        'tags',
+        Prefetch(
+            'recipeingredients',
+            queryset=RecipeIngredient.objects.select_related('ingredient')
+        ),
+    )
+
+
+def resolve_ids(model, ids, message):
+    """Загружает объекты по списку id одним запросом, сохраняя порядок."""
+    objects = model.objects.in_bulk(set(ids))
+    missing = sorted(set(ids) - set(objects))
+    if missing:
+        raise serializers.ValidationError(
+            f'{message}: {", ".join(map(str, missing))}'
+        )
+    return [objects[pk] for pk in ids]
+
+
+def validate_tag_ids(value):
+    if len(value) != len(set(value)):
+        raise serializers.ValidationError('Теги не должны повторяться')
+    return resolve_ids(Tag, value, 'Не найдены теги')
+
+
+def validate_recipe_ingredients(value):
+    ids = [item['id'] for item in value]
+    if len(ids) != len(set(ids)):
+        raise serializers.ValidationError('Ингредиенты не должны повторяться')
+    resolve_ids(Ingredient, ids, 'Не найдены ингредиенты')
+    return value
+
+
 class RecipeIngredientSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField()
     name = serializers.ReadOnlyField(source='ingredient.name')
@@ -71,7 +137,7 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
 
 
 class RecipeShortSerializer(serializers.ModelSerializer):
-    image = serializers.ImageField()
+    image = Base64ImageField(rendition='thumb')
 
     class Meta:
         model = Recipe
@@ -126,33 +192,27 @@ class MyUserCreateSerializer(serializers.ModelSerializer):
 
 class MyUserSerializer(serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
-    recipes = RecipeShortSerializer(
-        source='recipes_authored',
-        many=True,
-        read_only=True
+    recipes_count = serializers.IntegerField(read_only=True)
+    subscriptions_count = serializers.IntegerField(
+        source='following_count', read_only=True
     )
-    recipes_count = serializers.SerializerMethodField()
-    subscriptions_count = serializers.SerializerMethodField()
 
     class Meta:
         model = User
         fields = ['email', 'id', 'username', 'first_name',
-                  'last_name', 'is_subscribed', 'recipes',
+                  'last_name', 'is_subscribed',
                   'recipes_count', 'subscriptions_count', 'password']
+        extra_kwargs = {'password': {'write_only': True}}
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         request = self.context.get('request')
         user = request.user if request else None
         if user and user.is_authenticated:
             return Subscription.objects.filter(user=user, author=obj).exists()
         return False
 
-    def get_recipes_count(self, obj):
-        return obj.recipes_authored.count()
-
-    def get_subscriptions_count(self, obj):
-        return Subscription.objects.filter(user=obj).count()
-
     def create(self, validated_data):
         print('начинаю создавать новый пользователь в MyUser')
         user = User(
@@ -168,6 +228,21 @@ class MyUserSerializer(serializers.ModelSerializer):
         return user
 
 
+class MyUserWithRecipesSerializer(MyUserSerializer):
+    recipes = serializers.SerializerMethodField()
+
+    class Meta(MyUserSerializer.Meta):
+        fields = MyUserSerializer.Meta.fields + ['recipes']
+
+    def get_recipes(self, obj):
+        recipes = getattr(obj, 'feed_recipes', None)
+        if recipes is None:
+            recipes = obj.recipes_authored.all()
+        return RecipeShortSerializer(
+            recipes, many=True, context=self.context
+        ).data
+
+
 class AuthorSerializer(serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
 
@@ -177,6 +252,8 @@ class AuthorSerializer(serializers.ModelSerializer):
                   'last_name', 'is_subscribed']
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         request = self.context.get('request')
         user = request.user if request else None
         if user and user.is_authenticated:
@@ -191,7 +268,8 @@ class RecipeListSerializer(serializers.ModelSerializer):
         many=True,
         source='recipeingredients'
     )
-    image = Base64ImageField(max_length=None, use_url=True)
+    image = Base64ImageField(max_length=None, use_url=True,
+                             rendition='card')
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
 
@@ -201,7 +279,61 @@ class RecipeListSerializer(serializers.ModelSerializer):
                   'is_favorited', 'is_in_shopping_cart', 'name',
                   'cooking_time', 'text']
 
+    def fragment_key(self, recipe):
+        request = self.context.get('request')
+        return (
+            recipe.pk,
+            recipe.version.hex,
+            self.context.get('image_rendition', 'card'),
+            request.build_absolute_uri('/') if request else '',
+        )
+
+    def render_many(self, recipes):
+        """Представления рецептов из кэша фрагментов; сериализуются и
+        догружают теги с ингредиентами только отсутствующие в нём.
+
+        Во фрагменте всё, кроме отметок текущего пользователя, которые
+        подставляются при каждой отдаче.
+        """
+        keys = [self.fragment_key(recipe) for recipe in recipes]
+        found = fragments.get_many(keys)
+        missing = [
+            recipe for recipe, key in zip(recipes, keys) if key not in found
+        ]
+        prefetch_recipe_details(*missing)
+        rendered = {}
+        for recipe in missing:
+            if hasattr(recipe, 'is_author_subscribed'):
+                recipe.author.is_subscribed = recipe.is_author_subscribed
+            rendered[self.fragment_key(recipe)] = (
+                super().to_representation(recipe)
+            )
+        fragments.set_many(rendered)
+        return [
+            rendered[key] if key in rendered
+            else self.with_viewer_flags(found[key], recipe)
+            for recipe, key in zip(recipes, keys)
+        ]
+
+    def with_viewer_flags(self, fragment, recipe):
+        data = fragment.copy()
+        data['author'] = fragment['author'].copy()
+        if hasattr(recipe, 'is_author_subscribed'):
+            data['author']['is_subscribed'] = recipe.is_author_subscribed
+        else:
+            data['author']['is_subscribed'] = (
+                self.fields['author'].get_is_subscribed(recipe.author)
+            )
+        data['is_favorited'] = self.get_is_favorited(recipe)
+        data['is_in_shopping_cart'] = self.get_is_in_shopping_cart(recipe)
+        return data
+
+    def to_representation(self, instance):
+        return self.render_many([instance])[0]
+
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         user = request.user if request else None
         if user and user.is_authenticated:
@@ -209,6 +341,8 @@ class RecipeListSerializer(serializers.ModelSerializer):
         return False
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
         user = request.user if request else None
         if user and user.is_authenticated:
@@ -216,10 +350,17 @@ class RecipeListSerializer(serializers.ModelSerializer):
         return False
 
 
+class RecipeSerializerList(serializers.ListSerializer):
+    def to_representation(self, data):
+        if isinstance(data, Manager):
+            data = data.all()
+        return self.child.renderer.render_many(list(data))
+
+
 class RecipeSerializer(serializers.ModelSerializer):
-    tags = serializers.PrimaryKeyRelatedField(
-        many=True,
-        queryset=Tag.objects.all()
+    tags = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False
     )
     author = MyUserSerializer(read_only=True)
     ingredients = RecipeIngredientSerializer(
@@ -246,6 +387,7 @@ class RecipeSerializer(serializers.ModelSerializer):
             'text',
             'cooking_time',
         )
+        list_serializer_class = RecipeSerializerList
 
     def get_is_favorited(self, obj):
         pass
@@ -279,18 +421,22 @@ class RecipeSerializer(serializers.ModelSerializer):
 
         recipe.tags.add(*tags_data)
 
-        ingredients_to_create = []
-        for ingredient_data in ingredients_data:
-            ingredients_to_create.append(RecipeIngredient(
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(
                 recipe=recipe,
-                ingredient=Ingredient.objects.get(id=ingredient_data['id']),
+                ingredient_id=ingredient_data['id'],
                 amount=ingredient_data['amount']
-            ))
+            )
+            for ingredient_data in ingredients_data
+        )
+        refresh_search([recipe.pk])
+        return recipe
 
-        RecipeIngredient.objects.bulk_create(ingredients_to_create)
+    def validate_tags(self, value):
+        return validate_tag_ids(value)
 
-        recipe.save()
-        return recipe
+    def validate_ingredients(self, value):
+        return validate_recipe_ingredients(value)
 
     def validate_name(self, value):
         if not value.isalpha():
@@ -299,9 +445,16 @@ class RecipeSerializer(serializers.ModelSerializer):
                                               "и знаков")
         return value
 
-    def to_representation(self, instance):
+    @cached_property
+    def renderer(self):
         context = {'request': self.context.get('request')}
-        return RecipeListSerializer(instance, context=context).data
+        view = self.context.get('view')
+        if view is not None and getattr(view, 'action', None) == 'retrieve':
+            context['image_rendition'] = 'full'
+        return RecipeListSerializer(context=context)
+
+    def to_representation(self, instance):
+        return self.renderer.to_representation(instance)
 
 
 class AuthorWithoutRecipesSerializer(serializers.ModelSerializer):
@@ -346,57 +499,87 @@ class RecipeUpdateSerializer(serializers.ModelSerializer):
         )
 
     def to_internal_value(self, data):
-        tag_ids = data.get('tags', [])
-        data['tags'] = [Tag.objects.get(id=id) for id in tag_ids]
-        return super().to_internal_value(data)
+        validated_data = super().to_internal_value(data)
+        if 'tags' in data:
+            tags = serializers.ListField(
+                child=serializers.IntegerField(min_value=1)
+            )
+            try:
+                validated_data['tags'] = validate_tag_ids(
+                    tags.run_validation(data['tags'])
+                )
+            except serializers.ValidationError as error:
+                raise serializers.ValidationError({'tags': error.detail})
+        return validated_data
+
+    def validate_ingredients(self, value):
+        return validate_recipe_ingredients(value)
+
+    def to_representation(self, instance):
+        prefetch_recipe_details(instance)
+        return super().to_representation(instance)
 
     def update(self, instance, validated_data):
-        with transaction.atomic():
-            tags_data = (
-                validated_data.pop('tags', None)
-                if 'tags' in validated_data
-                else None
-            )
-            ingredients_data = (
-                validated_data.pop('recipeingredients', None)
-                if 'recipeingredients' in validated_data
-                else None
-            )
+        with transaction.atomic(), versions.batch():
+            old_image = instance.image.name
+            old_renditions = instance.image_renditions
+            tags_data = validated_data.pop('tags', None)
+            ingredients_data = validated_data.pop('recipeingredients', None)
 
             for attr, value in validated_data.items():
                 setattr(instance, attr, value)
 
             instance.save()
+            if instance.image.name != old_image:
+                schedule_release(old_image, old_renditions)
 
             if ingredients_data is not None:
-                for ingredient in instance.recipeingredients.all():
-                    if (
-                            ingredient.ingredient.id not in
-                            [i['id'] for i in ingredients_data]
-                    ):
-                        ingredient.delete()
-
-                for ingredient_data in ingredients_data:
-                    RecipeIngredient.objects.update_or_create(
+                current = {
+                    ingredient.ingredient_id: ingredient
+                    for ingredient in instance.recipeingredients.all()
+                }
+                before = {
+                    ingredient_id: ingredient.amount
+                    for ingredient_id, ingredient in current.items()
+                }
+                amounts = {
+                    ingredient_data['id']: ingredient_data['amount']
+                    for ingredient_data in ingredients_data
+                }
+                stale = current.keys() - amounts.keys()
+                if stale:
+                    RecipeIngredient.objects.filter(
+                        recipe=instance, ingredient__in=stale
+                    ).delete()
+                changed = []
+                for ingredient_id, ingredient in current.items():
+                    amount = amounts.get(ingredient_id, ingredient.amount)
+                    if amount != ingredient.amount:
+                        ingredient.amount = amount
+                        changed.append(ingredient)
+                RecipeIngredient.objects.bulk_update(changed, ['amount'])
+                RecipeIngredient.objects.bulk_create(
+                    RecipeIngredient(
                         recipe=instance,
-                        ingredient=Ingredient.objects.get(
-                            id=ingredient_data['id']
-                        ),
-                        defaults={'amount': ingredient_data['amount']}
+                        ingredient_id=ingredient_id,
+                        amount=amount
                     )
+                    for ingredient_id, amount in amounts.items()
+                    if ingredient_id not in current
+                )
+                shopping_cart.recipe_changed(instance, before, amounts)
 
             if tags_data is not None:
-                instance.tags.clear()
-                for tag in tags_data:
-                    instance.tags.add(tag)
-        print('завершаю обновление')
+                instance.tags.set(tags_data)
+            refresh_search([instance.pk])
         return instance
 
     def get_tags(self, obj):
-        tags = Tag.objects.filter(recipe=obj)
-        return TagSerializer(tags, many=True).data
+        return TagSerializer(obj.tags.all(), many=True).data
 
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         user = request.user if request else None
         if user and user.is_authenticated:
@@ -404,6 +587,8 @@ class RecipeUpdateSerializer(serializers.ModelSerializer):
         return False
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
         user = request.user if request else None
         if user and user.is_authenticated:
@@ -411,14 +596,49 @@ class RecipeUpdateSerializer(serializers.ModelSerializer):
         return False
 
 
+class RecipeIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_RECIPES_LIMIT
+    )
+
+
+class IngredientMatchSerializer(serializers.Serializer):
+    ingredients = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.RECIPE_MATCH_INGREDIENTS_LIMIT
+    )
+    limit = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.RECIPE_MATCH_MAX_LIMIT,
+        default=settings.RECIPE_MATCH_LIMIT
+    )
+
+
+class RecipeMatchSerializer(RecipeShortSerializer):
+    coverage = serializers.SerializerMethodField()
+    missing = serializers.SerializerMethodField()
+
+    class Meta(RecipeShortSerializer.Meta):
+        fields = RecipeShortSerializer.Meta.fields + ['coverage', 'missing']
+
+    def get_coverage(self, obj):
+        return round(self.context['matches'][obj.pk][0], 4)
+
+    def get_missing(self, obj):
+        catalogue = self.context['catalogue']
+        return [
+            catalogue.get(pk) for pk in self.context['matches'][obj.pk][1]
+            if catalogue.get(pk) is not None
+        ]
+
+
 class SubscriptionUserSerializer(serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
-    recipes = RecipeShortSerializer(
-        source='recipes_authored',
-        many=True,
-        read_only=True
-    )
-    recipes_count = serializers.SerializerMethodField()
+    recipes = serializers.SerializerMethodField()
+    recipes_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = User
@@ -426,24 +646,18 @@ class SubscriptionUserSerializer(serializers.ModelSerializer):
                   'is_subscribed', 'recipes', 'recipes_count']
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         request = self.context.get('request')
         user = request.user if request else None
         if user and user.is_authenticated:
             return Subscription.objects.filter(user=user, author=obj).exists()
         return False
 
-    def get_recipes_count(self, obj):
-        return obj.recipes_authored.count()
-
-
-class SubscriptionSerializer(serializers.ModelSerializer):
-    author = SubscriptionUserSerializer(read_only=True)
-
-    class Meta:
-        model = Subscription
-        fields = ['author']
-
-    def to_representation(self, instance):
-        representation = super().to_representation(instance)
-        author_representation = representation.pop('author')
-        return {**representation, **author_representation}
+    def get_recipes(self, obj):
+        recipes = getattr(obj, 'feed_recipes', None)
+        if recipes is None:
+            recipes = obj.recipes_authored.all()
+        return RecipeShortSerializer(
+            recipes, many=True, context=self.context
+        ).data
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+from django.conf import settings
+from django.db import connection
+
+from api import benchmark
+
+BUDGETS = os.path.join(settings.BASE_DIR, 'api', 'benchmark_budgets.json')
+
+
+def test_every_route_has_scenario():
+    assert benchmark.uncovered_routes() == set()
+
+
+def test_every_scenario_has_budget():
+    budgets = benchmark.load_budgets(BUDGETS)
+    assert {scenario.name for scenario in benchmark.SCENARIOS} == set(budgets)
+
+
+def test_endpoints_within_budgets(db, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    viewer = benchmark.seed()
+    results = benchmark.run(viewer)
+    violations = benchmark.check_budgets(
+        results, benchmark.load_budgets(BUDGETS)
+    )
+    assert violations == []
+
+
+@pytest.mark.skipif(connection.vendor != 'sqlite',
+                    reason='формат плана зависит от СУБД')
+def test_query_plans_use_indexes(db, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    plans = benchmark.query_plans(benchmark.seed())
+    for name in ('favorite-lookup', 'shopping-list-lookup',
+                 'subscription-lookup', 'recipe-tag-lookup'):
+        assert 'INDEX' in plans[name]
+    assert 'recipe_pub_date_idx' in plans['recipe-feed']
+    assert 'recipe_author_pub_date_idx' in plans['author-feed']
+    assert 'recipe_popularity_idx' in plans['popularity-feed']
+
+
+def test_time_search(db, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    timings = benchmark.time_search(benchmark.seed(), repeat=1)
+    assert set(timings) == set(benchmark.SEARCH_QUERIES)
+    assert all(time_ms > 0 for time_ms in timings.values())
+
+
+def test_check_budgets_reports_regressions():
+    results = {'recipe-list': {'status': 200, 'queries': 12}}
+    budgets = {
+        'recipe-list': {'status': 200, 'queries': 5},
+        'tag-list': {'queries': 1},
+    }
+    assert benchmark.check_budgets(results, budgets) == [
+        'recipe-list: queries 12 > 5',
+        'tag-list: no measurement',
+    ]
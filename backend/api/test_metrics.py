@@ -0,0 +1,164 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from prometheus_client import REGISTRY
+from rest_framework import serializers
+from rest_framework.test import APIClient
+
+from api.middleware import RequestProfilingMiddleware, fingerprint, profiled
+from recipes.models import Recipe
+
+
+def test_request_profiling(db, test_user, test_recipe, api_client, settings,
+                           caplog):
+    response = api_client.get('/api/recipes/')
+    assert 'Server-Timing' not in response
+
+    settings.REQUEST_PROFILING_SAMPLE_RATE = 1
+    client = APIClient()
+    with caplog.at_level('INFO', logger='api.middleware'):
+        response = client.get('/api/recipes/')
+    assert response.status_code == 200
+    timing = response['Server-Timing']
+    assert timing.startswith('total;dur=')
+    assert 'db;dur=' in timing and 'serializer;dur=' in timing
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record['view'] == 'api:recipe-list'
+    assert record['queries'] >= 1
+    assert record['duplicates'] == []
+
+    def view(request):
+        for recipe_id in (1, 2, 3):
+            list(Recipe.objects.filter(pk__in=[recipe_id, recipe_id + 1]))
+        return HttpResponse()
+
+    response = RequestProfilingMiddleware(view)(RequestFactory().get('/'))
+    assert 'dup;desc="1 repeated"' in response['Server-Timing']
+    assert fingerprint('WHERE id IN (%s, %s, %s)') == 'WHERE id IN (...)'
+
+    class SlowSerializer(serializers.Serializer):
+        value = serializers.SerializerMethodField()
+
+        def get_value(self, obj):
+            time.sleep(0.02)
+            return obj
+
+    def serialize(request):
+        serializer = SlowSerializer(1)
+        assert profiled(serializer) is serializer
+        assert isinstance(serializer, SlowSerializer)
+        return HttpResponse(json.dumps(serializer.data))
+
+    response = RequestProfilingMiddleware(serialize)(
+        RequestFactory().get('/')
+    )
+    assert json.loads(response.content) == {'value': 1}
+    serializer_ms = float(re.search(
+        r'serializer;dur=([\d.]+)', response['Server-Timing']
+    ).group(1))
+    assert serializer_ms >= 20
+    assert type(SlowSerializer(1)) is SlowSerializer
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics_endpoint(db, test_user, test_recipe, api_client, settings):
+    requests_before = sample(
+        'foodgram_requests_total',
+        route='api:recipe-list', method='GET', status='200'
+    )
+    exports_before = sample(
+        'foodgram_cart_export_bytes_count', format='txt'
+    )
+    bytes_before = sample('foodgram_cart_export_bytes_sum', format='txt')
+    api_client.force_authenticate(user=test_user)
+    api_client.post(f'/api/recipes/{test_recipe.id}/shopping_cart/')
+    api_client.get('/api/recipes/')
+    response = api_client.get('/api/recipes/download_shopping_cart/')
+    size = len(b''.join(response.streaming_content))
+    api_client.get('/api/ingredients/')
+    api_client.get('/api/ingredients/')
+
+    assert sample(
+        'foodgram_requests_total',
+        route='api:recipe-list', method='GET', status='200'
+    ) == requests_before + 1
+    assert sample(
+        'foodgram_cart_export_bytes_count', format='txt'
+    ) == exports_before + 1
+    assert sample(
+        'foodgram_cart_export_bytes_sum', format='txt'
+    ) == bytes_before + size
+    assert sample(
+        'foodgram_cache_requests_total', cache='ingredients', result='hit'
+    ) >= 1
+
+    assert APIClient().get('/api/metrics').status_code == 401
+    test_user.is_staff = True
+    test_user.save()
+    response = api_client.get('/api/metrics')
+    assert response.status_code == 200
+    assert response['Content-Type'].startswith('text/plain')
+    text = response.content.decode()
+    for name in (
+        'foodgram_request_duration_seconds',
+        'foodgram_request_queries',
+        'foodgram_image_upload_bytes',
+        'foodgram_cart_export_duration_seconds',
+    ):
+        assert f'# TYPE {name} histogram' in text
+    assert (
+        'foodgram_request_queries_count{method="GET",'
+        'route="api:ingredient-list"}' in text
+    )
+    assert (
+        'foodgram_requests_total{method="POST",'
+        'route="api:recipe-shopping-cart",status="201"}' in text
+    )
+    assert (
+        'foodgram_cache_requests_total{cache="ingredients",result="miss"}'
+        in text
+    )
+    test_user.is_staff = False
+    assert api_client.get('/api/metrics').status_code == 403
+    settings.METRICS_TOKEN = 'secret'
+    response = APIClient().get(
+        '/api/metrics', HTTP_AUTHORIZATION='Bearer secret'
+    )
+    assert response.status_code == 200
+    response = APIClient().get(
+        '/api/metrics', HTTP_AUTHORIZATION='Bearer wrong'
+    )
+    assert response.status_code == 401
+
+
+def test_metrics_multiprocess(tmp_path):
+    env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(tmp_path)}
+    worker = (
+        'from api import metrics; '
+        'metrics.cache_hit("tags", True); '
+        'metrics.REQUEST_LATENCY.labels("api:tag-list", "GET").observe(0.1)'
+    )
+    for _ in range(2):
+        subprocess.run([sys.executable, '-c', worker], env=env, check=True)
+    output = subprocess.run(
+        [sys.executable, '-c',
+         'from api import metrics; print(metrics.collect()[0].decode())'],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    assert (
+        'foodgram_cache_requests_total{cache="tags",result="hit"} 2.0'
+        in output
+    )
+    assert (
+        'foodgram_request_duration_seconds_count'
+        '{method="GET",route="api:tag-list"} 2.0' in output
+    )
@@ -0,0 +1,73 @@
+import binascii
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import (InMemoryUploadedFile,
+                                            TemporaryUploadedFile)
+
+from .metrics import IMAGE_UPLOAD_BYTES
+
+CHUNK_SIZE = 64 * 1024
+HEADER_LIMIT = 100
+MARKER = ';base64,'
+WHITESPACE = ' \t\r\n'
+
+
+def too_large(max_size):
+    return ValueError(
+        f'Размер изображения не должен превышать {max_size} байт'
+    )
+
+
+def decode_data_uri(data, max_size, chunk_size=CHUNK_SIZE):
+    """Декодирует data URI с base64 по частям.
+
+    Тело строки не копируется целиком: декодируются срезы по chunk_size
+    символов. Результат пишется в память или, если он больше
+    FILE_UPLOAD_MAX_MEMORY_SIZE, во временный файл на диске.
+    """
+    start = data.find(MARKER, 0, HEADER_LIMIT)
+    if not data.startswith('data:') or start == -1:
+        raise ValueError('Ожидалось изображение в формате data URI')
+    content_type = data[len('data:'):start]
+    start += len(MARKER)
+    length = len(data) - start - sum(
+        data.count(space, start) for space in WHITESPACE
+    )
+    padding = 2 if data.endswith('==') else int(data.endswith('='))
+    size_hint = length * 3 // 4 - padding
+    if size_hint > max_size:
+        raise too_large(max_size)
+    name = 'image.' + content_type.split('/')[-1]
+    if size_hint > settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+        upload = TemporaryUploadedFile(name, content_type, size_hint, None)
+    else:
+        upload = InMemoryUploadedFile(
+            BytesIO(), None, name, content_type, size_hint, None
+        )
+
+    chunk_size -= chunk_size % 4
+    size = 0
+    tail = ''
+    try:
+        for position in range(start, len(data), chunk_size):
+            chunk = tail + ''.join(
+                data[position:position + chunk_size].split()
+            )
+            usable = len(chunk) - len(chunk) % 4
+            tail = chunk[usable:]
+            decoded = binascii.a2b_base64(chunk[:usable])
+            size += len(decoded)
+            if size > max_size:
+                raise too_large(max_size)
+            upload.write(decoded)
+        if tail:
+            raise ValueError('Некорректные данные base64')
+    except (binascii.Error, ValueError) as error:
+        upload.close()
+        raise ValueError(str(error)) from error
+
+    IMAGE_UPLOAD_BYTES.observe(size)
+    upload.size = size
+    upload.seek(0)
+    return upload
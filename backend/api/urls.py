@@ -3,8 +3,8 @@ from django.conf.urls.static import static
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from .views import (IngredientViewSet, RecipeViewSet, ShoppingListManipulation,
-                    TagViewSet)
+from .views import (IngredientViewSet, MetricsView, RecipeViewSet,
+                    ShoppingListManipulation, TagViewSet)
 from .views import UserViewSet as CustomUserViewSet
 
 app_name = 'api'
@@ -26,7 +26,9 @@ urlpatterns = [
     # path('auth/', include('djoser.urls.authtoken')),
     path('', include(router.urls)),
     path('recipes/<int:id>/shopping_cart/',
-         ShoppingListManipulation.as_view()),
+         ShoppingListManipulation.as_view(),
+         name='recipe-shopping-cart'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     *djoser_urls,
 ]
 
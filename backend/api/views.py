@@ -1,27 +1,89 @@
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import (BooleanField, Exists, OuterRef, Prefetch,
+                              Subquery, Value)
+from django.http import HttpResponse, Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions, status, views, viewsets
 from rest_framework.decorators import action
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
-from recipes.models import (Favorite, Ingredient, Recipe, RecipeIngredient,
-                            ShoppingList, Tag)
+from recipes import counters, popularity, shopping_cart, versions
+from recipes.models import (Favorite, Ingredient, Recipe,
+                            ShoppingCartIngredient, ShoppingList, Tag)
+from recipes.versions import INGREDIENTS, TAGS
 from users.models import User, Subscription
+from .catalogue import get_ingredient_catalogue, get_recipe_matcher
 from .filters import IngredientFilter, RecipeFilter
-from .paginations import CustomPagination
-from .permissions import IsOwnerOrReadOnly
-from .serializers import (IngredientSerializer, RecipeSerializer,
-                          RecipeShortSerializer, SubscriptionSerializer,
+from .metrics import collect, observe_export
+from .middleware import profiled
+from .mixins import ConditionalGetMixin, ProfiledSerializerMixin
+from .paginations import CustomPagination, RecipePagination
+from .permissions import HasMetricsToken, IsOwnerOrReadOnly
+from .renderers import SHOPPING_CART_RENDERERS
+from .serializers import (IngredientMatchSerializer, IngredientSerializer,
+                          RecipeIdsSerializer, RecipeMatchSerializer,
+                          RecipeSerializer, RecipeShortSerializer,
+                          SubscriptionUserSerializer,
                           TagSerializer, MyUserSerializer,
+                          MyUserWithRecipesSerializer,
                           RecipeUpdateSerializer)
 
 
-class UserViewSet(viewsets.ModelViewSet):
+def get_recipes_limit(request):
+    try:
+        recipes_limit = int(request.query_params['recipes_limit'])
+    except (KeyError, ValueError):
+        return settings.SUBSCRIPTION_RECIPES_LIMIT
+    return max(recipes_limit, 0)
+
+
+def latest_recipes(recipes_limit):
+    latest = Recipe.objects.filter(
+        author=OuterRef('author')
+    ).order_by('-pub_date', '-id').values('id')[:recipes_limit]
+    return Prefetch(
+        'recipes_authored',
+        queryset=Recipe.objects.filter(
+            id__in=Subquery(latest)
+        ).order_by('-pub_date', '-id'),
+        to_attr='feed_recipes'
+    )
+
+
+class UserViewSet(ProfiledSerializerMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = MyUserSerializer
+    pagination_class = CustomPagination
+
+    def expand_recipes(self):
+        return 'recipes' in self.request.query_params.get(
+            'expand', ''
+        ).split(',')
+
+    def get_queryset(self):
+        user = self.request.user
+        queryset = User.objects.order_by('id')
+        if user.is_authenticated:
+            queryset = queryset.annotate(is_subscribed=Exists(
+                Subscription.objects.filter(user=user, author=OuterRef('pk'))
+            ))
+        else:
+            queryset = queryset.annotate(
+                is_subscribed=Value(False, output_field=BooleanField())
+            )
+        if self.expand_recipes():
+            queryset = queryset.prefetch_related(
+                latest_recipes(get_recipes_limit(self.request))
+            )
+        return queryset
+
+    def get_serializer_class(self):
+        if self.request.method == 'GET' and self.expand_recipes():
+            return MyUserWithRecipesSerializer
+        return MyUserSerializer
 
     @action(detail=True, methods=['post', 'delete'],
             permission_classes=(IsAuthenticated,))
@@ -35,10 +97,12 @@ class UserViewSet(viewsets.ModelViewSet):
                     author=user
                 )
                 if created:
-                    serializer = MyUserSerializer(
+                    # Аннотация get_object() посчитана до подписки.
+                    user.is_subscribed = True
+                    serializer = profiled(MyUserSerializer(
                         user,
                         context={'request': request}
-                    )
+                    ))
                     return Response(
                         serializer.data,
                         status=status.HTTP_201_CREATED
@@ -67,11 +131,18 @@ class UserViewSet(viewsets.ModelViewSet):
         permission_classes=(IsAuthenticated,)
     )
     def subscriptions(self, request):
-        subscriptions = Subscription.objects.filter(user=request.user)
-        paginator = PageNumberPagination()
-        paginator.page_size = 10
-        result_page = paginator.paginate_queryset(subscriptions, request)
-        serializer = SubscriptionSerializer(result_page, many=True)
+        authors = User.objects.filter(
+            followed__user=request.user
+        ).annotate(
+            is_subscribed=Value(True, output_field=BooleanField()),
+        ).order_by('-followed__id').prefetch_related(
+            latest_recipes(get_recipes_limit(request))
+        )
+        paginator = CustomPagination()
+        result_page = paginator.paginate_queryset(authors, request)
+        serializer = profiled(SubscriptionUserSerializer(
+            result_page, many=True, context={'request': request}
+        ))
         return paginator.get_paginated_response(serializer.data)
 
     @action(
@@ -80,9 +151,9 @@ class UserViewSet(viewsets.ModelViewSet):
         permission_classes=(IsAuthenticated,)
     )
     def me(self, request):
-        serializer = MyUserSerializer(
-            request.user,
-            context={'request': request})
+        serializer = self.get_serializer(
+            self.get_queryset().get(pk=request.user.pk)
+        )
         return Response(serializer.data)
 
     @action(
@@ -99,7 +170,7 @@ class UserViewSet(viewsets.ModelViewSet):
 
         password = request.data['new_password']
         user.set_password(password)
-        user.save()
+        user.save(update_fields=['password'])
         print('Кончаем')
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -108,16 +179,27 @@ class ShoppingListManipulation(views.APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, id):
-        recipe = Recipe.objects.get(id=id)
-        ShoppingList.objects.get_or_create(user=request.user, recipe=recipe)
-        serializer = RecipeSerializer(recipe)
+        recipe = get_object_or_404(Recipe, id=id)
+        with transaction.atomic():
+            _, created = ShoppingList.objects.get_or_create(
+                user=request.user, recipe=recipe
+            )
+            if created:
+                shopping_cart.cart_changed([(request.user.pk, recipe.pk)], 1)
+        serializer = profiled(RecipeSerializer(recipe))
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def delete(self, request, id):
-        recipe = Recipe.objects.get(id=id)
-        item = ShoppingList.objects.filter(user=request.user, recipe=recipe)
-        if item.exists():
-            item.delete()
+        recipe = get_object_or_404(Recipe, id=id)
+        with transaction.atomic():
+            deleted, _ = ShoppingList.objects.filter(
+                user=request.user, recipe=recipe
+            ).delete()
+            if deleted:
+                shopping_cart.cart_changed(
+                    [(request.user.pk, recipe.pk)], -1
+                )
+        if deleted:
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response(
             {"detail": "Recipe not in shopping list."},
@@ -125,25 +207,49 @@ class ShoppingListManipulation(views.APIView):
         )
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ProfiledSerializerMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
-    pagination_class = CustomPagination
+    pagination_class = RecipePagination
     permission_classes = (IsOwnerOrReadOnly,)
 
+    def get_queryset(self):
+        # Теги и ингредиенты догружает RecipeSerializer, и только для
+        # рецептов, которых нет в кэше фрагментов.
+        queryset = Recipe.objects.select_related('author')
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset
+        return queryset.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(ShoppingList.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_author_subscribed=Exists(Subscription.objects.filter(
+                user=user, author=OuterRef('author'))),
+        )
+
     def get_permissions(self):
         if self.request.method == 'POST':
             self.permission_classes = (IsAuthenticated,)
         return super(RecipeViewSet, self).get_permissions()
 
+    def perform_destroy(self, instance):
+        with transaction.atomic(), counters.batch(), popularity.batch(), \
+                versions.batch():
+            shopping_cart.cart_changed(
+                instance.in_shopping_cart.values_list('user', 'recipe'), -1
+            )
+            instance.delete()
+
     def create(self, request, *args, **kwargs):
         data = request.data
-        serializer = RecipeSerializer(
+        serializer = profiled(RecipeSerializer(
             data=data,
             context={'request': request}
-        )
+        ))
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -152,49 +258,159 @@ class RecipeViewSet(viewsets.ModelViewSet):
     def update(self, request, *args, **kwargs):
         recipe = self.get_object()
         data = request.data
-        serializer = RecipeUpdateSerializer(   # заменили на новый сериализатор
+        # заменили на новый сериализатор
+        serializer = profiled(RecipeUpdateSerializer(
             recipe,
             data=data,
             # partial=True,
             context={'request': request}
-        )
+        ))
         if serializer.is_valid():
             serializer.save()
+            recipe._prefetched_objects_cache = {}
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['GET'], pagination_class=None)
+    def match(self, request):
+        """Рецепты по доле уже имеющихся ингредиентов:
+        ?ingredients=1,2,3&limit=20."""
+        data = {'ingredients': [
+            value
+            for param in request.query_params.getlist('ingredients')
+            for value in param.split(',') if value
+        ]}
+        if 'limit' in request.query_params:
+            data['limit'] = request.query_params['limit']
+        serializer = IngredientMatchSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        matches = {
+            pk: (coverage, missing)
+            for pk, coverage, missing in get_recipe_matcher().match(
+                serializer.validated_data['ingredients'],
+                serializer.validated_data['limit']
+            )
+        }
+        recipes = Recipe.objects.in_bulk(list(matches))
+        return Response(profiled(RecipeMatchSerializer(
+            [recipes[pk] for pk in matches if pk in recipes],
+            many=True,
+            context={
+                'request': request,
+                'matches': matches,
+                'catalogue': get_ingredient_catalogue(),
+            }
+        )).data)
+
+    @action(detail=False, methods=['GET'],
+            pagination_class=CustomPagination)
+    def trending(self, request):
+        queryset = self.filter_queryset(
+            self.get_queryset().filter(popularity__isnull=False)
+        ).order_by('-popularity__score', '-pub_date', '-id')
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
     @action(detail=False, methods=["GET"],
             permission_classes=(IsAuthenticated,),
-            pagination_class=None)
+            pagination_class=None,
+            renderer_classes=SHOPPING_CART_RENDERERS)
     def download_shopping_cart(self, request):
-        shopping_cart_recipes = ShoppingList.objects.filter(
-            user=request.user).values_list('recipe', flat=True
-                                           )
-        ingredients = RecipeIngredient.objects.filter(
-            recipe__in=shopping_cart_recipes
-        ).values(
-            'ingredient__name', 'ingredient__measurement_unit'
+        ingredients = ShoppingCartIngredient.objects.filter(
+            user=request.user
+        ).values_list(
+            'ingredient__name', 'total_amount',
+            'ingredient__measurement_unit'
         ).order_by(
-            'ingredient__name'
-        ).annotate(ingredient_total=Sum('amount'))
+            'ingredient__name', 'ingredient__measurement_unit'
+        )
+        renderer = request.accepted_renderer
+        response = StreamingHttpResponse(
+            observe_export(renderer.format, renderer.stream(
+                {
+                    'name': name,
+                    'amount': amount,
+                    'measurement_unit': measurement_unit,
+                }
+                for name, amount, measurement_unit in ingredients.iterator()
+            ), renderer.charset),
+            content_type=(
+                f'{renderer.media_type}; charset={renderer.charset}'
+                if renderer.charset else renderer.media_type
+            )
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="ingredients.{renderer.format}"'
+        )
+        return response
 
-        return self.convert_txt(ingredients)
+    def bulk_link(self, request, model):
+        """Добавляет или удаляет связи пользователя с пачкой рецептов.
 
-    @staticmethod
-    def convert_txt(ingredients):
-        response = HttpResponse(content_type='text/plain')
-        response['Content-Disposition'] = (
-            'attachment; filename="ingredients.txt"'
+        Возвращает статус по каждому id: added/exists при добавлении,
+        removed/absent при удалении и not_found для несуществующих.
+        """
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+        found = set(
+            Recipe.objects.filter(id__in=ids).values_list('id', flat=True)
         )
+        links = model.objects.filter(user=request.user, recipe__in=found)
+        linked = set(links.values_list('recipe', flat=True))
 
-        for ingredient in ingredients:
-            line = (
-                f"{ingredient['ingredient__name']} - "
-                f"{ingredient['ingredient_total']} "
-                f"{ingredient['ingredient__measurement_unit']}\n"
+        if request.method == 'POST':
+            changed = [pk for pk in ids if pk in found and pk not in linked]
+            try:
+                with transaction.atomic():
+                    # bulk_create не шлёт post_save, счётчики сдвигаются
+                    # здесь же, в той же транзакции.
+                    counters.links_changed(model, model.objects.bulk_create(
+                        [model(user=request.user, recipe_id=pk)
+                         for pk in changed]
+                    ), 1)
+            except IntegrityError:
+                # Часть связей успели добавить параллельно: добавляем по
+                # одной, счётчики сдвигает сигнал post_save.
+                created = {
+                    pk for pk in changed
+                    if model.objects.get_or_create(
+                        user=request.user, recipe_id=pk
+                    )[1]
+                }
+                linked.update(set(changed) - created)
+                changed = [pk for pk in changed if pk in created]
+            statuses = {pk: 'exists' for pk in linked}
+            done = 'added'
+        else:
+            changed = [pk for pk in ids if pk in linked]
+            with transaction.atomic(), counters.batch(), popularity.batch():
+                links.delete()
+            statuses = {pk: 'absent' for pk in found - linked}
+            done = 'removed'
+        statuses.update((pk, done) for pk in changed)
+        return changed, Response({
+            str(pk): statuses.get(pk, 'not_found') for pk in ids
+        })
+
+    @action(detail=False, methods=['post', 'delete'],
+            url_path='shopping_cart',
+            permission_classes=(IsAuthenticated,))
+    def bulk_shopping_cart(self, request):
+        with transaction.atomic():
+            changed, response = self.bulk_link(request, ShoppingList)
+            shopping_cart.cart_changed(
+                [(request.user.pk, pk) for pk in changed],
+                1 if request.method == 'POST' else -1
             )
-            response.write(line)
+        return response
 
+    @action(detail=False, methods=['post', 'delete'],
+            url_path='favorite',
+            permission_classes=(IsAuthenticated,))
+    def bulk_favorite(self, request):
+        _, response = self.bulk_link(request, Favorite)
         return response
 
     @action(
@@ -210,15 +426,16 @@ class RecipeViewSet(viewsets.ModelViewSet):
             if favorite.exists():
                 return Response(status=status.HTTP_400_BAD_REQUEST)
             else:
-                Favorite.objects.create(user=user, recipe=recipe)
-                serializer = RecipeShortSerializer(recipe)
+                with transaction.atomic():
+                    Favorite.objects.create(user=user, recipe=recipe)
+                serializer = profiled(RecipeShortSerializer(recipe))
                 return Response(
                     serializer.data,
                     status=status.HTTP_201_CREATED
                 )
         elif request.method == 'DELETE':
-            if favorite.exists():
-                favorite.delete()
+            deleted, _ = favorite.delete()
+            if deleted:
                 return Response(status=status.HTTP_204_NO_CONTENT)
             else:
                 return Response(
@@ -227,19 +444,54 @@ class RecipeViewSet(viewsets.ModelViewSet):
                 )
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class TagViewSet(ConditionalGetMixin, ProfiledSerializerMixin,
+                 viewsets.ReadOnlyModelViewSet):
     """Вьюсет для  тегов: ReadOnly."""
+    version_name = TAGS
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (permissions.AllowAny, )
     pagination_class = None
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(ConditionalGetMixin, ProfiledSerializerMixin,
+                        viewsets.ReadOnlyModelViewSet):
     """Вьюсет для  рецептов: ReadOnly."""
+    version_name = INGREDIENTS
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (permissions.AllowAny, )
     filter_backends = (DjangoFilterBackend,)
     filterset_class = IngredientFilter
     pagination_class = None
+
+    def list(self, request, *args, **kwargs):
+        if not settings.INGREDIENT_CATALOGUE:
+            return super().list(request, *args, **kwargs)
+        catalogue = get_ingredient_catalogue()
+        name = request.query_params.get('name')
+        if name:
+            return Response(
+                catalogue.search(name, settings.INGREDIENT_SEARCH_LIMIT)
+            )
+        return Response(catalogue.items)
+
+    def retrieve(self, request, *args, **kwargs):
+        if not settings.INGREDIENT_CATALOGUE:
+            return super().retrieve(request, *args, **kwargs)
+        try:
+            item = get_ingredient_catalogue().get(int(kwargs['pk']))
+        except ValueError:
+            item = None
+        if item is None:
+            raise Http404
+        return Response(item)
+
+
+class MetricsView(views.APIView):
+    """Метрики для Prometheus: по METRICS_TOKEN или администратору."""
+    permission_classes = (HasMetricsToken | permissions.IsAdminUser,)
+
+    def get(self, request):
+        body, content_type = collect()
+        return HttpResponse(body, content_type=content_type)
@@ -0,0 +1,50 @@
+import pytest
+from django.core.cache import cache
+from rest_framework.test import APIClient
+
+from api.catalogue import recipe_index, recipe_matcher
+from recipes.models import Recipe
+from users.models import User
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    recipe_index.clear()
+    recipe_matcher.clear()
+
+
+@pytest.fixture
+def api_client():
+    return APIClient()
+
+
+@pytest.fixture
+def test_password():
+    return 'strong-test-pass'
+
+
+@pytest.fixture
+def create_user(db, test_password):
+    def make_user(**kwargs):
+        kwargs['password'] = test_password
+        if 'username' not in kwargs:
+            kwargs['username'] = str(kwargs['email'])
+        return User.objects.create_user(**kwargs)
+    return make_user
+
+
+@pytest.fixture
+def test_user(create_user):
+    user = create_user(email='user@test.com', password='test_password')
+    return user
+
+
+@pytest.fixture
+def test_recipe(db, test_user):
+    return Recipe.objects.create(
+        name='Test recipe',
+        text='Test text',
+        cooking_time=30,
+        author=test_user
+    )
@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 import os
+import tempfile
 
 load_dotenv()
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -27,6 +28,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.MetricsMiddleware',
+    'api.middleware.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,6 +81,20 @@ else:
     }
 
 
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'
+        ),
+        'LOCATION': os.getenv(
+            'CACHE_LOCATION',
+            os.path.join(tempfile.gettempdir(), 'foodgram_cache')
+        ),
+    }
+}
+
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -112,6 +129,8 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+DEFAULT_FILE_STORAGE = 'recipes.storage.ContentHashStorage'
+
 
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
@@ -119,6 +138,12 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.BrowsableAPIRenderer',
     ],
 
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.LimitedJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
@@ -147,6 +172,130 @@ DJOSER = {
 
 AUTH_USER_MODEL = 'users.User'
 
+INGREDIENT_SEARCH_LIMIT = int(os.getenv('INGREDIENT_SEARCH_LIMIT', 30))
+
+INGREDIENT_CATALOGUE = os.getenv('INGREDIENT_CATALOGUE', 'True') == 'True'
+
+# Конфигурация полнотекстового поиска PostgreSQL для рецептов.
+RECIPE_SEARCH_CONFIG = os.getenv('RECIPE_SEARCH_CONFIG', 'russian')
+
+# Сколько лучших совпадений отдаёт поиск рецептов без tsvector.
+RECIPE_SEARCH_LIMIT = int(os.getenv('RECIPE_SEARCH_LIMIT', 1000))
+
+# Сколько хранится журнал изменённых рецептов, в секундах. Процесс,
+# не обновлявший индексы рецептов дольше, собирает их заново.
+RECIPE_CHANGES_RETENTION = int(
+    os.getenv('RECIPE_CHANGES_RETENTION', 24 * 60 * 60)
+)
+
+RECIPE_MATCH_LIMIT = int(os.getenv('RECIPE_MATCH_LIMIT', 20))
+
+RECIPE_MATCH_MAX_LIMIT = int(os.getenv('RECIPE_MATCH_MAX_LIMIT', 100))
+
+RECIPE_MATCH_INGREDIENTS_LIMIT = int(
+    os.getenv('RECIPE_MATCH_INGREDIENTS_LIMIT', 200)
+)
+
+API_CACHE_MAX_AGE = int(os.getenv('API_CACHE_MAX_AGE', 60))
+
+# Сколько готовых представлений рецептов держит в памяти каждый процесс;
+# 0 отключает кэш в процессе.
+RECIPE_FRAGMENT_CACHE_SIZE = int(
+    os.getenv('RECIPE_FRAGMENT_CACHE_SIZE', 5000)
+)
+
+# Хранить представления рецептов ещё и в общем кэше Django.
+RECIPE_FRAGMENT_SHARED_CACHE = (
+    os.getenv('RECIPE_FRAGMENT_SHARED_CACHE', 'False') == 'True'
+)
+
+RECIPE_FRAGMENT_CACHE_TTL = int(
+    os.getenv('RECIPE_FRAGMENT_CACHE_TTL', 60 * 60)
+)
+
+PAGINATION_COUNT_STRATEGY = os.getenv('PAGINATION_COUNT_STRATEGY', 'exact')
+
+RECIPE_COUNT_STRATEGY = os.getenv('RECIPE_COUNT_STRATEGY', 'cached')
+
+PAGINATION_COUNT_CACHE_TTL = int(os.getenv('PAGINATION_COUNT_CACHE_TTL', 30))
+
+PAGINATION_ESTIMATE_THRESHOLD = int(
+    os.getenv('PAGINATION_ESTIMATE_THRESHOLD', 1000)
+)
+
+# Доля запросов, для которых пишутся Server-Timing и строка в лог;
+# 0 отключает профилирование.
+REQUEST_PROFILING_SAMPLE_RATE = float(
+    os.getenv('REQUEST_PROFILING_SAMPLE_RATE', 0)
+)
+
+# Сколько одинаковых запросов за один HTTP-запрос считать N+1.
+REQUEST_PROFILING_DUPLICATE_THRESHOLD = int(
+    os.getenv('REQUEST_PROFILING_DUPLICATE_THRESHOLD', 3)
+)
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+
+# /api/metrics отдаётся с Authorization: Bearer <токен> и администраторам;
+# без токена — только администраторам.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.middleware': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+BULK_RECIPES_LIMIT = int(os.getenv('BULK_RECIPES_LIMIT', 100))
+
+SUBSCRIPTION_RECIPES_LIMIT = int(os.getenv('SUBSCRIPTION_RECIPES_LIMIT', 3))
+
+# Вклад одного добавления в популярность рецепта.
+POPULARITY_WEIGHTS = {
+    'favorite': 2.0,
+    'cart': 1.0,
+}
+
+# Период полураспада вклада, в секундах.
+POPULARITY_HALF_LIFE = int(
+    os.getenv('POPULARITY_HALF_LIFE', 3 * 24 * 60 * 60)
+)
+
+IMAGE_MAX_UPLOAD_SIZE = int(
+    os.getenv('IMAGE_MAX_UPLOAD_SIZE', 10 * 1024 * 1024)
+)
+
+# Тело запроса с base64-изображением на треть больше самого изображения.
+JSON_BODY_MAX_SIZE = IMAGE_MAX_UPLOAD_SIZE * 4 // 3 + 1024 * 1024
+
+IMAGE_RENDITIONS = {
+    'thumb': 160,
+    'card': 480,
+    'full': 1280,
+}
+
+IMAGE_RENDITION_FORMAT = os.getenv('IMAGE_RENDITION_FORMAT', 'WEBP')
+
+IMAGE_RENDITION_QUALITY = int(os.getenv('IMAGE_RENDITION_QUALITY', 80))
+
+IMAGE_RENDITION_WORKERS = int(os.getenv('IMAGE_RENDITION_WORKERS', 2))
+
+IMAGE_RENDITIONS_EAGER = os.getenv('IMAGE_RENDITIONS_EAGER', 'False') == 'True'
+
+# Сколько секунд после сохранения файл изображения не удаляется, даже если
+# на него пока не ссылается ни один рецепт.
+IMAGE_RELEASE_GRACE = int(os.getenv('IMAGE_RELEASE_GRACE', 60 * 60))
+
+SHOPPING_CART_PDF_FONT = os.getenv(
+    'SHOPPING_CART_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+
 CORS_ALLOW_ALL_ORIGINS = True
 
 CORS_ALLOWED_ORIGINS = [
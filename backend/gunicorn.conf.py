@@ -0,0 +1,9 @@
+bind = '0.0.0.0:8000'
+
+
+def child_exit(server, worker):
+    # Счётчики завершившегося воркера продолжают суммироваться из его
+    # файлов, а live-gauge нужно пометить как неактуальные.
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
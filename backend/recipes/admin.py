@@ -1,9 +1,12 @@
 from django.contrib import admin
+from django.db import transaction
 
 from users.models import User, Subscription
 
+from . import counters, popularity, shopping_cart, versions
 from .models import (Favorite, Ingredient, Recipe, RecipeIngredient, RecipeTag,
                      ShoppingList, Tag)
+from .search import refresh_search
 
 
 class RecipeIngredientInline(admin.TabularInline):
@@ -37,10 +40,67 @@ class ShoppingListInline(admin.TabularInline):
 class RecipeAdmin(admin.ModelAdmin):
     inlines = (RecipeIngredientInline, RecipeTagInline)
 
+    def save_related(self, request, form, formsets, change):
+        recipe = form.instance
+        before = shopping_cart.recipe_amounts([recipe.pk])[recipe.pk]
+        with transaction.atomic(), versions.batch():
+            super().save_related(request, form, formsets, change)
+            versions.recipe_links_changed([recipe.pk])
+            shopping_cart.recipe_changed(
+                recipe,
+                before,
+                shopping_cart.recipe_amounts([recipe.pk])[recipe.pk]
+            )
+        refresh_search([recipe.pk])
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, Recipe.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic(), counters.batch(), popularity.batch(), \
+                versions.batch():
+            shopping_cart.cart_changed(ShoppingList.objects.filter(
+                recipe__in=queryset.values('pk')
+            ).values_list('user', 'recipe'), -1)
+            super().delete_queryset(request, queryset)
+
+
+class ShoppingListAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            if change:
+                shopping_cart.cart_changed(ShoppingList.objects.filter(
+                    pk=obj.pk
+                ).values_list('user', 'recipe'), -1)
+            super().save_model(request, obj, form, change)
+            shopping_cart.cart_changed([(obj.user_id, obj.recipe_id)], 1)
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, ShoppingList.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            shopping_cart.cart_changed(
+                queryset.values_list('user', 'recipe'), -1
+            )
+            super().delete_queryset(request, queryset)
+
 
 class UserAdmin(admin.ModelAdmin):
     inlines = (SubscriptionInline, FavoriteInline, ShoppingListInline)
 
+    def save_related(self, request, form, formsets, change):
+        user = form.instance
+        cart = ShoppingList.objects.filter(user=user).values_list(
+            'user', 'recipe'
+        )
+        with transaction.atomic():
+            before = set(cart.all())
+            super().save_related(request, form, formsets, change)
+            after = set(cart.all())
+            shopping_cart.cart_changed(before - after, -1)
+            shopping_cart.cart_changed(after - before, 1)
+
 
 admin.site.register(Recipe, RecipeAdmin)
 admin.site.register(Ingredient)
@@ -48,7 +108,7 @@ admin.site.register(Tag)
 admin.site.register(RecipeIngredient)
 admin.site.register(Subscription)
 admin.site.register(Favorite)
-admin.site.register(ShoppingList)
+admin.site.register(ShoppingList, ShoppingListAdmin)
 admin.site.register(RecipeTag)
 
 admin.site.register(User, UserAdmin)
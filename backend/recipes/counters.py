@@ -0,0 +1,128 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from users.models import Subscription, User
+from .models import Favorite, Recipe, ShoppingList
+
+# Счётчик -> (модель связи, поле связи, указывающее на владельца счётчика).
+RECIPE_COUNTERS = {
+    'favorites_count': (Favorite, 'recipe'),
+    'carts_count': (ShoppingList, 'recipe'),
+}
+USER_COUNTERS = {
+    'recipes_count': (Recipe, 'author'),
+    'followers_count': (Subscription, 'author'),
+    'following_count': (Subscription, 'user'),
+}
+COUNTERS = (
+    (Recipe, RECIPE_COUNTERS),
+    (User, USER_COUNTERS),
+)
+
+
+_pending = ContextVar('pending_counters', default=None)
+
+
+def link_counters(link_model):
+    """Счётчики, которые зависят от строк link_model: (модель, поле,
+    поле связи)."""
+    return [
+        (model, field, link_field)
+        for model, counters in COUNTERS
+        for field, (source, link_field) in counters.items()
+        if source is link_model
+    ]
+
+
+def shift(shifts):
+    """Сдвигает счётчики на {(модель, поле, pk): delta} выражениями F().
+
+    UPDATE берёт блокировку строки, поэтому одновременные сдвиги не
+    теряются; вызывать нужно в той же транзакции, что и запись связи.
+    """
+    groups = defaultdict(list)
+    for (model, field, pk), delta in shifts.items():
+        if delta:
+            groups[model, field, delta].append(pk)
+    for (model, field, delta), owners in groups.items():
+        value = F(field) + delta
+        if delta < 0:
+            value = Greatest(value, 0)
+        model.objects.filter(pk__in=owners).update(**{field: value})
+
+
+def links_changed(link_model, links, delta):
+    """Сдвигает счётчики владельцев строк links на delta за строку:
+    +1 для добавленных, -1 для удалённых.
+
+    Внутри batch() сдвиги суммируются и применяются при выходе из блока.
+    """
+    shifts = Counter()
+    for model, field, link_field in link_counters(link_model):
+        for link in links:
+            shifts[model, field, getattr(link, f'{link_field}_id')] += delta
+    pending = _pending.get()
+    if pending is None:
+        shift(shifts)
+    else:
+        pending.update(shifts)
+
+
+@contextmanager
+def batch():
+    """Один UPDATE на владельца вместо UPDATE на каждую строку,
+    например при массовом удалении связей с сигналами post_delete."""
+    pending = Counter()
+    token = _pending.set(pending)
+    try:
+        yield
+    finally:
+        _pending.reset(token)
+    shift(pending)
+
+
+def actual_count(source, link_field):
+    return Coalesce(
+        Subquery(
+            source.objects.filter(
+                **{link_field: OuterRef('pk')}
+            ).order_by().values(link_field).annotate(
+                total=Count('pk')
+            ).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+def find_drift(model, counters):
+    """{(pk, поле): (сохранено, по факту)} для расходящихся счётчиков."""
+    drift = {}
+    queryset = model.objects.annotate(**{
+        f'actual_{field}': actual_count(source, link_field)
+        for field, (source, link_field) in counters.items()
+    }).order_by('pk')
+    fields = list(counters)
+    rows = queryset.values_list(
+        'pk', *fields, *(f'actual_{field}' for field in fields)
+    )
+    for pk, *values in rows.iterator():
+        for field, stored, actual in zip(
+                fields, values, values[len(fields):]):
+            if stored != actual:
+                drift[pk, field] = stored, actual
+    return drift
+
+
+def reconcile(model, counters):
+    """Пересчитывает счётчики model по таблицам связей."""
+    with transaction.atomic():
+        return model.objects.update(**{
+            field: actual_count(source, link_field)
+            for field, (source, link_field) in counters.items()
+        })
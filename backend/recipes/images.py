@@ -0,0 +1,126 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import Lock
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+from .models import Recipe
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    'WEBP': 'webp',
+    'JPEG': 'jpg',
+}
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_RENDITION_WORKERS,
+                thread_name_prefix='renditions'
+            )
+        return _executor
+
+
+def make_renditions(recipe_id):
+    """Строит уменьшенные копии изображения рецепта.
+
+    Результат записывается в image_renditions, только если изображение
+    не сменилось, пока копии строились.
+    """
+    recipe = Recipe.objects.filter(pk=recipe_id).only('image').first()
+    if recipe is None or not recipe.image:
+        return
+    source = recipe.image.name
+    image_format = settings.IMAGE_RENDITION_FORMAT
+    with recipe.image.open('rb') as f:
+        image = ImageOps.exif_transpose(Image.open(f))
+    if image_format == 'JPEG' or 'A' not in image.getbands():
+        image = image.convert('RGB')
+    else:
+        image = image.convert('RGBA')
+
+    stem = os.path.splitext(os.path.basename(source))[0]
+    renditions = {'source': source}
+    for name, size in settings.IMAGE_RENDITIONS.items():
+        rendition = image.copy()
+        rendition.thumbnail((size, size), Image.LANCZOS)
+        buffer = BytesIO()
+        rendition.save(
+            buffer, image_format, quality=settings.IMAGE_RENDITION_QUALITY
+        )
+        renditions[name] = recipe.image.storage.save(
+            f'recipes/renditions/{stem}_{name}.'
+            f'{EXTENSIONS.get(image_format, image_format.lower())}',
+            ContentFile(buffer.getvalue())
+        )
+    Recipe.objects.filter(pk=recipe_id, image=source).update(
+        image_renditions=renditions, version=uuid4()
+    )
+    return renditions
+
+
+def make_renditions_in_worker(recipe_id):
+    try:
+        make_renditions(recipe_id)
+    except Exception:
+        logger.exception('Не удалось обработать изображение рецепта %s',
+                         recipe_id)
+    finally:
+        connections.close_all()
+
+
+def image_files(name, renditions):
+    return {name} | {
+        path for key, path in renditions.items() if key != 'source'
+    }
+
+
+def release_image(name, renditions):
+    """Удаляет изображение и его копии, если на них не ссылается рецепт.
+
+    Файлы называются по содержимому и могут быть общими для нескольких
+    рецептов, поэтому удаляются только после того, как пропала
+    последняя ссылка. Файлы моложе IMAGE_RELEASE_GRACE секунд могли
+    только что достаться другому рецепту, транзакция которого ещё не
+    завершилась, — их оставляем, потом их удалит cleanup_media.
+    """
+    if not name or Recipe.objects.filter(image=name).exists():
+        return
+    if renditions.get('source') != name:
+        renditions = {}
+    storage = Recipe._meta.get_field('image').storage
+    threshold = time.time() - settings.IMAGE_RELEASE_GRACE
+    for path in image_files(name, renditions):
+        try:
+            if os.path.getmtime(storage.path(path)) > threshold:
+                continue
+        except FileNotFoundError:
+            continue
+        storage.delete(path)
+
+
+def schedule_release(name, renditions):
+    transaction.on_commit(lambda: release_image(name, renditions))
+
+
+def schedule_renditions(recipe):
+    if settings.IMAGE_RENDITIONS_EAGER:
+        recipe.image_renditions = make_renditions(recipe.pk) or {}
+        return
+    transaction.on_commit(
+        lambda: get_executor().submit(make_renditions_in_worker, recipe.pk)
+    )
@@ -1,33 +1,173 @@
 import csv
+import json
 import os
+import re
+from itertools import islice
 
 from django.conf import settings
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
 from recipes.models import Ingredient
+from recipes.versions import INGREDIENTS, bump_version
+
+READ_SIZE = 64 * 1024
+# Наибольший размер одного объекта в JSON-массиве: больший буфер
+# означает повреждённый или обрезанный файл.
+MAX_ITEM_SIZE = 1024 * 1024
+SEPARATOR = re.compile(r'[\s,]*')
+
+# В PostgreSQL строки копируются COPY во временную таблицу и переносятся
+# одним INSERT ... SELECT, минуя ORM и построчные запросы.
+STAGING_SQL = '''
+CREATE TEMPORARY TABLE ingredient_import (
+    name varchar(200) NOT NULL,
+    measurement_unit varchar(10) NOT NULL
+) ON COMMIT DROP
+'''
+COPY_SQL = (
+    'COPY ingredient_import (name, measurement_unit) '
+    'FROM STDIN WITH (FORMAT csv)'
+)
+MERGE_SQL = '''
+INSERT INTO {table} (name, measurement_unit)
+SELECT DISTINCT name, measurement_unit FROM ingredient_import
+ON CONFLICT DO NOTHING
+'''
+
+
+def read_csv(f):
+    for row in csv.reader(f):
+        if row:
+            name, measurement_unit = row
+            yield name, measurement_unit
+
+
+def read_json(f):
+    """Поэлементно отдаёт объекты из JSON-массива, не читая файл целиком."""
+    decoder = json.JSONDecoder()
+    chunk = f.read(READ_SIZE)
+    buffer = chunk.lstrip()
+    # Позиция начала buffer в файле, в символах.
+    offset = len(chunk) - len(buffer)
+    if not buffer.startswith('['):
+        raise CommandError('Ожидался JSON-массив ингредиентов')
+    pos = 1
+    eof = False
+    while True:
+        pos = SEPARATOR.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise CommandError(
+                    f'Некорректный JSON-файл: позиция {offset + pos}'
+                )
+            if len(buffer) - pos > MAX_ITEM_SIZE:
+                raise CommandError(
+                    f'Некорректный JSON-файл: позиция {offset + pos}, '
+                    f'объект длиннее {MAX_ITEM_SIZE} символов'
+                )
+            chunk = f.read(READ_SIZE)
+            eof = not chunk
+            offset += pos
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield item['name'], item['measurement_unit']
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+class CsvStream:
+    """Файлоподобный объект, отдающий строки в формате csv для COPY."""
+
+    def __init__(self, rows):
+        writer = csv.writer(Echo())
+        self.lines = (writer.writerow(row) for row in rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+def copy_rows(rows):
+    """Загружает строки через COPY и возвращает их число."""
+    table = connection.ops.quote_name(Ingredient._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(STAGING_SQL)
+        cursor.cursor.copy_expert(COPY_SQL, CsvStream(rows), READ_SIZE)
+        total = cursor.cursor.rowcount
+        cursor.execute(MERGE_SQL.format(table=table))
+    return total
+
+
+def insert_rows(rows, batch_size):
+    """Вставляет строки пачками без дублей и возвращает их число."""
+    table = connection.ops.quote_name(Ingredient._meta.db_table)
+    sql = '{} {} (name, measurement_unit) VALUES (%s, %s) {}'.format(
+        connection.ops.insert_statement(ignore_conflicts=True),
+        table,
+        connection.ops.ignore_conflicts_suffix_sql(ignore_conflicts=True)
+    )
+    total = 0
+    with connection.cursor() as cursor:
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                return total
+            total += len(chunk)
+            cursor.executemany(sql, set(chunk))
+
+
+READERS = {
+    '.csv': read_csv,
+    '.json': read_json,
+}
 
 
 class Command(BaseCommand):
-    help = 'Загрузка из csv файла'
+    help = 'Загрузка ингредиентов из csv или json файла'
 
     def add_arguments(self, parser):
         parser.add_argument('filename', default='ingredients.csv', nargs='?',
                             type=str)
+        parser.add_argument('--batch-size', default=1000, type=int)
 
     def handle(self, *args, **options):
+        path = os.path.join(settings.BASE_DIR, '.', 'data',
+                            options['filename'])
+        reader = READERS.get(os.path.splitext(path)[1].lower())
+        if reader is None:
+            raise CommandError('Поддерживаются только файлы .csv и .json')
 
-        with open(os.path.join(
-                settings.BASE_DIR,
-                '.',
-                'data',
-                options['filename']),
-                'r',
-                encoding='utf-8') as f:
-            data = csv.reader(f)
-            for row in data:
-                name, measurement_unit = row
-                Ingredient.objects.get_or_create(
-                    name=name,
-                    measurement_unit=measurement_unit,
-                )
+        before = Ingredient.objects.count()
+        with open(path, 'r', encoding='utf-8') as f, transaction.atomic():
+            rows = (
+                (name.strip(), measurement_unit.strip())
+                for name, measurement_unit in reader(f)
+            )
+            if connection.vendor == 'postgresql':
+                total = copy_rows(rows)
+            else:
+                total = insert_rows(rows, options['batch_size'])
 
-        self.stdout.write(self.style.SUCCESS('Все ингридиенты загружены!'))
+        inserted = Ingredient.objects.count() - before
+        if inserted:
+            bump_version(INGREDIENTS)
+        self.stdout.write(self.style.SUCCESS(
+            f'Ингредиенты загружены: добавлено {inserted}, '
+            f'пропущено {total - inserted}'
+        ))
@@ -0,0 +1,31 @@
+from django.core.management import BaseCommand
+
+from recipes.images import make_renditions
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Построение уменьшенных копий изображений рецептов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Перестроить копии и для уже обработанных рецептов'
+        )
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(image='').only(
+            'image', 'image_renditions'
+        ).order_by('id')
+        built = 0
+        for recipe in recipes.iterator():
+            if (
+                not options['force']
+                and recipe.image_renditions.get('source') == recipe.image.name
+            ):
+                continue
+            make_renditions(recipe.pk)
+            built += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано изображений: {built}'
+        ))
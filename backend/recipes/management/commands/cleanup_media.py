@@ -0,0 +1,56 @@
+import os
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from recipes.images import image_files
+from recipes.models import Recipe
+
+MEDIA_DIRECTORY = 'recipes'
+
+
+def walk(storage, directory):
+    directories, files = storage.listdir(directory)
+    for name in files:
+        yield os.path.join(directory, name).replace('\\', '/')
+    for name in directories:
+        yield from walk(storage, os.path.join(directory, name))
+
+
+class Command(BaseCommand):
+    help = 'Удаление изображений, на которые не ссылается ни один рецепт'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace', type=int, default=60,
+            help='Не трогать файлы моложе указанного числа минут'
+        )
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        storage = Recipe._meta.get_field('image').storage
+        if not storage.exists(MEDIA_DIRECTORY):
+            return
+        referenced = set()
+        recipes = Recipe.objects.exclude(image='').values_list(
+            'image', 'image_renditions'
+        )
+        for name, renditions in recipes.iterator():
+            referenced |= image_files(name, renditions)
+
+        threshold = timezone.now() - timedelta(minutes=options['grace'])
+        removed = freed = 0
+        for path in walk(storage, MEDIA_DIRECTORY):
+            if (
+                path in referenced
+                or storage.get_modified_time(path) > threshold
+            ):
+                continue
+            freed += storage.size(path)
+            removed += 1
+            if not options['dry_run']:
+                storage.delete(path)
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено файлов: {removed}, освобождено {freed} байт'
+        ))
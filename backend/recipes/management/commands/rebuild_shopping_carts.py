@@ -0,0 +1,46 @@
+from django.core.management import BaseCommand, CommandError
+
+from recipes.shopping_cart import find_drift, refresh_totals
+from users.models import User
+
+USERS_PER_BATCH = 500
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт или проверка сумм ингредиентов в списках покупок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Только сравнить таблицу с пересчётом, ничего не меняя'
+        )
+
+    def handle(self, *args, **options):
+        user_ids = list(
+            User.objects.order_by('id').values_list('id', flat=True)
+        )
+        batches = [
+            user_ids[start:start + USERS_PER_BATCH]
+            for start in range(0, len(user_ids), USERS_PER_BATCH)
+        ]
+
+        if options['verify']:
+            drift = {}
+            for batch in batches:
+                drift.update(find_drift(batch))
+            for (user_id, ingredient_id), (stored, expected) in sorted(
+                    drift.items()):
+                self.stdout.write(
+                    f'user={user_id} ingredient={ingredient_id}: '
+                    f'{stored} != {expected}'
+                )
+            if drift:
+                raise CommandError(f'Найдено расхождений: {len(drift)}')
+            self.stdout.write(self.style.SUCCESS('Расхождений нет'))
+            return
+
+        for batch in batches:
+            refresh_totals(batch)
+        self.stdout.write(self.style.SUCCESS(
+            f'Списки покупок пересчитаны: {len(user_ids)} пользователей'
+        ))
@@ -0,0 +1,36 @@
+from django.core.management import BaseCommand, CommandError
+
+from recipes.counters import COUNTERS, find_drift, reconcile
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт или проверка денормализованных счётчиков'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Только сравнить счётчики с пересчётом, ничего не меняя'
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            total = 0
+            for model, counters in COUNTERS:
+                drift = find_drift(model, counters)
+                total += len(drift)
+                for (pk, field), (stored, actual) in sorted(drift.items()):
+                    self.stdout.write(
+                        f'{model._meta.model_name}={pk} {field}: '
+                        f'{stored} != {actual}'
+                    )
+            if total:
+                raise CommandError(f'Найдено расхождений: {total}')
+            self.stdout.write(self.style.SUCCESS('Расхождений нет'))
+            return
+
+        for model, counters in COUNTERS:
+            updated = reconcile(model, counters)
+            self.stdout.write(
+                f'{model._meta.verbose_name_plural}: пересчитано {updated}'
+            )
+        self.stdout.write(self.style.SUCCESS('Счётчики пересчитаны'))
@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+
+from recipes.popularity import rebuild, refresh
+
+
+class Command(BaseCommand):
+    help = ('Учёт новых добавлений в избранное и списки покупок и удалений '
+            'из них в популярности')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', default=5000, type=int)
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Пересчитать популярность с нуля по текущим строкам'
+        )
+
+    def handle(self, *args, **options):
+        update = rebuild if options['rebuild'] else refresh
+        processed = update(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Популярность обновлена: учтено строк {processed}'
+        ))
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+CREATE_INDEXES = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS recipes_ingredient_name_prefix '
+    'ON recipes_ingredient (UPPER(name::text) text_pattern_ops)',
+    'CREATE INDEX IF NOT EXISTS recipes_ingredient_name_trgm '
+    'ON recipes_ingredient USING gin (UPPER(name::text) gin_trgm_ops)',
+)
+
+DROP_INDEXES = (
+    'DROP INDEX IF EXISTS recipes_ingredient_name_trgm',
+    'DROP INDEX IF EXISTS recipes_ingredient_name_prefix',
+)
+
+
+def run_on_postgresql(statements):
+    def operation(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+    """Индексы под поиск ингредиентов по префиксу и подстроке.
+
+    Выражение UPPER(name::text) совпадает с тем, что Django генерирует
+    для istartswith/icontains в PostgreSQL. На других СУБД поиск идёт
+    через индекс в памяти процесса (api.search).
+    """
+
+    dependencies = [
+        ('recipes', '0003_ingredient_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_on_postgresql(CREATE_INDEXES),
+            run_on_postgresql(DROP_INDEXES),
+        ),
+    ]
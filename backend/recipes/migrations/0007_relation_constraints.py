@@ -0,0 +1,91 @@
+# Generated by Django 3.2.19 on 2026-10-18 04:23
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def delete_duplicates(model, fields):
+    """Оставляет по одной строке на набор fields, возвращает удалённые."""
+    duplicates = (
+        model.objects.values(*fields)
+        .annotate(keep_id=Min('id'), total=Count('id'))
+        .filter(total__gt=1)
+        .order_by()
+    )
+    removed = []
+    for duplicate in duplicates:
+        extra = model.objects.filter(
+            **{field: duplicate[field] for field in fields}
+        ).exclude(id=duplicate['keep_id'])
+        removed.append(duplicate)
+        extra.delete()
+    return removed
+
+
+def deduplicate_relations(apps, schema_editor):
+    Favorite = apps.get_model('recipes', 'Favorite')
+    RecipeTag = apps.get_model('recipes', 'RecipeTag')
+    ShoppingList = apps.get_model('recipes', 'ShoppingList')
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    ShoppingCartIngredient = apps.get_model(
+        'recipes', 'ShoppingCartIngredient'
+    )
+    delete_duplicates(Favorite, ('user', 'recipe'))
+    delete_duplicates(RecipeTag, ('recipe', 'tag'))
+    user_ids = {
+        duplicate['user']
+        for duplicate in delete_duplicates(ShoppingList, ('user', 'recipe'))
+    }
+    if not user_ids:
+        return
+    ShoppingCartIngredient.objects.filter(user__in=user_ids).delete()
+    totals = RecipeIngredient.objects.filter(
+        recipe__in_shopping_cart__user__in=user_ids
+    ).values(
+        'recipe__in_shopping_cart__user', 'ingredient'
+    ).annotate(total=Sum('amount')).order_by()
+    ShoppingCartIngredient.objects.bulk_create(
+        ShoppingCartIngredient(
+            user_id=row['recipe__in_shopping_cart__user'],
+            ingredient_id=row['ingredient'],
+            total_amount=row['total'],
+        )
+        for row in totals
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_recipe_image_renditions'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            deduplicate_relations, migrations.RunPython.noop
+        ),
+        migrations.AlterModelOptions(
+            name='recipe',
+            options={'ordering': ('-pub_date',), 'verbose_name': 'Рецепт', 'verbose_name_plural': 'Рецепты'},
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-pub_date'], name='recipe_pub_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['author', '-pub_date'], name='recipe_author_pub_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='favorite',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_favorite'),
+        ),
+        migrations.AddConstraint(
+            model_name='recipetag',
+            constraint=models.UniqueConstraint(fields=('recipe', 'tag'), name='unique_recipe_tag'),
+        ),
+        migrations.AddConstraint(
+            model_name='shoppinglist',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_shopping_list'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 3.2.19 on 2026-10-18 04:31
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_of(source, link_field):
+    return Coalesce(
+        Subquery(
+            source.objects.filter(
+                **{link_field: OuterRef('pk')}
+            ).order_by().values(link_field).annotate(
+                total=Count('pk')
+            ).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    ShoppingList = apps.get_model('recipes', 'ShoppingList')
+    User = apps.get_model('users', 'User')
+    Subscription = apps.get_model('users', 'Subscription')
+    Recipe.objects.update(
+        favorites_count=count_of(Favorite, 'recipe'),
+        carts_count=count_of(ShoppingList, 'recipe'),
+    )
+    User.objects.update(
+        recipes_count=count_of(Recipe, 'author'),
+        followers_count=count_of(Subscription, 'author'),
+        following_count=count_of(Subscription, 'user'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_relation_constraints'),
+        ('users', '0003_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='в списках покупок'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='в избранном'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-favorites_count', '-pub_date'], name='recipe_favorites_count_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.19 on 2026-10-18 04:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularityCheckpoint',
+            fields=[
+                ('source', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('last_id', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Отметка пересчёта популярности',
+                'verbose_name_plural': 'Отметки пересчёта популярности',
+            },
+        ),
+        migrations.CreateModel(
+            name='RecipePopularity',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='popularity', serialize=False, to='recipes.recipe')),
+                ('score', models.FloatField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Популярность рецепта',
+                'verbose_name_plural': 'Популярность рецептов',
+            },
+        ),
+        migrations.AddField(
+            model_name='favorite',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='shoppinglist',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='recipepopularity',
+            index=models.Index(fields=['-score'], name='recipe_popularity_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.2.19 on 2026-10-18 04:40
+
+from django.conf import settings
+from django.db import migrations
+
+UPDATE_SQL = """
+UPDATE recipes_recipe AS recipe SET search_vector =
+    setweight(to_tsvector(%s::regconfig, recipe.name), 'A')
+    || setweight(to_tsvector(%s::regconfig, coalesce((
+        SELECT string_agg(ingredient.name, ' ')
+        FROM recipes_recipeingredient AS link
+        JOIN recipes_ingredient AS ingredient
+            ON ingredient.id = link.ingredient_id
+        WHERE link.recipe_id = recipe.id
+    ), '')), 'B')
+    || setweight(to_tsvector(%s::regconfig, recipe.text), 'C')
+"""
+
+
+def add_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'ALTER TABLE recipes_recipe ADD COLUMN search_vector tsvector'
+    )
+    schema_editor.execute(UPDATE_SQL, [settings.RECIPE_SEARCH_CONFIG] * 3)
+    schema_editor.execute(
+        'CREATE INDEX recipe_search_vector_idx ON recipes_recipe '
+        'USING gin (search_vector)'
+    )
+
+
+def drop_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'ALTER TABLE recipes_recipe DROP COLUMN search_vector'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_popularity'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_search_vector, drop_search_vector),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.19 on 2026-10-18 04:49
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_recipe_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='version',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, verbose_name='версия'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.19 on 2026-10-18 05:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_recipe_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipe_id', models.IntegerField()),
+                ('changed_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Изменение рецепта',
+                'verbose_name_plural': 'Изменения рецептов',
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.19 on 2026-10-18 05:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_recipe_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularityRemoval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipe_id', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Удаление из источника популярности',
+                'verbose_name_plural': 'Удаления из источников популярности',
+            },
+        ),
+    ]
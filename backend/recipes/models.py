@@ -1,3 +1,5 @@
+from uuid import uuid4
+
 from django.conf import settings
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
@@ -30,6 +32,12 @@ class Ingredient(models.Model):
         ordering = ('name', )
         verbose_name = "Ингредиенты"
         verbose_name_plural = "Ингредиенты"
+        constraints = (
+            models.UniqueConstraint(
+                fields=('name', 'measurement_unit'),
+                name='unique_ingredient'
+            ),
+        )
 
     def __str__(self):
         return self.name
@@ -41,6 +49,11 @@ class Recipe(models.Model):
         upload_to='recipes/',
         blank=True
     )
+    image_renditions = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False
+    )
     tags = models.ManyToManyField(Tag, through='RecipeTag')
     cooking_time = models.PositiveSmallIntegerField(
         default=1,
@@ -58,10 +71,31 @@ class Recipe(models.Model):
         related_name='recipes_authored'
     )
     pub_date = models.DateTimeField(auto_now_add=True)
+    favorites_count = models.PositiveIntegerField(
+        'в избранном', default=0, editable=False
+    )
+    carts_count = models.PositiveIntegerField(
+        'в списках покупок', default=0, editable=False
+    )
+    # Меняется при любой правке рецепта, его тегов, ингредиентов и профиля
+    # автора; по ней проверяется кэш готового представления рецепта.
+    version = models.UUIDField('версия', default=uuid4, editable=False)
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        ordering = ('-pub_date',)
+        indexes = (
+            models.Index(fields=('-pub_date',), name='recipe_pub_date_idx'),
+            models.Index(
+                fields=('author', '-pub_date'),
+                name='recipe_author_pub_date_idx'
+            ),
+            models.Index(
+                fields=('-favorites_count', '-pub_date'),
+                name='recipe_favorites_count_idx'
+            ),
+        )
 
     def __str__(self):
         return self.name
@@ -78,6 +112,13 @@ class RecipeTag(models.Model):
         related_name='recipetag')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=('recipe', 'tag'), name='unique_recipe_tag'
+            ),
+        )
+
 
 class RecipeIngredient(models.Model):
     recipe = models.ForeignKey(
@@ -106,6 +147,14 @@ class Favorite(models.Model):
         Recipe,
         on_delete=models.CASCADE,
         related_name='favorited_by')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'recipe'), name='unique_favorite'
+            ),
+        )
 
 
 class ShoppingList(models.Model):
@@ -117,3 +166,92 @@ class ShoppingList(models.Model):
         Recipe,
         on_delete=models.CASCADE,
         related_name='in_shopping_cart')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'recipe'), name='unique_shopping_list'
+            ),
+        )
+
+
+class ShoppingCartIngredient(models.Model):
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='shopping_cart_ingredients')
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='+')
+    total_amount = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name = 'Ингредиент в списке покупок'
+        verbose_name_plural = 'Ингредиенты в списках покупок'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'ingredient'),
+                name='unique_shopping_cart_ingredient'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.ingredient} - {self.total_amount}'
+
+
+class RecipePopularity(models.Model):
+    """Популярность рецепта: log2 суммы весов добавлений в избранное и
+    списки покупок, каждый из которых затухает с периодом полураспада.
+
+    Вес отсчитывается от общей эпохи, поэтому старые строки не нужно
+    пересчитывать: порядок рецептов от этого не меняется.
+    """
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='popularity'
+    )
+    score = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Популярность рецепта'
+        verbose_name_plural = 'Популярность рецептов'
+        indexes = (
+            models.Index(fields=('-score',), name='recipe_popularity_idx'),
+        )
+
+
+class PopularityCheckpoint(models.Model):
+    """Последняя учтённая строка источника популярности."""
+    source = models.CharField(max_length=32, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Отметка пересчёта популярности'
+        verbose_name_plural = 'Отметки пересчёта популярности'
+
+
+class PopularityRemoval(models.Model):
+    """Рецепт, у которого удалили строку избранного или списка покупок:
+    его популярность пересчитывается без этой строки."""
+    recipe_id = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Удаление из источника популярности'
+        verbose_name_plural = 'Удаления из источников популярности'
+
+
+class RecipeChange(models.Model):
+    """Журнал изменённых рецептов, по которому процессы обновляют свои
+    индексы рецептов, не перестраивая их целиком."""
+    recipe_id = models.IntegerField()
+    changed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = 'Изменение рецепта'
+        verbose_name_plural = 'Изменения рецептов'
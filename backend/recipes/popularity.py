@@ -0,0 +1,188 @@
+import math
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone as tz
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import (Favorite, PopularityCheckpoint, PopularityRemoval,
+                     RecipePopularity, ShoppingList)
+
+SOURCES = (
+    ('favorite', Favorite),
+    ('cart', ShoppingList),
+)
+REMOVALS = 'removal'
+EPOCH = datetime(2023, 1, 1, tzinfo=tz.utc)
+# Строки моложе этого ждут следующего запуска: транзакция с меньшим id
+# может закоммититься позже, и её нельзя пропустить за отметкой.
+COMMIT_LAG = timedelta(seconds=30)
+
+_pending = ContextVar('pending_removals', default=None)
+
+
+def log_weight(weight, created_at):
+    """log2 вклада строки, отсчитанный от EPOCH."""
+    return math.log2(weight) + (
+        (created_at - EPOCH).total_seconds() / settings.POPULARITY_HALF_LIFE
+    )
+
+
+def log_add(total, value):
+    """log2(2 ** total + 2 ** value) без переполнения."""
+    if total is None:
+        return value
+    high, low = max(total, value), min(total, value)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def merge_scores(scores, replace=False):
+    """Прибавляет scores к сохранённым оценкам (или, с replace,
+    записывает их вместо сохранённых)."""
+    now = timezone.now()
+    existing = {
+        popularity.recipe_id: popularity
+        for popularity in RecipePopularity.objects.select_for_update().filter(
+            recipe_id__in=scores
+        )
+    }
+    for recipe_id, popularity in existing.items():
+        popularity.score = scores[recipe_id] if replace else log_add(
+            popularity.score, scores[recipe_id]
+        )
+        popularity.updated_at = now
+    RecipePopularity.objects.bulk_update(
+        existing.values(), ['score', 'updated_at']
+    )
+    RecipePopularity.objects.bulk_create(
+        RecipePopularity(recipe_id=recipe_id, score=score)
+        for recipe_id, score in scores.items()
+        if recipe_id not in existing
+    )
+
+
+def recompute(recipe_ids, checkpoints):
+    """Считает оценки рецептов заново по уже учтённым строкам
+    источников, снимая вклад удалённых строк."""
+    scores = {}
+    for name, model in SOURCES:
+        weight = settings.POPULARITY_WEIGHTS[name]
+        rows = model.objects.filter(
+            recipe_id__in=recipe_ids, id__lte=checkpoints[name].last_id
+        ).values_list('recipe_id', 'created_at')
+        for recipe_id, created_at in rows.iterator():
+            scores[recipe_id] = log_add(
+                scores.get(recipe_id), log_weight(weight, created_at)
+            )
+    RecipePopularity.objects.filter(recipe_id__in=recipe_ids).exclude(
+        recipe_id__in=scores
+    ).delete()
+    merge_scores(scores, replace=True)
+
+
+def refresh_batch(batch_size, lag=COMMIT_LAG):
+    """Учитывает следующую пачку новых строк каждого источника и
+    удалений из них.
+
+    Возвращает число учтённых строк; 0 значит, что всё учтено.
+    """
+    cutoff = timezone.now() - lag
+    processed = 0
+    names = [name for name, _ in SOURCES] + [REMOVALS]
+    with transaction.atomic():
+        for name in names:
+            PopularityCheckpoint.objects.get_or_create(source=name)
+        checkpoints = {
+            checkpoint.source: checkpoint
+            for checkpoint in PopularityCheckpoint.objects.select_for_update()
+            .filter(source__in=names)
+            .order_by('source')
+        }
+        scores = {}
+        for name, model in SOURCES:
+            checkpoint = checkpoints[name]
+            weight = settings.POPULARITY_WEIGHTS[name]
+            rows = model.objects.filter(
+                id__gt=checkpoint.last_id
+            ).order_by('id').values_list(
+                'id', 'recipe_id', 'created_at'
+            )[:batch_size]
+            for row_id, recipe_id, created_at in rows:
+                if created_at >= cutoff:
+                    break
+                scores[recipe_id] = log_add(
+                    scores.get(recipe_id), log_weight(weight, created_at)
+                )
+                checkpoint.last_id = row_id
+                processed += 1
+            checkpoint.save(update_fields=['last_id'])
+        if scores:
+            merge_scores(scores)
+
+        checkpoint = checkpoints[REMOVALS]
+        recipe_ids = set()
+        rows = PopularityRemoval.objects.filter(
+            id__gt=checkpoint.last_id
+        ).order_by('id').values_list('id', 'recipe_id', 'created_at')
+        for row_id, recipe_id, created_at in rows[:batch_size]:
+            if created_at >= cutoff:
+                break
+            recipe_ids.add(recipe_id)
+            checkpoint.last_id = row_id
+            processed += 1
+        if recipe_ids:
+            recompute(recipe_ids, checkpoints)
+            PopularityRemoval.objects.filter(
+                id__lte=checkpoint.last_id
+            ).delete()
+        checkpoint.save(update_fields=['last_id'])
+    return processed
+
+
+def record_removals(recipe_ids):
+    PopularityRemoval.objects.bulk_create(
+        PopularityRemoval(recipe_id=recipe_id) for recipe_id in recipe_ids
+    )
+
+
+def source_removed(links):
+    """Отмечает рецепты удалённых строк избранного или списка покупок
+    для пересчёта популярности; внутри batch() — при выходе из блока."""
+    recipe_ids = {link.recipe_id for link in links}
+    pending = _pending.get()
+    if pending is None:
+        record_removals(recipe_ids)
+    else:
+        pending.update(recipe_ids)
+
+
+@contextmanager
+def batch():
+    """Одна запись на рецепт при массовом удалении строк источников."""
+    pending = set()
+    token = _pending.set(pending)
+    try:
+        yield
+    finally:
+        _pending.reset(token)
+    record_removals(pending)
+
+
+def refresh(batch_size=5000, lag=COMMIT_LAG):
+    """Доводит таблицу популярности до текущих строк источников."""
+    total = 0
+    while True:
+        processed = refresh_batch(batch_size, lag)
+        if not processed:
+            return total
+        total += processed
+
+
+def rebuild(batch_size=5000, lag=COMMIT_LAG):
+    with transaction.atomic():
+        RecipePopularity.objects.all().delete()
+        PopularityCheckpoint.objects.all().delete()
+        PopularityRemoval.objects.all().delete()
+    return refresh(batch_size, lag)
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+
+from .models import Recipe
+from .versions import recipes_changed
+
+BATCH_SIZE = 1000
+
+# Колонка search_vector есть только в PostgreSQL (миграция 0010) и не
+# объявлена в модели, чтобы не попадать в каждый SELECT рецептов.
+UPDATE_SQL = """
+UPDATE recipes_recipe AS recipe SET search_vector =
+    setweight(to_tsvector(%(config)s::regconfig, recipe.name), 'A')
+    || setweight(to_tsvector(%(config)s::regconfig, coalesce((
+        SELECT string_agg(ingredient.name, ' ')
+        FROM recipes_recipeingredient AS link
+        JOIN recipes_ingredient AS ingredient
+            ON ingredient.id = link.ingredient_id
+        WHERE link.recipe_id = recipe.id
+    ), '')), 'B')
+    || setweight(to_tsvector(%(config)s::regconfig, recipe.text), 'C')
+WHERE recipe.id = ANY(%(ids)s)
+"""
+MATCH_SQL = (
+    '"recipes_recipe"."search_vector" @@ '
+    'websearch_to_tsquery(%s::regconfig, %s)'
+)
+RANK_SQL = (
+    'ts_rank("recipes_recipe"."search_vector", '
+    'websearch_to_tsquery(%s::regconfig, %s))'
+)
+
+
+def uses_search_vector():
+    return connection.vendor == 'postgresql'
+
+
+def refresh_search(recipe_ids):
+    """Обновляет поисковые данные рецептов после изменения названия,
+    текста или состава.
+
+    Журнал изменений обновляет индексы рецептов в памяти процессов.
+    """
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return
+    recipes_changed(recipe_ids)
+    if not uses_search_vector():
+        return
+    with connection.cursor() as cursor:
+        for start in range(0, len(recipe_ids), BATCH_SIZE):
+            cursor.execute(UPDATE_SQL, {
+                'config': settings.RECIPE_SEARCH_CONFIG,
+                'ids': recipe_ids[start:start + BATCH_SIZE],
+            })
+
+
+def refresh_all():
+    refresh_search(Recipe.objects.values_list('id', flat=True))
+
+
+def search_recipes(queryset, query):
+    """Рецепты, подходящие под запрос, по убыванию релевантности
+    (только PostgreSQL)."""
+    params = (settings.RECIPE_SEARCH_CONFIG, query)
+    return queryset.filter(
+        RawSQL(MATCH_SQL, params, output_field=BooleanField())
+    ).annotate(
+        search_rank=RawSQL(RANK_SQL, params, output_field=FloatField())
+    ).order_by('-search_rank', '-pub_date', '-id')
@@ -0,0 +1,183 @@
+from collections import Counter, defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import (Case, F, IntegerField, Q, Sum, Value,
+                              When)
+from django.db.models.functions import Greatest
+
+from users.models import User
+
+from .models import (Recipe, RecipeIngredient, ShoppingCartIngredient,
+                     ShoppingList)
+
+BATCH_SIZE = 500
+
+
+def calculate_totals(user_ids=None, ingredient_ids=None):
+    """Суммы ингредиентов по спискам покупок, посчитанные по рецептам."""
+    rows = RecipeIngredient.objects.filter(
+        recipe__in_shopping_cart__isnull=False
+    )
+    if user_ids is not None:
+        rows = rows.filter(recipe__in_shopping_cart__user__in=user_ids)
+    if ingredient_ids is not None:
+        rows = rows.filter(ingredient__in=ingredient_ids)
+    return {
+        (row['recipe__in_shopping_cart__user'], row['ingredient']):
+            row['total']
+        for row in rows.values(
+            'recipe__in_shopping_cart__user', 'ingredient'
+        ).annotate(total=Sum('amount')).order_by()
+    }
+
+
+def refresh_totals(user_ids, ingredient_ids=None):
+    """Пересчитывает строки ShoppingCartIngredient для указанных
+    пользователей (и, если заданы, только для этих ингредиентов) по
+    рецептам — для rebuild_shopping_carts и начальной загрузки."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    if ingredient_ids is not None:
+        ingredient_ids = list(ingredient_ids)
+        if not ingredient_ids:
+            return
+    stale = ShoppingCartIngredient.objects.filter(user__in=user_ids)
+    if ingredient_ids is not None:
+        stale = stale.filter(ingredient__in=ingredient_ids)
+    with transaction.atomic():
+        # Параллельный пересчёт тех же пользователей ждёт коммита этого
+        # и считает суммы уже по новым данным.
+        list(User.objects.select_for_update().filter(
+            pk__in=user_ids
+        ).order_by('pk').values_list('pk', flat=True))
+        totals = calculate_totals(user_ids, ingredient_ids)
+        stale.delete()
+        ShoppingCartIngredient.objects.bulk_create(
+            ShoppingCartIngredient(
+                user_id=user_id, ingredient_id=ingredient_id,
+                total_amount=total
+            )
+            for (user_id, ingredient_id), total in totals.items()
+        )
+
+
+def recipe_amounts(recipe_ids):
+    """{id рецепта: {id ингредиента: количество}}."""
+    amounts = defaultdict(dict)
+    rows = RecipeIngredient.objects.filter(recipe__in=recipe_ids)
+    for recipe_id, ingredient_id, amount in rows.values_list(
+            'recipe', 'ingredient', 'amount'):
+        amounts[recipe_id][ingredient_id] = amount
+    return amounts
+
+
+def apply_deltas(deltas):
+    """Сдвигает суммы на {(id пользователя, id ингредиента): delta}.
+
+    Недостающие строки создаются с нулём, сдвиг делается выражением F()
+    одним UPDATE на пачку, а обнулившиеся строки удаляются. Полный
+    пересчёт остаётся команде rebuild_shopping_carts.
+    """
+    keys = sorted(key for key, delta in deltas.items() if delta)
+    for start in range(0, len(keys), BATCH_SIZE):
+        chunk = keys[start:start + BATCH_SIZE]
+        ShoppingCartIngredient.objects.bulk_create(
+            [
+                ShoppingCartIngredient(
+                    user_id=user_id, ingredient_id=ingredient_id,
+                    total_amount=0
+                )
+                for user_id, ingredient_id in chunk
+                if deltas[user_id, ingredient_id] > 0
+            ],
+            ignore_conflicts=True
+        )
+        ingredient_ids = defaultdict(list)
+        for user_id, ingredient_id in chunk:
+            ingredient_ids[user_id].append(ingredient_id)
+        rows = ShoppingCartIngredient.objects.filter(reduce(or_, (
+            Q(user=user_id, ingredient__in=ingredients)
+            for user_id, ingredients in ingredient_ids.items()
+        )))
+        rows.update(total_amount=Greatest(
+            F('total_amount') + Case(
+                *(
+                    When(user=user_id, ingredient=ingredient_id,
+                         then=Value(deltas[user_id, ingredient_id]))
+                    for user_id, ingredient_id in chunk
+                ),
+                default=Value(0), output_field=IntegerField()
+            ),
+            0
+        ))
+        if any(deltas[key] < 0 for key in chunk):
+            rows.filter(total_amount=0).delete()
+
+
+def cart_changed(pairs, sign):
+    """Учитывает рецепты, добавленные (sign=1) или удалённые (sign=-1) из
+    списков покупок; pairs — пары (id пользователя, id рецепта).
+
+    Вызывать в транзакции записи ShoppingList и до удаления самих
+    рецептов: количества берутся из их ингредиентов.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return
+    recipe_ids = {recipe_id for _, recipe_id in pairs}
+    with transaction.atomic():
+        # Правка рецепта держит блокировку его строки до коммита, так что
+        # количества читаются уже после неё.
+        list(Recipe.objects.select_for_update().filter(
+            pk__in=recipe_ids
+        ).order_by('pk').values_list('pk', flat=True))
+        amounts = recipe_amounts(recipe_ids)
+        deltas = Counter()
+        for user_id, recipe_id in pairs:
+            for ingredient_id, amount in amounts[recipe_id].items():
+                deltas[user_id, ingredient_id] += sign * amount
+        apply_deltas(deltas)
+
+
+def recipe_changed(recipe, before, after):
+    """Сдвигает суммы у всех, у кого рецепт в списке покупок, на разницу
+    количеств ингредиентов до и после правки ({id ингредиента: amount}).
+    """
+    changes = {
+        ingredient_id: after.get(ingredient_id, 0)
+        - before.get(ingredient_id, 0)
+        for ingredient_id in before.keys() | after.keys()
+    }
+    changes = {key: delta for key, delta in changes.items() if delta}
+    if not changes:
+        return
+    user_ids = ShoppingList.objects.filter(
+        recipe=recipe
+    ).values_list('user', flat=True)
+    apply_deltas({
+        (user_id, ingredient_id): delta
+        for user_id in user_ids.iterator()
+        for ingredient_id, delta in changes.items()
+    })
+
+
+def find_drift(user_ids=None):
+    """Расхождения таблицы с пересчётом: {(user, ingredient): (было, надо)}."""
+    stored = ShoppingCartIngredient.objects.all()
+    if user_ids is not None:
+        stored = stored.filter(user__in=user_ids)
+    actual = {
+        (user_id, ingredient_id): total
+        for user_id, ingredient_id, total in stored.values_list(
+            'user', 'ingredient', 'total_amount'
+        )
+    }
+    expected = calculate_totals(user_ids)
+    return {
+        key: (actual.get(key), expected.get(key))
+        for key in actual.keys() | expected.keys()
+        if actual.get(key) != expected.get(key)
+    }
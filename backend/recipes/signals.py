@@ -0,0 +1,119 @@
+from uuid import uuid4
+
+from django.db import transaction
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
+from django.dispatch import receiver
+
+from users.models import Subscription, User
+from . import popularity
+from .counters import links_changed
+from .images import schedule_release, schedule_renditions
+from .models import (Favorite, Ingredient, Recipe, RecipeIngredient,
+                     RecipeTag, ShoppingList, Tag)
+from .search import refresh_search
+from .versions import (INGREDIENTS, TAGS, bump_version, recipe_links_changed,
+                       recipes_changed, touch_recipes)
+
+AUTHOR_FIELDS = {'email', 'username', 'first_name', 'last_name'}
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def ingredient_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(INGREDIENTS))
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        touch_recipes(Recipe.objects.filter(ingredients=instance))
+        refresh_search(RecipeIngredient.objects.filter(
+            ingredient=instance
+        ).values_list('recipe_id', flat=True))
+
+
+@receiver(pre_delete, sender=Ingredient)
+@receiver(pre_delete, sender=Tag)
+def catalogue_item_deleting(sender, instance, **kwargs):
+    field = 'ingredients' if sender is Ingredient else 'tags'
+    touch_recipes(Recipe.objects.filter(**{field: instance}))
+    if sender is Ingredient:
+        recipes_changed(RecipeIngredient.objects.filter(
+            ingredient=instance
+        ).values_list('recipe_id', flat=True))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(TAGS))
+
+
+@receiver(post_save, sender=Tag)
+def tag_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        touch_recipes(Recipe.objects.filter(tags=instance))
+
+
+@receiver(pre_save, sender=Recipe)
+def recipe_saving(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance.version = uuid4()
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_save, sender=RecipeTag)
+@receiver(post_delete, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeTag)
+def recipe_link_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        recipe_links_changed([instance.recipe_id])
+
+
+@receiver(post_save, sender=User)
+def author_saved(sender, instance, created, raw=False, update_fields=None,
+                 **kwargs):
+    if created or raw:
+        return
+    if update_fields is None or AUTHOR_FIELDS & set(update_fields):
+        touch_recipes(Recipe.objects.filter(author=instance))
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, **kwargs):
+    if (
+        instance.image
+        and instance.image_renditions.get('source') != instance.image.name
+    ):
+        schedule_renditions(instance)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    if instance.image:
+        schedule_release(instance.image.name, instance.image_renditions)
+    recipes_changed([instance.pk])
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Subscription)
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingList)
+def link_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        links_changed(sender, [instance], 1)
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Subscription)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingList)
+def link_deleted(sender, instance, **kwargs):
+    links_changed(sender, [instance], -1)
+
+
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingList)
+def popularity_source_deleted(sender, instance, **kwargs):
+    popularity.source_removed([instance])
@@ -0,0 +1,34 @@
+import hashlib
+import os
+
+from django.core.files.storage import FileSystemStorage
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+class ContentHashStorage(FileSystemStorage):
+    """Хранилище, называющее файлы по sha256 содержимого.
+
+    Одинаковые файлы сохраняются один раз, а имя файла не меняется,
+    пока не изменится его содержимое, поэтому URL можно кэшировать
+    навсегда. Если такой файл уже есть, у него обновляется время
+    изменения: release_image не удаляет недавно сохранённые файлы,
+    даже если ссылающийся на них рецепт ещё не записан в базу.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        digest = hashlib.sha256()
+        for chunk in content.chunks(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+        dirname, basename = os.path.split(name)
+        extension = os.path.splitext(basename)[1].lower()
+        name = os.path.join(dirname, digest.hexdigest() + extension)
+        if self.exists(name):
+            try:
+                os.utime(self.path(name))
+            except FileNotFoundError:
+                return super().save(name, content, max_length)
+            return name.replace('\\', '/')
+        return super().save(name, content, max_length)
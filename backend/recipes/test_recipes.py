@@ -1,45 +1,35 @@
+import base64
+import csv
+import importlib
+import json
+import os
+import tracemalloc
+from datetime import timedelta
+from io import BytesIO, StringIO
+
 import pytest
+from django.contrib import admin
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+from PIL import Image
 from rest_framework.test import APIClient
 
-from recipes.models import (Ingredient, Recipe, RecipeIngredient,
+from api.catalogue import get_recipe_index, get_recipe_matcher, recipe_index
+from api.fragments import fragments
+from api.renderers import PdfShoppingCartRenderer
+from api.search import IngredientIndex, IngredientMatcher, RecipeIndex
+from api.uploads import decode_data_uri
+from recipes import counters, popularity
+from recipes.images import release_image
+from recipes.models import (Favorite, Ingredient, Recipe, RecipeChange,
+                            RecipeIngredient, RecipePopularity,
+                            RecipeTag, ShoppingCartIngredient, ShoppingList,
                             Tag)
-from users.models import User, Subscription
-
-
-@pytest.fixture
-def api_client():
-    return APIClient()
-
-
-@pytest.fixture
-def test_password():
-    return 'strong-test-pass'
-
-
-@pytest.fixture
-def create_user(db, test_password):
-    def make_user(**kwargs):
-        kwargs['password'] = test_password
-        if 'username' not in kwargs:
-            kwargs['username'] = str(kwargs['email'])
-        return User.objects.create_user(**kwargs)
-    return make_user
-
-
-@pytest.fixture
-def test_user(create_user):
-    user = create_user(email='user@test.com', password='test_password')
-    return user
-
-
-@pytest.fixture
-def test_recipe(db, test_user):
-    return Recipe.objects.create(
-        name='Test recipe',
-        text='Test text',
-        cooking_time=30,
-        author=test_user
-    )
+from recipes.search import refresh_search, uses_search_vector
+from recipes.shopping_cart import refresh_totals
+from recipes.versions import INGREDIENTS, bump_version
+from users.models import Subscription
 
 
 @pytest.fixture
@@ -92,8 +82,9 @@ def test_create_recipe(db, test_user, test_recipe,
 
 
 def test_update_recipe(db, test_user, test_recipe, test_ingredient,
-                       test_tag, api_client
+                       test_tag, api_client, settings, tmp_path
                        ):
+    settings.MEDIA_ROOT = str(tmp_path)
     api_client.force_authenticate(user=test_user)
     response = api_client.patch(f'/api/recipes/{test_recipe.id}/', {
         'name': 'Updated name',
@@ -129,6 +120,16 @@ def test_remove_from_shopping_cart(db, test_user, test_recipe, api_client):
     assert response.status_code == 204
 
 
+def test_shopping_cart_missing_recipe(db, test_user, api_client):
+    api_client.force_authenticate(user=test_user)
+    assert api_client.post(
+        '/api/recipes/999/shopping_cart/'
+    ).status_code == 404
+    assert api_client.delete(
+        '/api/recipes/999/shopping_cart/'
+    ).status_code == 404
+
+
 def test_download_shopping_cart(db, test_user, test_recipe, api_client):
     test_ingredient = Ingredient.objects.create(
         name="Test ingredient",
@@ -149,8 +150,9 @@ def test_download_shopping_cart(db, test_user, test_recipe, api_client):
 
     assert response.status_code == 200, 'Downloading shopping cart failed'
 
-    assert 'Test ingredient - 10 g' in str(response.content), \
-        'The ingredient list is incorrect'
+    assert 'Test ingredient - 10 g' in str(
+        b''.join(response.streaming_content)
+    ), 'The ingredient list is incorrect'
 
 
 def test_shopping_list(db, test_user, test_recipe, api_client):
@@ -199,6 +201,17 @@ def test_subscribe(db, test_user, test_subscription, api_client):
     assert response.status_code == 400  # because already subscribed
 
 
+def test_subscribe_returns_subscribed_author(db, test_user, create_user,
+                                             api_client):
+    author = create_user(email='author@test.com', username='author')
+    api_client.force_authenticate(user=test_user)
+    response = api_client.post(f'/api/users/{author.id}/subscribe/')
+    assert response.status_code == 201
+    assert response.data['is_subscribed'] is True
+    response = api_client.get(f'/api/users/{author.id}/')
+    assert response.data['is_subscribed'] is True
+
+
 def test_unsubscribe(db, test_user, test_subscription, api_client):
     api_client.force_authenticate(user=test_user)
     response = api_client.delete(
@@ -220,3 +233,1337 @@ def test_tags(db):
         Tag.objects.create(name='Test tag 1', color='123456', slug='test1'),
         Tag.objects.create(name='Test tag 2', color='654321', slug='test2'),
     ]
+
+
+def test_recipe_list_query_count(db, test_user, test_tags, test_ingredients,
+                                 create_user, api_client,
+                                 django_assert_num_queries):
+    author = create_user(email='author@test.com')
+    Subscription.objects.create(user=test_user, author=author)
+    for number in range(10):
+        recipe = Recipe.objects.create(
+            name=f'Recipe {number}',
+            text='Test text',
+            cooking_time=10,
+            author=author if number % 2 else test_user
+        )
+        recipe.tags.add(*test_tags)
+        for ingredient in test_ingredients:
+            RecipeIngredient.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=number + 1
+            )
+        if number % 3 == 0:
+            Favorite.objects.create(user=test_user, recipe=recipe)
+            ShoppingList.objects.create(user=test_user, recipe=recipe)
+
+    api_client.force_authenticate(user=test_user)
+    with django_assert_num_queries(4):
+        response = api_client.get('/api/recipes/?limit=10')
+    assert response.status_code == 200
+    results = response.data['results']
+    assert len(results) == 10
+    for data in results:
+        number = int(data['name'].split()[-1])
+        assert data['is_favorited'] == (number % 3 == 0)
+        assert data['is_in_shopping_cart'] == (number % 3 == 0)
+        assert data['author']['is_subscribed'] == bool(number % 2)
+        assert len(data['tags']) == 2
+        assert len(data['ingredients']) == 3
+
+
+def test_add_ingredients_is_idempotent(db, tmp_path, test_ingredient):
+    csv_file = tmp_path / 'ingredients.csv'
+    csv_file.write_text(
+        'Test ingredient,g\n'
+        'соль,г\n'
+        'соль,г\n'
+        'сахар,г\n',
+        encoding='utf-8'
+    )
+    json_file = tmp_path / 'ingredients.json'
+    json_file.write_text(
+        '[{"name": "сахар", "measurement_unit": "г"}, '
+        '{"name": "перец", "measurement_unit": "по вкусу"}]',
+        encoding='utf-8'
+    )
+    out = StringIO()
+
+    call_command('add-ingredients', str(csv_file), batch_size=2, stdout=out)
+    assert 'добавлено 2, пропущено 2' in out.getvalue()
+    call_command('add-ingredients', str(json_file), stdout=out)
+    assert 'добавлено 1, пропущено 1' in out.getvalue()
+    call_command('add-ingredients', str(csv_file), stdout=out)
+    assert 'добавлено 0, пропущено 4' in out.getvalue()
+
+    assert sorted(
+        Ingredient.objects.values_list('name', 'measurement_unit')
+    ) == [
+        ('Test ingredient', 'g'),
+        ('перец', 'по вкусу'),
+        ('сахар', 'г'),
+        ('соль', 'г'),
+    ]
+
+
+def test_add_ingredients_copy_stream():
+    command = importlib.import_module(
+        'recipes.management.commands.add-ingredients'
+    )
+    rows = [('соль, крупная', 'г'), ('"сыр"', 'кг')] * 1000
+    stream = command.CsvStream(iter(rows))
+    data = ''.join(iter(lambda: stream.read(100), ''))
+    assert list(map(tuple, csv.reader(StringIO(data)))) == rows
+
+
+def test_add_ingredients_rejects_malformed_json(monkeypatch):
+    command = importlib.import_module(
+        'recipes.management.commands.add-ingredients'
+    )
+    monkeypatch.setattr(command, 'READ_SIZE', 16)
+    monkeypatch.setattr(command, 'MAX_ITEM_SIZE', 64)
+    item = '{"name": "соль", "measurement_unit": "г"}'
+    head = f' [{item}, '
+
+    rows = command.read_json(StringIO(head + '{"name": "' + 'a' * 1000))
+    assert next(rows) == ('соль', 'г')
+    with pytest.raises(CommandError, match=f'позиция {len(head)},'):
+        next(rows)
+
+    rows = command.read_json(StringIO(head + '{"name"'))
+    assert next(rows) == ('соль', 'г')
+    with pytest.raises(CommandError, match=f'позиция {len(head)}$'):
+        next(rows)
+
+
+def test_ingredient_index_ranks_prefix_before_substring():
+    index = IngredientIndex([
+        (1, 'Сахарная пудра'),
+        (2, 'тростниковый сахар'),
+        (3, 'сахар'),
+        (4, 'соль'),
+        (5, 'ванильный сахар'),
+    ])
+    assert index.search('САХ', 10) == [3, 1, 5, 2]
+    assert index.search('сах', 2) == [3, 1]
+    assert index.search('перец', 10) == []
+
+
+def test_ingredient_search_endpoint(db, api_client, settings):
+    settings.INGREDIENT_SEARCH_LIMIT = 3
+    Ingredient.objects.bulk_create(
+        Ingredient(name=name, measurement_unit='г')
+        for name in ('молоко', 'кокосовое молоко', 'сгущённое молоко',
+                     'молочный шоколад', 'мука', 'мёд')
+    )
+    bump_version(INGREDIENTS)
+    response = api_client.get('/api/ingredients/', {'name': 'Мол'})
+    assert response.status_code == 200
+    assert [item['name'] for item in response.data] == [
+        'молоко', 'молочный шоколад', 'кокосовое молоко'
+    ]
+
+
+def test_ingredient_catalogue_serves_lookups_from_memory(
+        db, test_ingredients, api_client, django_assert_num_queries,
+        django_capture_on_commit_callbacks):
+    api_client.get('/api/ingredients/')
+    with django_assert_num_queries(0):
+        response = api_client.get('/api/ingredients/', {'name': 'test'})
+        detail = api_client.get(f'/api/ingredients/{test_ingredients[1].id}/')
+    assert [item['id'] for item in response.data] == [
+        test_ingredients[0].id, test_ingredients[1].id
+    ]
+    assert detail.data == {
+        'id': test_ingredients[1].id,
+        'name': 'Test ingredient 2',
+        'measurement_unit': 'kg',
+    }
+
+    with django_capture_on_commit_callbacks(execute=True):
+        test_ingredients[1].name = 'Renamed'
+        test_ingredients[1].save()
+        # До коммита версия прежняя: другой процесс не соберёт каталог
+        # из ещё не зафиксированных строк под новой версией.
+        response = api_client.get('/api/ingredients/', {'name': 'test'})
+        assert len(response.data) == 2
+    response = api_client.get('/api/ingredients/', {'name': 'test'})
+    assert [item['id'] for item in response.data] == [test_ingredients[0].id]
+    assert api_client.get('/api/ingredients/0/').status_code == 404
+
+
+def test_tags_conditional_get(db, test_tags, api_client,
+                              django_assert_num_queries,
+                              django_capture_on_commit_callbacks):
+    response = api_client.get('/api/tags/')
+    etag = response['ETag']
+    assert response.status_code == 200
+    assert 'max-age' in response['Cache-Control']
+
+    with django_assert_num_queries(0):
+        response = api_client.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+
+    detail = api_client.get(f'/api/tags/{test_tags[0].id}/')
+    assert detail['ETag'] != etag
+
+    with django_capture_on_commit_callbacks(execute=True):
+        test_tags[0].name = 'Renamed tag'
+        test_tags[0].save()
+        assert api_client.get(
+            '/api/tags/', HTTP_IF_NONE_MATCH=etag
+        ).status_code == 304
+    response = api_client.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+    assert api_client.get('/api/recipes/', {
+        'tags': test_tags[0].slug
+    }).status_code == 200
+    with django_capture_on_commit_callbacks(execute=True):
+        Tag.objects.create(name='New tag', color='#00FF00', slug='new')
+    response = api_client.get('/api/recipes/', {'tags': 'new'})
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('export_format, content_type', [
+    ('txt', 'text/plain; charset=utf-8'),
+    ('csv', 'text/csv; charset=utf-8'),
+    ('json', 'application/json; charset=utf-8'),
+    ('pdf', 'application/pdf'),
+])
+def test_download_shopping_cart_formats(db, test_user, test_recipe,
+                                        api_client, export_format,
+                                        content_type):
+    salt = Ingredient.objects.create(name='соль', measurement_unit='г')
+    pepper = Ingredient.objects.create(name='перец', measurement_unit='г')
+    pinch = Ingredient.objects.create(name='соль', measurement_unit='щепотка')
+    other_recipe = Recipe.objects.create(
+        name='Other', text='Text', cooking_time=5, author=test_user
+    )
+    RecipeIngredient.objects.bulk_create([
+        RecipeIngredient(recipe=test_recipe, ingredient=salt, amount=5),
+        RecipeIngredient(recipe=test_recipe, ingredient=pinch, amount=1),
+        RecipeIngredient(recipe=other_recipe, ingredient=salt, amount=7),
+        RecipeIngredient(recipe=other_recipe, ingredient=pepper, amount=2),
+    ])
+    api_client.force_authenticate(user=test_user)
+    api_client.post(f'/api/recipes/{test_recipe.id}/shopping_cart/')
+    api_client.post(f'/api/recipes/{other_recipe.id}/shopping_cart/')
+    response = api_client.get(
+        '/api/recipes/download_shopping_cart/', {'format': export_format}
+    )
+    assert response.status_code == 200
+    assert response['Content-Type'] == content_type
+    assert response['Content-Disposition'] == (
+        f'attachment; filename="ingredients.{export_format}"'
+    )
+    content = b''.join(response.streaming_content)
+    if export_format == 'txt':
+        assert content.decode() == (
+            'перец - 2 г\nсоль - 12 г\nсоль - 1 щепотка\n'
+        )
+    elif export_format == 'csv':
+        assert content.decode().splitlines() == [
+            'name,amount,measurement_unit',
+            'перец,2,г',
+            'соль,12,г',
+            'соль,1,щепотка',
+        ]
+    elif export_format == 'json':
+        assert json.loads(content) == [
+            {'name': 'перец', 'amount': 2, 'measurement_unit': 'г'},
+            {'name': 'соль', 'amount': 12, 'measurement_unit': 'г'},
+            {'name': 'соль', 'amount': 1, 'measurement_unit': 'щепотка'},
+        ]
+    else:
+        assert content.startswith(b'%PDF')
+
+
+def test_pdf_font_falls_back_to_builtin(db, test_user, test_recipe,
+                                        api_client, settings, monkeypatch,
+                                        tmp_path, caplog):
+    monkeypatch.setattr(PdfShoppingCartRenderer, 'font',
+                        PdfShoppingCartRenderer.font)
+    settings.SHOPPING_CART_PDF_FONT = str(tmp_path / 'missing.ttf')
+    with caplog.at_level('WARNING', logger='api.renderers'):
+        assert PdfShoppingCartRenderer.register_font() == 'Helvetica'
+    assert 'missing.ttf' in caplog.text
+
+    broken = tmp_path / 'broken.ttf'
+    broken.write_bytes(b'not a font')
+    settings.SHOPPING_CART_PDF_FONT = str(broken)
+    assert PdfShoppingCartRenderer.register_font() == 'Helvetica'
+
+    ShoppingList.objects.create(user=test_user, recipe=test_recipe)
+    api_client.force_authenticate(user=test_user)
+    response = api_client.get(
+        '/api/recipes/download_shopping_cart/', {'format': 'pdf'}
+    )
+    assert response.status_code == 200
+    assert b''.join(response.streaming_content).startswith(b'%PDF')
+
+
+def test_download_shopping_cart_requires_auth(db, api_client):
+    response = api_client.get(
+        '/api/recipes/download_shopping_cart/', {'format': 'pdf'}
+    )
+    assert response.status_code == 401
+    assert response['Content-Type'] == 'application/json'
+
+
+def test_shopping_cart_totals_follow_cart_and_recipe_changes(
+        db, test_user, test_recipe, test_ingredients, test_tag, api_client):
+    first, second, third = test_ingredients
+    RecipeIngredient.objects.create(
+        recipe=test_recipe, ingredient=first, amount=10
+    )
+    RecipeIngredient.objects.create(
+        recipe=test_recipe, ingredient=second, amount=3
+    )
+    other = Recipe.objects.create(
+        name='Other', text='Text', cooking_time=5, author=test_user
+    )
+    RecipeIngredient.objects.create(recipe=other, ingredient=first, amount=5)
+
+    def totals():
+        return dict(ShoppingCartIngredient.objects.filter(
+            user=test_user).values_list('ingredient', 'total_amount'))
+
+    api_client.force_authenticate(user=test_user)
+    api_client.post(f'/api/recipes/{test_recipe.id}/shopping_cart/')
+    api_client.post(f'/api/recipes/{other.id}/shopping_cart/')
+    assert totals() == {first.id: 15, second.id: 3}
+
+    response = api_client.patch(f'/api/recipes/{test_recipe.id}/', {
+        'name': 'Updated',
+        'text': 'Test text',
+        'cooking_time': 1,
+        'ingredients': [
+            {'id': first.id, 'amount': 1}, {'id': third.id, 'amount': 7}
+        ],
+        'tags': [test_tag.id],
+    }, format='json')
+    assert response.status_code == 200
+    assert totals() == {first.id: 6, third.id: 7}
+
+    api_client.delete(f'/api/recipes/{other.id}/shopping_cart/')
+    assert totals() == {first.id: 1, third.id: 7}
+
+    api_client.delete(f'/api/recipes/{test_recipe.id}/')
+    assert totals() == {}
+
+
+def test_rebuild_shopping_carts_fixes_drift(db, test_user, test_recipe,
+                                            test_ingredient):
+    RecipeIngredient.objects.create(
+        recipe=test_recipe, ingredient=test_ingredient, amount=4
+    )
+    ShoppingList.objects.create(user=test_user, recipe=test_recipe)
+
+    with pytest.raises(CommandError):
+        call_command('rebuild_shopping_carts', verify=True, stdout=StringIO())
+    call_command('rebuild_shopping_carts', stdout=StringIO())
+    call_command('rebuild_shopping_carts', verify=True, stdout=StringIO())
+    assert ShoppingCartIngredient.objects.get(
+        user=test_user, ingredient=test_ingredient
+    ).total_amount == 4
+
+
+def test_bulk_shopping_cart_and_favorites(db, test_user, test_recipe,
+                                          test_ingredient, api_client):
+    RecipeIngredient.objects.create(
+        recipe=test_recipe, ingredient=test_ingredient, amount=3
+    )
+    other = Recipe.objects.create(
+        name='Other', text='Text', cooking_time=5, author=test_user
+    )
+    RecipeIngredient.objects.create(
+        recipe=other, ingredient=test_ingredient, amount=4
+    )
+    ShoppingList.objects.create(user=test_user, recipe=other)
+    refresh_totals([test_user.pk])
+    api_client.force_authenticate(user=test_user)
+
+    response = api_client.post('/api/recipes/shopping_cart/', {
+        'ids': [test_recipe.id, other.id, 999999, test_recipe.id]
+    }, format='json')
+    assert response.status_code == 200
+    assert response.data == {
+        str(test_recipe.id): 'added',
+        str(other.id): 'exists',
+        '999999': 'not_found',
+    }
+    assert ShoppingCartIngredient.objects.get(
+        user=test_user, ingredient=test_ingredient).total_amount == 7
+
+    response = api_client.delete('/api/recipes/shopping_cart/', {
+        'ids': [test_recipe.id, other.id]
+    }, format='json')
+    assert response.data == {
+        str(test_recipe.id): 'removed', str(other.id): 'removed'
+    }
+    assert not ShoppingList.objects.filter(user=test_user).exists()
+    assert not ShoppingCartIngredient.objects.filter(user=test_user).exists()
+
+    response = api_client.post('/api/recipes/favorite/', {
+        'ids': [test_recipe.id]
+    }, format='json')
+    assert response.data == {str(test_recipe.id): 'added'}
+    response = api_client.delete('/api/recipes/favorite/', {
+        'ids': [test_recipe.id, other.id]
+    }, format='json')
+    assert response.data == {
+        str(test_recipe.id): 'removed', str(other.id): 'absent'
+    }
+
+    response = api_client.post('/api/recipes/favorite/', {'ids': []},
+                               format='json')
+    assert response.status_code == 400
+
+
+def test_subscriptions_feed_is_bounded(db, test_user, create_user, api_client,
+                                       django_assert_max_num_queries):
+    for number in range(3):
+        author = create_user(email=f'author{number}@test.com',
+                             username=f'author{number}')
+        Subscription.objects.create(user=test_user, author=author)
+        for recipe_number in range(5):
+            Recipe.objects.create(
+                name=f'Recipe {number} {recipe_number}',
+                text='Test text',
+                cooking_time=10,
+                author=author
+            )
+
+    api_client.force_authenticate(user=test_user)
+    with django_assert_max_num_queries(4):
+        response = api_client.get('/api/users/subscriptions/?recipes_limit=2')
+    assert response.status_code == 200
+    assert response.data['count'] == 3
+    for data in response.data['results']:
+        assert data['is_subscribed'] is True
+        assert data['recipes_count'] == 5
+        number = data['username'][-1]
+        assert [recipe['name'] for recipe in data['recipes']] == [
+            f'Recipe {number} 4', f'Recipe {number} 3'
+        ]
+
+
+def test_user_list_does_not_embed_recipes(db, test_user, create_user,
+                                          api_client,
+                                          django_assert_num_queries):
+    author = create_user(email='author@test.com')
+    Subscription.objects.create(user=test_user, author=author)
+    for number in range(4):
+        Recipe.objects.create(
+            name=f'Recipe {number}', text='Test text', cooking_time=10,
+            author=author
+        )
+        create_user(email=f'user{number}@test.com')
+
+    api_client.force_authenticate(user=test_user)
+    with django_assert_num_queries(2):
+        response = api_client.get('/api/users/?limit=10')
+    assert response.status_code == 200
+    by_id = {data['id']: data for data in response.data['results']}
+    assert len(by_id) == 6
+    assert 'recipes' not in by_id[author.id]
+    assert 'password' not in by_id[author.id]
+    assert by_id[author.id]['recipes_count'] == 4
+    assert by_id[author.id]['is_subscribed'] is True
+    assert by_id[test_user.id]['subscriptions_count'] == 1
+
+    with django_assert_num_queries(1):
+        response = api_client.get('/api/users/me/')
+    assert response.data['id'] == test_user.id
+    assert 'recipes' not in response.data
+
+    response = api_client.get(
+        f'/api/users/{author.id}/?expand=recipes&recipes_limit=2'
+    )
+    assert [recipe['name'] for recipe in response.data['recipes']] == [
+        'Recipe 3', 'Recipe 2'
+    ]
+
+
+def png_data_uri(width, height):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), 'orange').save(buffer, 'PNG')
+    return ('data:image/png;base64,'
+            + base64.b64encode(buffer.getvalue()).decode())
+
+
+def test_recipe_image_renditions(db, test_user, test_ingredient, test_tag,
+                                 api_client, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.IMAGE_RENDITIONS_EAGER = True
+    api_client.force_authenticate(user=test_user)
+    payload = {
+        'name': 'Renditions',
+        'text': 'Test text',
+        'cooking_time': 1,
+        'ingredients': [{'id': test_ingredient.id, 'amount': 10}],
+        'tags': [test_tag.id],
+        'image': png_data_uri(2000, 1000),
+    }
+    response = api_client.post('/api/recipes/', payload, format='json')
+    assert response.status_code == 201
+    recipe = Recipe.objects.get(id=response.data['id'])
+    assert recipe.image_renditions['source'] == recipe.image.name
+    with Image.open(
+        tmp_path / recipe.image_renditions['thumb']
+    ) as thumb:
+        assert thumb.format == 'WEBP'
+        assert thumb.size == (160, 80)
+
+    renditions = recipe.image_renditions
+    response = api_client.get('/api/recipes/')
+    assert response.data['results'][0]['image'].endswith(renditions['card'])
+    response = api_client.get(f'/api/recipes/{recipe.id}/')
+    assert response.data['image'].endswith(renditions['full'])
+    response = api_client.post(f'/api/recipes/{recipe.id}/favorite/')
+    assert response.data['image'].endswith(renditions['thumb'])
+
+    settings.IMAGE_MAX_UPLOAD_SIZE = 10
+    response = api_client.post('/api/recipes/', payload, format='json')
+    assert response.status_code == 400
+    assert 'image' in response.data
+
+
+def test_recipe_images_are_deduplicated_and_released(
+        db, test_user, test_ingredient, test_tag, api_client, settings,
+        tmp_path, django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.IMAGE_RELEASE_GRACE = 0
+    image = png_data_uri(20, 10)
+    payload = {
+        'name': 'Shared',
+        'text': 'Test text',
+        'cooking_time': 1,
+        'ingredients': [{'id': test_ingredient.id, 'amount': 10}],
+        'tags': [test_tag.id],
+        'image': image,
+    }
+    api_client.force_authenticate(user=test_user)
+    first, second = (
+        Recipe.objects.get(
+            id=api_client.post('/api/recipes/', payload,
+                               format='json').data['id']
+        )
+        for _ in range(2)
+    )
+    assert first.image.name == second.image.name
+    assert len(list((tmp_path / 'recipes').iterdir())) == 1
+    shared = tmp_path / first.image.name
+
+    with django_capture_on_commit_callbacks(execute=True):
+        response = api_client.patch(f'/api/recipes/{first.id}/', {
+            **payload, 'image': png_data_uri(10, 20)
+        }, format='json')
+    assert response.status_code == 200
+    assert shared.exists()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        api_client.delete(f'/api/recipes/{second.id}/')
+    assert not shared.exists()
+
+    orphan = tmp_path / 'recipes' / 'orphan.png'
+    orphan.write_bytes(b'orphan')
+    call_command('cleanup_media', grace=0, stdout=StringIO())
+    assert not orphan.exists()
+    first.refresh_from_db()
+    assert (tmp_path / first.image.name).exists()
+
+
+def test_release_image_keeps_recently_saved_files(db, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.IMAGE_RELEASE_GRACE = 60
+    storage = Recipe._meta.get_field('image').storage
+    name = storage.save('recipes/image.png', ContentFile(b'image'))
+    path = tmp_path / name
+    os.utime(path, (0, 0))
+    # Тот же файл только что загрузили для рецепта, который ещё не в базе.
+    assert storage.save('recipes/other.png', ContentFile(b'image')) == name
+    release_image(name, {})
+    assert path.exists()
+
+    os.utime(path, (0, 0))
+    release_image(name, {})
+    assert not path.exists()
+
+
+@pytest.mark.parametrize('memory_size', [0, 10 * 1024 * 1024])
+def test_decode_data_uri_in_chunks(settings, memory_size):
+    settings.FILE_UPLOAD_MAX_MEMORY_SIZE = memory_size
+    payload = os.urandom(4 * 1024 * 1024 + 1)
+    encoded = base64.b64encode(payload).decode()
+    data = 'data:image/png;base64,' + encoded
+
+    tracemalloc.start()
+    upload = decode_data_uri(data, len(payload), chunk_size=8 * 1024)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    if not memory_size:
+        assert peak < 256 * 1024
+    assert upload.name == 'image.png'
+    assert upload.size == len(payload)
+    assert upload.read() == payload
+
+    wrapped = 'data:image/png;base64,' + '\n'.join(
+        encoded[position:position + 76]
+        for position in range(0, len(encoded), 76)
+    )
+    assert decode_data_uri(wrapped, len(payload)).read() == payload
+
+    tracemalloc.start()
+    with pytest.raises(ValueError):
+        decode_data_uri(data, len(payload) - 1)
+    assert tracemalloc.get_traced_memory()[1] < 64 * 1024
+    tracemalloc.stop()
+    with pytest.raises(ValueError):
+        decode_data_uri(data[:-1], len(payload))
+
+
+def test_json_body_size_limit(db, test_user, api_client, settings):
+    api_client.force_authenticate(user=test_user)
+    payload = {'name': 'x' * 5000, 'text': 'Test text', 'cooking_time': 1}
+    response = api_client.post('/api/recipes/', payload, format='json')
+    assert response.status_code == 400
+
+    settings.JSON_BODY_MAX_SIZE = 1000
+    response = api_client.post('/api/recipes/', payload, format='json')
+    assert response.status_code == 413
+
+
+def test_recipe_write_path_batches_ingredients(
+        db, test_user, test_ingredients, test_tags, api_client, settings,
+        tmp_path, django_assert_max_num_queries):
+    settings.MEDIA_ROOT = str(tmp_path)
+    api_client.force_authenticate(user=test_user)
+    payload = {
+        'name': 'Batched',
+        'text': 'Test text',
+        'cooking_time': 1,
+        'ingredients': [
+            {'id': ingredient.id, 'amount': 5}
+            for ingredient in test_ingredients
+        ],
+        'tags': [tag.id for tag in test_tags],
+        'image': png_data_uri(2, 2),
+    }
+    response = api_client.post('/api/recipes/', {
+        **payload, 'ingredients': [{'id': 999999, 'amount': 1}],
+        'tags': [999999]
+    }, format='json')
+    assert response.status_code == 400
+    assert set(response.data) == {'ingredients', 'tags'}
+
+    with django_assert_max_num_queries(13):
+        response = api_client.post('/api/recipes/', payload, format='json')
+    assert response.status_code == 201
+    recipe_id = response.data['id']
+
+    first, second, third = test_ingredients
+    with django_assert_max_num_queries(20):
+        response = api_client.patch(f'/api/recipes/{recipe_id}/', {
+            **payload,
+            'ingredients': [
+                {'id': first.id, 'amount': 5},
+                {'id': second.id, 'amount': 7},
+            ],
+            'tags': [test_tags[0].id],
+        }, format='json')
+    assert response.status_code == 200
+    assert dict(RecipeIngredient.objects.filter(
+        recipe_id=recipe_id).values_list('ingredient', 'amount')) == {
+        first.id: 5, second.id: 7
+    }
+    assert list(Recipe.objects.get(id=recipe_id).tags.all()) == [
+        test_tags[0]
+    ]
+
+    response = api_client.patch(f'/api/recipes/{recipe_id}/', {
+        **payload, 'ingredients': [{'id': third.id, 'amount': 1}] * 2
+    }, format='json')
+    assert response.status_code == 400
+
+
+def test_recipe_feed_cursor_pagination(db, test_user, api_client,
+                                       django_assert_max_num_queries):
+    for number in range(7):
+        Recipe.objects.create(
+            name=f'Recipe {number}', text='Test text', cooking_time=10,
+            author=test_user
+        )
+    api_client.force_authenticate(user=test_user)
+
+    response = api_client.get('/api/recipes/?pagination=cursor&limit=3')
+    assert response.status_code == 200
+    assert response.data['count'] is None
+    assert response.data['previous'] is None
+    seen = [recipe['name'] for recipe in response.data['results']]
+    assert seen == ['Recipe 6', 'Recipe 5', 'Recipe 4']
+
+    Recipe.objects.create(
+        name='Recipe new', text='Test text', cooking_time=10,
+        author=test_user
+    )
+    next_url = response.data['next']
+    while next_url:
+        with django_assert_max_num_queries(5):
+            response = api_client.get(next_url)
+        seen += [recipe['name'] for recipe in response.data['results']]
+        next_url = response.data['next']
+    assert seen == [f'Recipe {number}' for number in range(6, -1, -1)]
+
+    response = api_client.get(
+        '/api/recipes/?pagination=cursor&limit=3&count=exact'
+    )
+    assert response.data['count'] == 8
+    response = api_client.get('/api/recipes/?cursor=garbage')
+    assert response.status_code == 404
+    response = api_client.get('/api/recipes/?limit=3&page=2')
+    assert response.data['count'] == 8
+
+    def walk(query):
+        names = []
+        next_url = f'/api/recipes/?pagination=cursor&limit=3&{query}'
+        while next_url:
+            response = api_client.get(next_url)
+            assert response.status_code == 200, (next_url, response.data)
+            names += [recipe['name'] for recipe in response.data['results']]
+            next_url = response.data['next']
+        return names
+
+    def offset(query):
+        return [
+            recipe['name'] for recipe in
+            api_client.get(f'/api/recipes/?limit=20&{query}').data['results']
+        ]
+
+    recipes = {recipe.name: recipe for recipe in Recipe.objects.all()}
+    Recipe.objects.filter(pk__in=[
+        recipes[f'Recipe {number}'].pk for number in (1, 4, 5)
+    ]).update(favorites_count=2)
+    RecipePopularity.objects.bulk_create(
+        RecipePopularity(recipe=recipes[name], score=score)
+        for name, score in (('Recipe 2', 5.0), ('Recipe 0', 5.0),
+                            ('Recipe 3', 1.0))
+    )
+    for query in ('ordering=favorites', 'ordering=-favorites',
+                  'ordering=popular', 'ordering=popular,-favorites',
+                  'ordering=pub_date'):
+        assert walk(query) == offset(query), query
+    assert walk('ordering=popular')[:3] == [
+        'Recipe 2', 'Recipe 0', 'Recipe 3'
+    ]
+    next_url = api_client.get(
+        '/api/recipes/?pagination=cursor&limit=3&ordering=popular'
+    ).data['next']
+    response = api_client.get(next_url.replace('popular', 'favorites'))
+    assert response.status_code == 404
+
+
+def test_pagination_count_strategies(db, test_user, test_recipe, api_client,
+                                     django_assert_num_queries):
+    api_client.force_authenticate(user=test_user)
+    response = api_client.get('/api/recipes/')
+    assert response.data['count'] == 1
+    assert response.data['count_strategy'] == 'cached'
+
+    Recipe.objects.create(
+        name='Another', text='Test text', cooking_time=10, author=test_user
+    )
+    with django_assert_num_queries(3):
+        response = api_client.get('/api/recipes/')
+    assert response.data['count'] == 1
+    assert len(response.data['results']) == 2
+
+    response = api_client.get('/api/recipes/?count=exact')
+    assert (response.data['count'], response.data['count_strategy']) == (
+        2, 'exact'
+    )
+    response = api_client.get('/api/recipes/?count=estimated')
+    assert response.data['count'] == 2
+    response = api_client.get('/api/users/')
+    assert response.data['count_strategy'] == 'exact'
+
+
+def test_denormalized_counters(db, test_user, test_recipe, create_user,
+                               api_client):
+    other = create_user(email='other@test.com', username='other')
+    popular = Recipe.objects.create(
+        name='Popular', text='Test text', cooking_time=10, author=other
+    )
+    api_client.force_authenticate(user=test_user)
+    api_client.post(f'/api/recipes/{popular.id}/favorite/')
+    api_client.post(f'/api/recipes/{popular.id}/shopping_cart/')
+    api_client.post('/api/recipes/favorite/', {
+        'ids': [test_recipe.id, popular.id]
+    }, format='json')
+    api_client.post(f'/api/users/{other.id}/subscribe/')
+
+    popular.refresh_from_db()
+    test_recipe.refresh_from_db()
+    assert (popular.favorites_count, popular.carts_count) == (1, 1)
+    assert test_recipe.favorites_count == 1
+    other.refresh_from_db()
+    test_user.refresh_from_db()
+    assert (other.recipes_count, other.followers_count) == (1, 1)
+    assert (test_user.recipes_count, test_user.following_count) == (1, 1)
+
+    response = api_client.get('/api/users/me/')
+    assert response.data['recipes_count'] == 1
+    assert response.data['subscriptions_count'] == 1
+
+    Recipe.objects.filter(pk=popular.pk).update(favorites_count=7)
+    response = api_client.get('/api/recipes/?ordering=favorites')
+    assert [recipe['id'] for recipe in response.data['results']] == [
+        test_recipe.id, popular.id
+    ]
+
+    api_client.delete('/api/recipes/favorite/', {
+        'ids': [test_recipe.id]
+    }, format='json')
+    api_client.delete(f'/api/users/{other.id}/subscribe/')
+    test_recipe.refresh_from_db()
+    other.refresh_from_db()
+    assert test_recipe.favorites_count == 0
+    assert other.followers_count == 0
+
+    with pytest.raises(CommandError):
+        call_command('reconcile_counters', verify=True, stdout=StringIO())
+    call_command('reconcile_counters', stdout=StringIO())
+    call_command('reconcile_counters', verify=True, stdout=StringIO())
+    popular.refresh_from_db()
+    assert popular.favorites_count == 1
+
+    popular.delete()
+    other.refresh_from_db()
+    assert other.recipes_count == 0
+
+    reader = create_user(email='reader@test.com', username='reader')
+    Favorite.objects.create(user=reader, recipe=test_recipe)
+    ShoppingList.objects.create(user=reader, recipe=test_recipe)
+    api_client.force_authenticate(user=reader)
+    assert api_client.delete(
+        f'/api/recipes/{test_recipe.id}/favorite/'
+    ).status_code == 204
+    assert api_client.delete(
+        f'/api/recipes/{test_recipe.id}/favorite/'
+    ).status_code == 400
+    Favorite.objects.create(user=reader, recipe=test_recipe)
+    link = Favorite(user=reader, recipe=test_recipe)
+    with counters.batch():
+        counters.links_changed(Favorite, [link] * 3, 1)
+        counters.links_changed(Favorite, [link], -1)
+    test_recipe.refresh_from_db()
+    assert (test_recipe.favorites_count, test_recipe.carts_count) == (3, 1)
+    counters.links_changed(Favorite, [link] * 5, -1)
+    test_recipe.refresh_from_db()
+    assert test_recipe.favorites_count == 0
+    call_command('reconcile_counters', stdout=StringIO())
+    test_recipe.refresh_from_db()
+    assert (test_recipe.favorites_count, test_recipe.carts_count) == (1, 1)
+    reader.delete()
+    test_recipe.refresh_from_db()
+    assert (test_recipe.favorites_count, test_recipe.carts_count) == (0, 0)
+
+
+def test_popularity_is_refreshed_incrementally(db, test_user, test_recipe,
+                                               create_user, api_client):
+    other = create_user(email='other@test.com', username='other')
+    old = Recipe.objects.create(
+        name='Old favorite', text='Test text', cooking_time=10, author=other
+    )
+    fresh = Recipe.objects.create(
+        name='Fresh', text='Test text', cooking_time=10, author=other
+    )
+    Favorite.objects.create(user=test_user, recipe=old)
+    Favorite.objects.create(user=other, recipe=old)
+    Favorite.objects.filter(recipe=old).update(
+        created_at=timezone.now() - timedelta(days=30)
+    )
+    ShoppingList.objects.create(user=test_user, recipe=fresh)
+
+    assert popularity.refresh() == 2
+    assert popularity.refresh(lag=timedelta(0)) == 1
+    assert popularity.refresh(lag=timedelta(0)) == 0
+
+    response = api_client.get('/api/recipes/?ordering=popular')
+    assert [recipe['id'] for recipe in response.data['results']] == [
+        fresh.id, old.id, test_recipe.id
+    ]
+    response = api_client.get(f'/api/recipes/trending/?author={other.id}')
+    assert [recipe['id'] for recipe in response.data['results']] == [
+        fresh.id, old.id
+    ]
+
+    Favorite.objects.create(user=test_user, recipe=test_recipe)
+    Favorite.objects.create(user=other, recipe=test_recipe)
+    call_command('refresh_popularity', stdout=StringIO())
+    assert not RecipePopularity.objects.filter(recipe=test_recipe).exists()
+    assert popularity.refresh(lag=timedelta(0)) == 2
+    response = api_client.get('/api/recipes/trending/')
+    assert response.data['results'][0]['id'] == test_recipe.id
+
+    old_score = RecipePopularity.objects.get(recipe=old).score
+    assert popularity.rebuild(lag=timedelta(0)) == 5
+    assert RecipePopularity.objects.get(recipe=old).score == pytest.approx(
+        old_score
+    )
+
+    Favorite.objects.filter(user=test_user, recipe=old).delete()
+    ShoppingList.objects.filter(recipe=fresh).delete()
+    assert popularity.refresh() == 0
+    assert popularity.refresh(lag=timedelta(0)) == 2
+    assert RecipePopularity.objects.get(recipe=old).score == pytest.approx(
+        old_score - 1
+    )
+    assert not RecipePopularity.objects.filter(recipe=fresh).exists()
+    assert popularity.rebuild(lag=timedelta(0)) == 3
+    assert RecipePopularity.objects.get(recipe=old).score == pytest.approx(
+        old_score - 1
+    )
+
+
+def test_recipe_index_ranks_fields_and_requires_all_words():
+    index = RecipeIndex('v1', [
+        (1, 'Борщ', 'свёкла капуста', 'Варить два часа'),
+        (2, 'Винегрет', 'свекла картофель', 'Нарезать кубиками'),
+        (3, 'Салат', 'капуста морковь', 'Добавить свёклу по вкусу'),
+    ])
+    assert index.search('свекл', 10) == [2, 1, 3]
+    assert index.search('Свёкла капуста', 10) == [1]
+    assert index.search('борщ', 1) == [1]
+    assert index.search('рыба', 10) == []
+    assert index.search('  ', 10) == []
+
+
+@pytest.mark.skipif(not uses_search_vector(),
+                    reason='tsvector есть только в PostgreSQL')
+def test_recipe_search_vector(db, test_user, create_user, api_client,
+                              django_capture_on_commit_callbacks):
+    other = create_user(email='other@test.com', username='other')
+    beet = Ingredient.objects.create(name='Свёкла', measurement_unit='г')
+    cabbage = Ingredient.objects.create(name='Капуста', measurement_unit='г')
+    by_name = Recipe.objects.create(
+        name='Печёная свёкла', text='Запечь', cooking_time=30,
+        author=test_user
+    )
+    by_ingredient = Recipe.objects.create(
+        name='Борщ', text='Варить два часа', cooking_time=120,
+        author=test_user
+    )
+    RecipeIngredient.objects.create(
+        recipe=by_ingredient, ingredient=beet, amount=1
+    )
+    RecipeIngredient.objects.create(
+        recipe=by_ingredient, ingredient=cabbage, amount=1
+    )
+    by_text = Recipe.objects.create(
+        name='Салат', text='Добавить свёклу', cooking_time=10, author=other
+    )
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_search([by_name.pk, by_ingredient.pk, by_text.pk])
+
+    def search(**params):
+        response = api_client.get('/api/recipes/', params)
+        assert response.status_code == 200
+        return [recipe['id'] for recipe in response.data['results']]
+
+    assert search(search='свёкла') == [
+        by_name.id, by_ingredient.id, by_text.id
+    ]
+    assert search(search='свёкла -капуста') == [by_name.id, by_text.id]
+    assert search(search='свёкла', author=other.id) == [by_text.id]
+    assert search(search='рыба') == []
+
+    by_text.text = 'Нарезать кубиками'
+    with django_capture_on_commit_callbacks(execute=True):
+        by_text.save()
+        refresh_search([by_text.pk])
+    assert search(search='свёкла') == [by_name.id, by_ingredient.id]
+
+
+def test_recipe_search(db, test_user, test_ingredient, test_tag, api_client,
+                       django_capture_on_commit_callbacks, settings):
+    beet = Ingredient.objects.create(name='Свёкла', measurement_unit='г')
+    soup = Recipe.objects.create(
+        name='Борщ', text='Варить два часа', cooking_time=120,
+        author=test_user
+    )
+    RecipeIngredient.objects.create(recipe=soup, ingredient=beet, amount=1)
+    salad = Recipe.objects.create(
+        name='Салат', text='Добавить свёклу', cooking_time=10,
+        author=test_user
+    )
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_search([soup.pk, salad.pk])
+
+    response = api_client.get('/api/recipes/', {'search': 'свёкл'})
+    assert [recipe['id'] for recipe in response.data['results']] == [
+        soup.id, salad.id
+    ]
+    response = api_client.get('/api/recipes/', {
+        'search': 'свёкл', 'pagination': 'cursor', 'limit': 1
+    })
+    assert [recipe['id'] for recipe in response.data['results']] == [soup.id]
+    response = api_client.get(response.data['next'])
+    assert [recipe['id'] for recipe in response.data['results']] == [
+        salad.id
+    ]
+    assert response.data['next'] is None
+    response = api_client.get('/api/recipes/', {
+        'search': 'свекла', 'author': test_user.id
+    })
+    assert response.data['count'] == 1
+
+    settings.RECIPE_SEARCH_LIMIT = 1
+    Favorite.objects.create(user=test_user, recipe=salad)
+    api_client.force_authenticate(user=test_user)
+    response = api_client.get('/api/recipes/', {
+        'search': 'свёкл', 'is_favorited': 1
+    })
+    assert [recipe['id'] for recipe in response.data['results']] == [
+        salad.id
+    ]
+
+    api_client.force_authenticate(user=test_user)
+    with django_capture_on_commit_callbacks(execute=True):
+        response = api_client.patch(f'/api/recipes/{salad.id}/', {
+            'name': 'Винегрет',
+            'text': 'Нарезать кубиками',
+            'cooking_time': 10,
+            'ingredients': [{'id': test_ingredient.id, 'amount': 10}],
+            'tags': [test_tag.id],
+        }, format='json')
+    assert response.status_code == 200
+    response = api_client.get('/api/recipes/', {'search': 'test ingredient'})
+    assert [recipe['id'] for recipe in response.data['results']] == [
+        salad.id
+    ]
+    response = api_client.get('/api/recipes/', {'search': 'рыба'})
+    assert response.data['results'] == []
+
+
+def test_ingredient_matcher_ranks_by_coverage():
+    matcher = IngredientMatcher('v1', [
+        (1, 10), (1, 11), (1, 12), (1, 13),
+        (2, 10), (2, 11),
+        (3, 12), (3, 14),
+        (4, 10), (4, 12),
+    ])
+    assert len(matcher) == 4
+    assert matcher.match([10, 11, 12], 10) == [
+        (4, 1.0, []),
+        (2, 1.0, []),
+        (1, 0.75, [13]),
+        (3, 0.5, [14]),
+    ]
+    assert matcher.match([14, 14], 1) == [(3, 0.5, [12])]
+    assert matcher.match([99], 10) == []
+
+
+def test_recipe_match_endpoint(db, test_user, test_ingredients, api_client,
+                               django_capture_on_commit_callbacks,
+                               django_assert_num_queries):
+    first, second = test_ingredients[:2]
+    full = Recipe.objects.create(
+        name='Full', text='Test text', cooking_time=10, author=test_user
+    )
+    half = Recipe.objects.create(
+        name='Half', text='Test text', cooking_time=10, author=test_user
+    )
+    RecipeIngredient.objects.bulk_create([
+        RecipeIngredient(recipe=full, ingredient=first, amount=1),
+        RecipeIngredient(recipe=half, ingredient=first, amount=1),
+        RecipeIngredient(recipe=half, ingredient=second, amount=1),
+    ])
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_search([full.pk, half.pk])
+
+    response = api_client.get(
+        '/api/recipes/match/', {'ingredients': f'{first.id}'}
+    )
+    assert response.status_code == 200
+    assert [
+        (recipe['id'], recipe['coverage'], recipe['missing'])
+        for recipe in response.data
+    ] == [
+        (full.id, 1.0, []),
+        (half.id, 0.5, [{
+            'id': second.id,
+            'name': second.name,
+            'measurement_unit': second.measurement_unit,
+        }]),
+    ]
+    with django_assert_num_queries(1):
+        api_client.get('/api/recipes/match/', {
+            'ingredients': [first.id, second.id], 'limit': 1
+        })
+
+    response = api_client.get('/api/recipes/match/')
+    assert response.status_code == 400
+
+
+def test_recipe_index_applies_changes(db, test_user, test_ingredients,
+                                      django_capture_on_commit_callbacks):
+    first, second = test_ingredients[:2]
+    soup = Recipe.objects.create(
+        name='Суп', text='Варить', cooking_time=10, author=test_user
+    )
+    RecipeIngredient.objects.create(recipe=soup, ingredient=first, amount=1)
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_search([soup.pk])
+    index, matcher = get_recipe_index(), get_recipe_matcher()
+    assert index.search('суп', 10) == [soup.pk]
+
+    salad = Recipe.objects.create(
+        name='Салат', text='Нарезать', cooking_time=10, author=test_user
+    )
+    RecipeIngredient.objects.create(recipe=salad, ingredient=second, amount=1)
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_search([salad.pk])
+        soup.delete()
+    assert get_recipe_index() is index
+    assert get_recipe_matcher() is matcher
+    assert index.search('суп', 10) == []
+    assert index.search('салат', 10) == [salad.pk]
+    assert len(matcher) == 1
+    assert matcher.match([second.pk], 10) == [(salad.pk, 1.0, [])]
+    assert matcher.match([first.pk], 10) == []
+
+    recipe_index.since -= timedelta(days=2)
+    recipe_index.pruned -= timedelta(days=2)
+    RecipeChange.objects.update(changed_at=recipe_index.since)
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_search([salad.pk])
+    assert get_recipe_index() is not index
+    assert get_recipe_index().search('салат', 10) == [salad.pk]
+    assert not RecipeChange.objects.filter(
+        changed_at__lt=timezone.now() - timedelta(days=1)
+    ).exists()
+
+
+def test_recipe_tag_filter_modes(db, test_user, test_tags, api_client,
+                                 django_assert_num_queries):
+    breakfast, lunch = test_tags
+    both = Recipe.objects.create(
+        name='Both', text='Test text', cooking_time=10, author=test_user
+    )
+    both.tags.add(breakfast, lunch)
+    only = Recipe.objects.create(
+        name='Only', text='Test text', cooking_time=10, author=test_user
+    )
+    only.tags.add(breakfast)
+    Recipe.objects.create(
+        name='None', text='Test text', cooking_time=10, author=test_user
+    )
+
+    def ids(**params):
+        response = api_client.get('/api/recipes/', {
+            'tags': [breakfast.slug, lunch.slug], 'count': 'exact', **params
+        })
+        assert response.status_code == 200
+        assert response.data['count'] == len(response.data['results'])
+        return [recipe['id'] for recipe in response.data['results']]
+
+    assert ids() == [only.id, both.id]
+    assert ids(tags_mode='all') == [both.id]
+    # Рецепты уже в кэше фрагментов: только count и страница.
+    with django_assert_num_queries(2):
+        assert ids(tags_mode='any') == [only.id, both.id]
+
+    response = api_client.get('/api/recipes/', {'tags': 'missing'})
+    assert response.status_code == 400
+
+
+def test_recipe_fragment_cache(db, test_user, test_recipe, test_tags,
+                               test_ingredient, create_user,
+                               settings, django_assert_num_queries):
+    reader = create_user(email='reader@test.com')
+    test_recipe.tags.add(test_tags[0])
+    link = RecipeIngredient.objects.create(
+        recipe=test_recipe, ingredient=test_ingredient, amount=10
+    )
+    Favorite.objects.create(user=reader, recipe=test_recipe)
+    Subscription.objects.create(user=reader, author=test_user)
+
+    def fetch(user=None, path='/api/recipes/'):
+        client = APIClient()
+        if user is not None:
+            client.force_authenticate(user=user)
+        response = client.get(path)
+        assert response.status_code == 200
+        return response.data.get('results', [response.data])[0]
+
+    first = fetch(test_user)
+    with django_assert_num_queries(1):
+        cached = fetch(reader)
+    assert cached['is_favorited'] and cached['author']['is_subscribed']
+    assert not first['is_favorited'] and not first['author']['is_subscribed']
+    assert {**cached, 'is_favorited': False, 'author': first['author']} == {
+        **first, 'is_favorited': False
+    }
+    assert fetch()['is_favorited'] is False
+    assert fetch(reader, f'/api/recipes/{test_recipe.id}/')['is_favorited']
+
+    link.amount = 25
+    link.save()
+    assert fetch()['ingredients'][0]['amount'] == 25
+    test_ingredient.name = 'Renamed ingredient'
+    test_ingredient.save()
+    assert fetch()['ingredients'][0]['name'] == 'Renamed ingredient'
+    test_tags[0].name = 'Renamed tag'
+    test_tags[0].save()
+    assert fetch()['tags'][0]['name'] == 'Renamed tag'
+    test_user.first_name = 'Renamed'
+    test_user.save()
+    assert fetch()['author']['first_name'] == 'Renamed'
+    test_recipe.refresh_from_db()
+    test_recipe.name = 'Renamed recipe'
+    test_recipe.save()
+    assert fetch()['name'] == 'Renamed recipe'
+
+    settings.RECIPE_FRAGMENT_SHARED_CACHE = True
+    fragments.clear()
+    fetch()
+    fragments.clear()
+    with django_assert_num_queries(1):
+        assert fetch()['name'] == 'Renamed recipe'
+
+
+def test_recipe_admin_inline_delete_changes_version(
+        db, test_user, test_recipe, test_ingredients, client):
+    links = [
+        RecipeIngredient.objects.create(
+            recipe=test_recipe, ingredient=ingredient, amount=1
+        )
+        for ingredient in test_ingredients[:2]
+    ]
+    ShoppingList.objects.create(user=test_user, recipe=test_recipe)
+    refresh_totals([test_user.pk])
+    version = Recipe.objects.get(pk=test_recipe.pk).version
+    test_user.is_staff = test_user.is_superuser = True
+    test_user.save()
+    client.force_login(test_user)
+    data = {
+        'name': test_recipe.name,
+        'text': test_recipe.text,
+        'cooking_time': test_recipe.cooking_time,
+        'author': test_user.pk,
+        'recipeingredients-TOTAL_FORMS': 2,
+        'recipeingredients-INITIAL_FORMS': 2,
+        'recipetag-TOTAL_FORMS': 0,
+        'recipetag-INITIAL_FORMS': 0,
+    }
+    for number, link in enumerate(links):
+        data.update({
+            f'recipeingredients-{number}-id': link.pk,
+            f'recipeingredients-{number}-recipe': test_recipe.pk,
+            f'recipeingredients-{number}-ingredient': link.ingredient_id,
+            f'recipeingredients-{number}-amount': 1,
+        })
+    data['recipeingredients-1-DELETE'] = 'on'
+    response = client.post(
+        f'/admin/recipes/recipe/{test_recipe.pk}/change/', data
+    )
+    assert response.status_code == 302
+    assert test_recipe.recipeingredients.count() == 1
+    assert Recipe.objects.get(pk=test_recipe.pk).version != version
+    assert list(ShoppingCartIngredient.objects.filter(
+        user=test_user).values_list('ingredient', flat=True)
+    ) == [test_ingredients[0].pk]
+
+
+
+def test_deleting_recipe_links_changes_version(
+        db, test_user, test_recipe, test_tags, test_ingredient, api_client,
+        client):
+    assert admin.site.is_registered(RecipeIngredient)
+    assert admin.site.is_registered(RecipeTag)
+    test_recipe.tags.add(test_tags[0])
+    link = RecipeIngredient.objects.create(
+        recipe=test_recipe, ingredient=test_ingredient, amount=10
+    )
+    api_client.force_authenticate(user=test_user)
+
+    def fetch():
+        return api_client.get('/api/recipes/').data['results'][0]
+
+    assert len(fetch()['ingredients']) == 1
+    version = Recipe.objects.get(pk=test_recipe.pk).version
+    test_user.is_staff = test_user.is_superuser = True
+    test_user.save()
+    client.force_login(test_user)
+    response = client.post(
+        f'/admin/recipes/recipeingredient/{link.pk}/delete/', {'post': 'yes'}
+    )
+    assert response.status_code == 302
+    assert Recipe.objects.get(pk=test_recipe.pk).version != version
+    assert fetch()['ingredients'] == []
+
+    version = Recipe.objects.get(pk=test_recipe.pk).version
+    assert len(fetch()['tags']) == 1
+    RecipeTag.objects.filter(recipe=test_recipe).delete()
+    assert Recipe.objects.get(pk=test_recipe.pk).version != version
+    assert fetch()['tags'] == []
+
+
+def test_shopping_list_admin_refreshes_totals(
+        db, test_user, test_recipe, test_ingredient, client):
+    RecipeIngredient.objects.create(
+        recipe=test_recipe, ingredient=test_ingredient, amount=3
+    )
+    test_user.is_staff = test_user.is_superuser = True
+    test_user.save()
+    client.force_login(test_user)
+
+    def totals():
+        return dict(ShoppingCartIngredient.objects.filter(
+            user=test_user).values_list('ingredient', 'total_amount'))
+
+    response = client.post('/admin/recipes/shoppinglist/add/', {
+        'user': test_user.pk, 'recipe': test_recipe.pk
+    })
+    assert response.status_code == 302
+    assert totals() == {test_ingredient.pk: 3}
+    cart = ShoppingList.objects.get(user=test_user)
+    response = client.post(
+        f'/admin/recipes/shoppinglist/{cart.pk}/delete/', {'post': 'yes'}
+    )
+    assert response.status_code == 302
+    assert totals() == {}
+
+    data = {
+        'username': test_user.username,
+        'email': test_user.email,
+        'first_name': 'Test',
+        'last_name': 'User',
+        'password': test_user.password,
+        'role': test_user.role,
+        'is_active': 'on',
+        'is_staff': 'on',
+        'is_superuser': 'on',
+        'date_joined_0': '2026-01-01',
+        'date_joined_1': '00:00:00',
+        'shopping_cart-TOTAL_FORMS': 1,
+        'shopping_cart-INITIAL_FORMS': 0,
+        'shopping_cart-0-user': test_user.pk,
+        'shopping_cart-0-recipe': test_recipe.pk,
+    }
+    for prefix in ('follower', 'favorites'):
+        data[f'{prefix}-TOTAL_FORMS'] = data[f'{prefix}-INITIAL_FORMS'] = 0
+    response = client.post(
+        f'/admin/users/user/{test_user.pk}/change/', data
+    )
+    assert response.status_code == 302
+    assert totals() == {test_ingredient.pk: 3}
+
+    response = client.post(
+        f'/admin/recipes/recipe/{test_recipe.pk}/delete/', {'post': 'yes'}
+    )
+    assert response.status_code == 302
+    assert totals() == {}
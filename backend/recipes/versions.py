@@ -0,0 +1,92 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Recipe, RecipeChange
+
+INGREDIENTS = 'ingredients'
+RECIPES = 'recipes'
+TAGS = 'tags'
+# Изменения моложе этого перечитываются при следующей синхронизации:
+# транзакция, записавшая их раньше, может закоммититься позже.
+CHANGES_LAG = timedelta(seconds=30)
+
+_pending_links = ContextVar('pending_recipe_links', default=None)
+
+
+def _key(name):
+    return f'version:{name}'
+
+
+def get_version(name):
+    version = cache.get(_key(name))
+    if version is None:
+        cache.add(_key(name), uuid4().hex, None)
+        version = cache.get(_key(name))
+    return version
+
+
+def bump_version(name):
+    """Меняет версию набора данных, сбрасывая кэши во всех процессах."""
+    version = uuid4().hex
+    cache.set(_key(name), version, None)
+    return version
+
+
+def touch_recipes(recipes):
+    """Меняет версию рецептов из queryset: их закэшированные
+    представления больше не используются."""
+    return recipes.update(version=uuid4())
+
+
+def recipe_links_changed(recipe_ids):
+    """Меняет версию рецептов, у которых добавились, изменились или
+    удалились строки ингредиентов и тегов.
+
+    Внутри batch() версии меняются одним UPDATE при выходе из блока.
+    """
+    pending = _pending_links.get()
+    if pending is None:
+        touch_recipes(Recipe.objects.filter(pk__in=set(recipe_ids)))
+    else:
+        pending.update(recipe_ids)
+
+
+@contextmanager
+def batch():
+    """Одна смена версии на рецепт вместо UPDATE на каждую строку связи,
+    например при удалении рецепта с сигналами post_delete."""
+    pending = set()
+    token = _pending_links.set(pending)
+    try:
+        yield
+    finally:
+        _pending_links.reset(token)
+    if pending:
+        touch_recipes(Recipe.objects.filter(pk__in=pending))
+
+
+def recipes_changed(recipe_ids):
+    """Записывает изменённые рецепты в журнал RecipeChange и после
+    коммита меняет версию RECIPES."""
+    recipe_ids = set(recipe_ids)
+    if not recipe_ids:
+        return
+    RecipeChange.objects.bulk_create(
+        (RecipeChange(recipe_id=pk) for pk in recipe_ids), batch_size=1000
+    )
+    transaction.on_commit(lambda: bump_version(RECIPES))
+
+
+def changed_recipes(since):
+    return set(RecipeChange.objects.filter(
+        changed_at__gte=since
+    ).values_list('recipe_id', flat=True))
+
+
+def prune_changes(before):
+    return RecipeChange.objects.filter(changed_at__lt=before).delete()[0]
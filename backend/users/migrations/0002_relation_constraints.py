@@ -0,0 +1,35 @@
+# Generated by Django 3.2.19 on 2026-10-18 04:23
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicate_subscriptions(apps, schema_editor):
+    Subscription = apps.get_model('users', 'Subscription')
+    duplicates = (
+        Subscription.objects.values('user', 'author')
+        .annotate(keep_id=Min('id'), total=Count('id'))
+        .filter(total__gt=1)
+        .order_by()
+    )
+    for duplicate in duplicates:
+        Subscription.objects.filter(
+            user=duplicate['user'], author=duplicate['author']
+        ).exclude(id=duplicate['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            delete_duplicate_subscriptions, migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=models.UniqueConstraint(fields=('user', 'author'), name='unique_subscription'),
+        ),
+    ]
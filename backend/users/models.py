@@ -36,6 +36,15 @@ class User(AbstractUser):
         choices=ROLES,
         default=DEFAULT_ROLE
     )
+    recipes_count = models.PositiveIntegerField(
+        'рецептов', default=0, editable=False
+    )
+    followers_count = models.PositiveIntegerField(
+        'подписчиков', default=0, editable=False
+    )
+    following_count = models.PositiveIntegerField(
+        'подписок', default=0, editable=False
+    )
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ('first_name', 'last_name', 'username', )
@@ -67,5 +76,12 @@ class Subscription(models.Model):
         on_delete=models.CASCADE,
         related_name='followed')
 
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'author'), name='unique_subscription'
+            ),
+        )
+
     def __str__(self):
         return f'{self.user} follows {self.author}'